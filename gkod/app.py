@@ -1,6 +1,6 @@
 # app.py
-from flask import Flask, request, jsonify, render_template
-from flask_socketio import SocketIO, emit, disconnect
+from flask import Flask, Response, request, jsonify, render_template, g
+from flask_socketio import SocketIO, ConnectionRefusedError, emit, disconnect, join_room
 from flask_cors import CORS
 from flask_limiter import Limiter
 from flask_limiter.util import get_remote_address
@@ -9,33 +9,585 @@ import sqlite3
 import uuid
 import jwt
 import datetime
+import base64
+import hashlib
+import json
 import logging
 import os
+import platform
 import ssl
+import atexit
+import queue
+import threading
+import time
+import weakref
+from bisect import bisect_left
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from contextlib import contextmanager
 from functools import wraps
 
+from logsetup import parse_levels, setup_logging
+
 # Logging ayarları
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.FileHandler('/var/log/remotecontrol/server.log'),
-        logging.StreamHandler()
-    ]
+LOG_FILE = os.environ.get('LOG_FILE', '/var/log/remotecontrol/server.log')
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO')
+# Per-logger levels; Socket.IO packet logs are off unless lowered here
+LOG_LEVELS = os.environ.get('LOG_LEVELS', 'engineio.server=WARNING,socketio.server=WARNING')
+LOG_FORMAT = os.environ.get('LOG_FORMAT', 'text')
+LOG_MAX_BYTES = int(os.environ.get('LOG_MAX_BYTES', 50 * 1024 * 1024))
+LOG_BACKUPS = int(os.environ.get('LOG_BACKUPS', 10))
+LOG_QUEUE_SIZE = int(os.environ.get('LOG_QUEUE_SIZE', 10000))
+# Packet loggers: records per second, burst, and 1-in-N sampling of the excess
+LOG_PACKET_RATE = float(os.environ.get('LOG_PACKET_RATE', 20))
+LOG_PACKET_BURST = float(os.environ.get('LOG_PACKET_BURST', 100))
+LOG_PACKET_SAMPLE = int(os.environ.get('LOG_PACKET_SAMPLE', 100))
+PACKET_LOGGERS = ('engineio.server', 'socketio.server')
+
+log_handler = setup_logging(
+    LOG_FILE,
+    level=LOG_LEVEL,
+    levels=parse_levels(LOG_LEVELS),
+    json_format=LOG_FORMAT == 'json',
+    max_bytes=LOG_MAX_BYTES,
+    backups=LOG_BACKUPS,
+    queue_size=LOG_QUEUE_SIZE,
+    rate_limits={name: (LOG_PACKET_RATE, LOG_PACKET_BURST, LOG_PACKET_SAMPLE) for name in PACKET_LOGGERS}
 )
 logger = logging.getLogger(__name__)
 
 app = Flask(__name__)
-app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', 'your-secret-key-here')
+DEFAULT_SECRET_KEY = 'your-secret-key-here'
+app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', DEFAULT_SECRET_KEY)
 CORS(app, resources={r"/*": {"origins": "*"}})
-socketio = SocketIO(app, cors_allowed_origins="*", ping_timeout=60)
+# Set SOCKETIO_MESSAGE_QUEUE (e.g. redis://localhost:6379/0) when running several
+# worker processes so emits reach sockets owned by other workers
+# Logger objects instead of True: the libraries would otherwise attach their own blocking handlers
+socketio = SocketIO(app, cors_allowed_origins="*", ping_timeout=60,
+                    message_queue=os.environ.get('SOCKETIO_MESSAGE_QUEUE'),
+                    logger=logging.getLogger('socketio.server'),
+                    engineio_logger=logging.getLogger('engineio.server'))
 limiter = Limiter(app=app, key_func=get_remote_address)
 
-class Database:
+DB_PATH = os.environ.get('DB_PATH', '/var/lib/remotecontrol/database.db')
+DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', 8))
+DB_POOL_TIMEOUT = float(os.environ.get('DB_POOL_TIMEOUT', 30))
+DB_CACHE_SIZE_KB = int(os.environ.get('DB_CACHE_SIZE_KB', 16384))
+DB_CACHED_STATEMENTS = int(os.environ.get('DB_CACHED_STATEMENTS', 256))
+AUTH_CACHE_SIZE = int(os.environ.get('AUTH_CACHE_SIZE', 10000))
+AUTH_CACHE_TTL = float(os.environ.get('AUTH_CACHE_TTL', 300))
+AUTH_CACHE_NEGATIVE_TTL = float(os.environ.get('AUTH_CACHE_NEGATIVE_TTL', 30))
+# Signing keys as "kid:secret,kid:secret"; JWT_ACTIVE_KID signs new tokens and the
+# others stay valid for verification until removed, which allows rotation
+JWT_KEYS = os.environ.get('JWT_KEYS', '')
+JWT_ACTIVE_KID = os.environ.get('JWT_ACTIVE_KID')
+JWT_TTL = float(os.environ.get('JWT_TTL', 86400))
+JWT_CACHE_SIZE = int(os.environ.get('JWT_CACHE_SIZE', 10000))
+# Agent reconnects: resume token lifetime, how long a dropped client's registry entry is kept,
+# and the admission rate for new agent connections before they are told to retry later
+RESUME_TTL = float(os.environ.get('RESUME_TTL', 3600))
+RESUME_PARK_TTL = float(os.environ.get('RESUME_PARK_TTL', 300))
+RESUME_PARK_MAX = int(os.environ.get('RESUME_PARK_MAX', 10000))
+CONNECT_RATE = float(os.environ.get('CONNECT_RATE', 100))
+CONNECT_BURST = float(os.environ.get('CONNECT_BURST', 500))
+CONNECT_RETRY_MAX = float(os.environ.get('CONNECT_RETRY_MAX', 60))
+PRESENCE_FLUSH_INTERVAL = float(os.environ.get('PRESENCE_FLUSH_INTERVAL', 5))
+AUDIT_BATCH_SIZE = int(os.environ.get('AUDIT_BATCH_SIZE', 500))
+AUDIT_QUEUE_SIZE = int(os.environ.get('AUDIT_QUEUE_SIZE', 100000))
+AUDIT_ID_BLOCK = int(os.environ.get('AUDIT_ID_BLOCK', 1000))
+AUDIT_WRITE_RETRIES = int(os.environ.get('AUDIT_WRITE_RETRIES', 3))
+BATCH_MAX_TARGETS = int(os.environ.get('BATCH_MAX_TARGETS', 10000))
+BATCH_EMIT_CHUNK = int(os.environ.get('BATCH_EMIT_CHUNK', 200))
+BATCH_EMIT_PAUSE = float(os.environ.get('BATCH_EMIT_PAUSE', 0.01))
+REGISTRY_TOMBSTONES = int(os.environ.get('REGISTRY_TOMBSTONES', 1000))
+# 'local' keeps presence in this process only, 'sqlite' shares it between workers
+PRESENCE_BACKEND = os.environ.get('PRESENCE_BACKEND', 'local')
+PRESENCE_LEASE = float(os.environ.get('PRESENCE_LEASE', 30))
+PRESENCE_TOMBSTONE_TTL = float(os.environ.get('PRESENCE_TOMBSTONE_TTL', 3600))
+WORKER_ID = f'{platform.node()}-{os.getpid()}-{uuid.uuid4().hex[:8]}'
+COMMAND_RESULT_CACHE = int(os.environ.get('COMMAND_RESULT_CACHE', 10000))
+COMMAND_WAIT_MAX = float(os.environ.get('COMMAND_WAIT_MAX', 60))
+# How often a waiting request re-reads results recorded by other workers
+COMMAND_WAIT_POLL = float(os.environ.get('COMMAND_WAIT_POLL', 1))
+OUTBOX_DEFAULT_TTL = float(os.environ.get('OUTBOX_DEFAULT_TTL', 3600))
+OUTBOX_MAX_TTL = float(os.environ.get('OUTBOX_MAX_TTL', 7 * 24 * 3600))
+OUTBOX_MAX_DEPTH = int(os.environ.get('OUTBOX_MAX_DEPTH', 100))
+OUTBOX_MAX_ATTEMPTS = int(os.environ.get('OUTBOX_MAX_ATTEMPTS', 5))
+SCREENSHOT_MAX_BYTES = int(os.environ.get('SCREENSHOT_MAX_BYTES', 20 * 1024 * 1024))
+SCREENSHOT_MAX_CHUNKS = int(os.environ.get('SCREENSHOT_MAX_CHUNKS', 1024))
+SCREENSHOT_STORE_BYTES = int(os.environ.get('SCREENSHOT_STORE_BYTES', 256 * 1024 * 1024))
+SCREENSHOT_TTL = float(os.environ.get('SCREENSHOT_TTL', 600))
+SCREENSHOT_MIME_TYPES = ('image/jpeg', 'image/webp', 'image/png')
+WATCH_MAX_FRAME_BYTES = int(os.environ.get('WATCH_MAX_FRAME_BYTES', 1024 * 1024))
+# 'thread' hashes in native threads (hashlib releases the GIL), 'inline' in the request
+PASSWORD_HASH_MODE = os.environ.get('PASSWORD_HASH_MODE', 'thread')
+PASSWORD_HASH_WORKERS = int(os.environ.get('PASSWORD_HASH_WORKERS', 2))
+PASSWORD_HASH_QUEUE = int(os.environ.get('PASSWORD_HASH_QUEUE', 16))
+PASSWORD_HASH_TIMEOUT = float(os.environ.get('PASSWORD_HASH_TIMEOUT', 10))
+METRICS_MAX_LABEL_VALUES = int(os.environ.get('METRICS_MAX_LABEL_VALUES', 100))
+METRICS_LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+METRICS_DB_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1)
+# Agent load history: raw samples are kept briefly, 1-minute and 1-hour rollups much longer
+METRICS_RAW_RETENTION = float(os.environ.get('METRICS_RAW_RETENTION', 24 * 3600))
+METRICS_RETENTION = float(os.environ.get('METRICS_RETENTION', 7 * 24 * 3600))
+METRICS_HOURLY_RETENTION = float(os.environ.get('METRICS_HOURLY_RETENTION', 90 * 24 * 3600))
+METRICS_PRUNE_INTERVAL = float(os.environ.get('METRICS_PRUNE_INTERVAL', 3600))
+METRICS_BATCH_MAX = int(os.environ.get('METRICS_BATCH_MAX', 1000))
+METRICS_MAX_POINTS = int(os.environ.get('METRICS_MAX_POINTS', 500))
+# Sample columns in client_metrics order; must match METRIC_FIELDS in client.py
+METRIC_FIELDS = ('ts', 'cpu', 'mem_percent', 'mem_used', 'disk_percent',
+                 'disk_read', 'disk_write', 'net_sent', 'net_recv')
+# (table, bucket seconds, retention) from finest to coarsest
+METRICS_TIERS = (
+    ('client_metrics', 1, METRICS_RAW_RETENTION),
+    ('client_metrics_1m', 60, METRICS_RETENTION),
+    ('client_metrics_1h', 3600, METRICS_HOURLY_RETENTION)
+)
+HISTORY_PAGE_SIZE = int(os.environ.get('HISTORY_PAGE_SIZE', 50))
+HISTORY_MAX_PAGE_SIZE = int(os.environ.get('HISTORY_MAX_PAGE_SIZE', 500))
+
+# Metrics: updated without locks on the hot path, rendered in Prometheus text format
+class Metric:
+    def __init__(self, name, description, kind, labelnames=()):
+        self.name = name
+        self.description = description
+        self.kind = kind
+        self.labelnames = labelnames
+        self._children = {}
+        if not labelnames:
+            self.labels()
+
+    def labels(self, *values):
+        child = self._children.get(values)
+        if child is None:
+            # Label values can come from requests; fold the long tail into 'other'
+            if len(self._children) >= METRICS_MAX_LABEL_VALUES:
+                values = ('other',) * len(values)
+            child = self._children.setdefault(values, self._new_child())
+        return child
+
+    def _label_text(self, values, extra=()):
+        pairs = list(zip(self.labelnames, values)) + list(extra)
+        if not pairs:
+            return ''
+        escaped = (
+            (k, str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+            for k, v in pairs
+        )
+        return '{' + ','.join(f'{k}="{v}"' for k, v in escaped) + '}'
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.description}', f'# TYPE {self.name} {self.kind}']
+        for values, child in list(self._children.items()):
+            lines.extend(self._render_child(values, child))
+        return lines
+
+class Counter(Metric):
+    def __init__(self, name, description, labelnames=()):
+        super().__init__(name, description, 'counter', labelnames)
+
+    def _new_child(self):
+        return [0]
+
+    def inc(self, *values, amount=1):
+        self.labels(*values)[0] += amount
+
+    def _render_child(self, values, child):
+        return [f'{self.name}{self._label_text(values)} {child[0]}']
+
+class Histogram(Metric):
+    def __init__(self, name, description, buckets, labelnames=()):
+        self.buckets = tuple(buckets)
+        super().__init__(name, description, 'histogram', labelnames)
+
+    def _new_child(self):
+        # One slot per bucket plus +Inf, then sum and count
+        return [0] * (len(self.buckets) + 3)
+
+    def observe(self, value, *values):
+        child = self.labels(*values)
+        child[bisect_left(self.buckets, value)] += 1
+        child[-2] += value
+        child[-1] += 1
+
+    def _render_child(self, values, child):
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + ('+Inf',), child):
+            cumulative += count
+            lines.append(f'{self.name}_bucket{self._label_text(values, [("le", bound)])} {cumulative}')
+        lines.append(f'{self.name}_sum{self._label_text(values)} {child[-2]}')
+        lines.append(f'{self.name}_count{self._label_text(values)} {child[-1]}')
+        return lines
+
+class Sampled(Metric):
+    # Value read from a callback at scrape time
+    def __init__(self, name, description, kind, read):
+        self.name = name
+        self.description = description
+        self.kind = kind
+        self.read = read
+
+    def render(self):
+        try:
+            value = self.read()
+        except Exception as e:
+            logger.error(f"Error reading metric {self.name}: {e}")
+            return []
+        return [f'# HELP {self.name} {self.description}', f'# TYPE {self.name} {self.kind}',
+                f'{self.name} {value}']
+
+class MetricsRegistry:
     def __init__(self):
-        self.db_path = '/var/lib/remotecontrol/database.db'
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name, description, labelnames=()):
+        return self.register(Counter(name, description, labelnames))
+
+    def histogram(self, name, description, buckets, labelnames=()):
+        return self.register(Histogram(name, description, buckets, labelnames))
+
+    def sampled(self, name, description, read, kind='gauge'):
+        return self.register(Sampled(name, description, kind, read))
+
+    def render(self):
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+metrics = MetricsRegistry()
+connects_total = metrics.counter('rc_connects_total', 'Agent socket connections accepted')
+connects_resumed_total = metrics.counter('rc_connects_resumed_total',
+                                         'Agent connections that resumed a previous session')
+connects_refused_total = metrics.counter('rc_connects_refused_total',
+                                         'Agent connections refused while over the admission rate')
+disconnects_total = metrics.counter('rc_disconnects_total', 'Agent socket disconnections')
+heartbeats_total = metrics.counter('rc_heartbeats_total', 'Heartbeats received')
+commands_sent_total = metrics.counter('rc_commands_sent_total', 'Commands emitted to agents')
+metric_samples_total = metrics.counter('rc_metric_samples_total', 'Agent load samples received')
+command_output_total = metrics.counter('rc_command_output_chunks_total', 'exec output chunks relayed to dashboards')
+screen_frames_total = metrics.counter('rc_screen_frames_total', 'Screen watch packets relayed to dashboards')
+screen_frame_bytes_total = metrics.counter('rc_screen_frame_bytes_total', 'Screen watch tile bytes relayed')
+errors_total = metrics.counter('rc_errors_total', 'Errors by source', ('source',))
+command_latency = metrics.histogram('rc_command_latency_seconds',
+                                    'Time from dispatch to command_result, by command',
+                                    METRICS_LATENCY_BUCKETS, ('command',))
+db_latency = metrics.histogram('rc_db_operation_seconds', 'Database method duration',
+                               METRICS_DB_BUCKETS, ('method',))
+
+class CommandTimer:
+    # Dispatch timestamps of in-flight commands, bounded like CommandResults
+    def __init__(self, histogram, max_entries=COMMAND_RESULT_CACHE):
+        self.histogram = histogram
+        self.max_entries = max_entries
+        self._started = OrderedDict()
+        self._lock = threading.Lock()
+
+    def start(self, command_id, command):
+        with self._lock:
+            self._started[command_id] = (command, time.monotonic())
+            if len(self._started) > self.max_entries:
+                self._started.popitem(last=False)
+
+    def finish(self, command_id):
+        with self._lock:
+            entry = self._started.pop(command_id, None)
+        if entry is not None:
+            self.histogram.observe(time.monotonic() - entry[1], entry[0])
+
+    def __len__(self):
+        return len(self._started)
+
+command_timer = CommandTimer(command_latency)
+
+def db_timed(f):
+    method = f.__name__
+
+    @wraps(f)
+    def timed(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return f(*args, **kwargs)
+        finally:
+            db_latency.observe(time.perf_counter() - started, method)
+    return timed
+
+class ConnectionPool:
+    def __init__(self, db_path, pool_size=DB_POOL_SIZE, timeout=DB_POOL_TIMEOUT):
+        self.db_path = db_path
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self._idle = []
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(pool_size)
+        # threading.local is greenlet-local once gevent has patched the process
+        self._local = threading.local()
+        self._stats = {
+            'created': 0,
+            'checkouts': 0,
+            'reused': 0,
+            'waits': 0,
+            'timeouts': 0,
+            'in_use': 0
+        }
+
+    def _connect(self):
+        conn = sqlite3.connect(
+            self.db_path,
+            timeout=self.timeout,
+            check_same_thread=False,
+            cached_statements=DB_CACHED_STATEMENTS
+        )
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.execute(f'PRAGMA cache_size=-{DB_CACHE_SIZE_KB}')
+        conn.execute('PRAGMA temp_store=MEMORY')
+        return conn
+
+    def _checkout(self):
+        if not self._slots.acquire(blocking=False):
+            with self._lock:
+                self._stats['waits'] += 1
+            if not self._slots.acquire(timeout=self.timeout):
+                with self._lock:
+                    self._stats['timeouts'] += 1
+                raise sqlite3.OperationalError('Database connection pool exhausted')
+
+        with self._lock:
+            self._stats['checkouts'] += 1
+            self._stats['in_use'] += 1
+            if self._idle:
+                self._stats['reused'] += 1
+                return self._idle.pop()
+
+        try:
+            conn = self._connect()
+        except Exception:
+            with self._lock:
+                self._stats['in_use'] -= 1
+            self._slots.release()
+            raise
+        with self._lock:
+            self._stats['created'] += 1
+        return conn
+
+    def _checkin(self, conn):
+        broken = False
+        if conn.in_transaction:
+            try:
+                conn.rollback()
+            except sqlite3.Error:
+                broken = True
+        with self._lock:
+            self._stats['in_use'] -= 1
+            if broken:
+                conn.close()
+            else:
+                self._idle.append(conn)
+        self._slots.release()
+
+    @contextmanager
+    def connection(self):
+        # Nested use inside the same thread/greenlet shares one connection
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
+            yield conn
+            return
+
+        conn = self._checkout()
+        self._local.conn = conn
+        try:
+            yield conn
+        finally:
+            self._local.conn = None
+            self._checkin(conn)
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats['idle'] = len(self._idle)
+        stats['pool_size'] = self.pool_size
+        return stats
+
+    def close(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for conn in idle:
+            conn.close()
+
+class AuthCache:
+    # Sentinel stored for API keys known to be invalid
+    MISSING = object()
+
+    def __init__(self, max_size=AUTH_CACHE_SIZE, ttl=AUTH_CACHE_TTL, negative_ttl=AUTH_CACHE_NEGATIVE_TTL):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._stats = {'hits': 0, 'negative_hits': 0, 'misses': 0, 'evictions': 0}
+
+    def get(self, api_key):
+        # Returns the cached user, MISSING for a cached invalid key, or None on a miss
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(api_key)
+            if entry is None or entry[1] <= now:
+                if entry is not None:
+                    del self._entries[api_key]
+                self._stats['misses'] += 1
+                return None
+            self._entries.move_to_end(api_key)
+            if entry[0] is self.MISSING:
+                self._stats['negative_hits'] += 1
+            else:
+                self._stats['hits'] += 1
+            return entry[0]
+
+    def put(self, api_key, user):
+        if user is None:
+            user, ttl = self.MISSING, self.negative_ttl
+        else:
+            ttl = self.ttl
+        with self._lock:
+            self._entries[api_key] = (user, time.monotonic() + ttl)
+            self._entries.move_to_end(api_key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self._stats['evictions'] += 1
+
+    def invalidate(self, api_key):
+        with self._lock:
+            self._entries.pop(api_key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats['size'] = len(self._entries)
+        return stats
+
+class HasherBusy(Exception):
+    pass
+
+class PasswordHasher:
+    # Keeps scrypt/pbkdf2 work off the event loop and sheds load when saturated
+    def __init__(self, mode=PASSWORD_HASH_MODE, workers=PASSWORD_HASH_WORKERS,
+                 max_pending=PASSWORD_HASH_QUEUE, timeout=PASSWORD_HASH_TIMEOUT):
+        if mode not in ('thread', 'inline'):
+            raise ValueError(f"Unknown PASSWORD_HASH_MODE: {mode}")
+        self.mode = mode
+        self.workers = workers
+        self.timeout = timeout
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._executor = None
+        self._hub_pools = weakref.WeakKeyDictionary()
+        self._lock = threading.Lock()
+        self._stats = {'submitted': 0, 'rejected': 0, 'timeouts': 0}
+
+    def _get_executor(self):
+        # Created on first use, after any monkey patching done by socketio.run
+        if socketio.async_mode == 'gevent':
+            from gevent import get_hub
+            from gevent.threadpool import ThreadPool
+            # Native threads the calling thread's hub waits on without blocking other greenlets
+            hub = get_hub()
+            with self._lock:
+                pool = self._hub_pools.get(hub)
+                if pool is None:
+                    pool = self._hub_pools[hub] = ThreadPool(self.workers, hub=hub)
+                return pool
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.workers,
+                                                    thread_name_prefix='password-hash')
+            return self._executor
+
+    def _call(self, fn, *args):
+        executor = self._get_executor()
+        if isinstance(executor, ThreadPoolExecutor):
+            return executor.submit(fn, *args).result(self.timeout)
+        from gevent import Timeout
+        try:
+            return executor.spawn(fn, *args).get(timeout=self.timeout)
+        except Timeout:
+            raise FutureTimeoutError()
+
+    def _run(self, fn, *args):
+        if not self._slots.acquire(blocking=False):
+            with self._lock:
+                self._stats['rejected'] += 1
+            raise HasherBusy('Password hashing queue is full')
+        try:
+            with self._lock:
+                self._stats['submitted'] += 1
+            if self.mode == 'inline':
+                return fn(*args)
+            try:
+                return self._call(fn, *args)
+            except FutureTimeoutError:
+                with self._lock:
+                    self._stats['timeouts'] += 1
+                raise HasherBusy('Password hashing timed out')
+        finally:
+            self._slots.release()
+
+    def hash(self, password):
+        return self._run(generate_password_hash, password)
+
+    def verify(self, pwhash, password):
+        return self._run(check_password_hash, pwhash, password)
+
+    def stats(self):
+        with self._lock:
+            return dict(self._stats)
+
+    def close(self):
+        with self._lock:
+            executor, self._executor = self._executor, None
+            pools = list(self._hub_pools.values())
+            self._hub_pools.clear()
+        if executor is not None:
+            executor.shutdown(wait=False, cancel_futures=True)
+        for pool in pools:
+            pool.kill()
+
+password_hasher = PasswordHasher()
+atexit.register(password_hasher.close)
+
+def metric_aggregates(source):
+    # SQL for (samples, cpu, cpu_max, mem_percent, ...) over rows of a metrics table. Raw samples
+    # are averaged; rollup rows are weighted by how many samples they hold
+    if source == METRICS_TIERS[0][0]:
+        return ['COUNT(*)', 'AVG(cpu)', 'MAX(cpu)'] + [f'AVG({name})' for name in METRIC_FIELDS[2:]]
+
+    def weighted(name):
+        return f'SUM({name} * samples) / SUM(CASE WHEN {name} IS NOT NULL THEN samples END)'
+    return ['SUM(samples)', weighted('cpu'), 'MAX(cpu_max)'] + [weighted(name) for name in METRIC_FIELDS[2:]]
+
+def rollup_statement(table, source):
+    # Row: (client_id, bucket start, bucket end)
+    return f'''INSERT OR REPLACE INTO {table}
+        (client_id, ts, samples, cpu, cpu_max, {', '.join(METRIC_FIELDS[2:])})
+        SELECT client_id, ?2, {', '.join(metric_aggregates(source))} FROM {source}
+        WHERE client_id = ?1 AND ts >= ?2 AND ts < ?3 GROUP BY client_id'''
+
+class Database:
+    def __init__(self, db_path=DB_PATH):
+        self.db_path = db_path
+        self.auth_cache = AuthCache()
         try:
             os.makedirs(os.path.dirname(self.db_path), exist_ok=True)
+            self.pool = ConnectionPool(self.db_path)
             self.init_db()
         except Exception as e:
             logger.error(f"Database initialization error: {e}")
@@ -43,7 +595,7 @@ class Database:
 
     def init_db(self):
         try:
-            with sqlite3.connect(self.db_path) as conn:
+            with self.pool.connection() as conn:
                 c = conn.cursor()
 
                 # Users table
@@ -80,24 +632,98 @@ class Database:
                     completed_at TIMESTAMP,
                     FOREIGN KEY (user_id) REFERENCES users (id))''')
 
+                c.execute('''CREATE INDEX IF NOT EXISTS idx_command_logs_user_executed
+                    ON command_logs (user_id, executed_at)''')
+                c.execute('''CREATE INDEX IF NOT EXISTS idx_command_logs_client_executed
+                    ON command_logs (client_id, executed_at)''')
+
+                # Commands waiting for an offline client, delivered in id order
+                c.execute('''CREATE TABLE IF NOT EXISTS command_outbox
+                    (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    command_id INTEGER UNIQUE NOT NULL,
+                    client_id TEXT NOT NULL,
+                    user_id INTEGER,
+                    command TEXT,
+                    parameters TEXT,
+                    created_at TIMESTAMP,
+                    expires_at REAL NOT NULL,
+                    delivered_at TIMESTAMP,
+                    attempts INTEGER DEFAULT 0,
+                    FOREIGN KEY (user_id) REFERENCES users (id))''')
+                c.execute('''CREATE INDEX IF NOT EXISTS idx_command_outbox_client
+                    ON command_outbox (client_id, id)''')
+                # Connected clients whose outbox hasn't been delivered yet, shared by workers
+                c.execute('''CREATE TABLE IF NOT EXISTS command_outbox_due
+                    (client_id TEXT PRIMARY KEY) WITHOUT ROWID''')
+
+                # Agent load samples, clustered by client and time for range scans
+                c.execute('''CREATE TABLE IF NOT EXISTS client_metrics
+                    (client_id TEXT NOT NULL,
+                    ts INTEGER NOT NULL,
+                    cpu REAL,
+                    mem_percent REAL,
+                    mem_used INTEGER,
+                    disk_percent REAL,
+                    disk_read REAL,
+                    disk_write REAL,
+                    net_sent REAL,
+                    net_recv REAL,
+                    PRIMARY KEY (client_id, ts)) WITHOUT ROWID''')
+
+                # Rollups of client_metrics, rewritten as samples arrive: per-bucket averages,
+                # the sample count and the peak CPU
+                for table, _, _ in METRICS_TIERS[1:]:
+                    c.execute(f'''CREATE TABLE IF NOT EXISTS {table}
+                        (client_id TEXT NOT NULL,
+                        ts INTEGER NOT NULL,
+                        samples INTEGER NOT NULL,
+                        cpu REAL,
+                        cpu_max REAL,
+                        mem_percent REAL,
+                        mem_used REAL,
+                        disk_percent REAL,
+                        disk_read REAL,
+                        disk_write REAL,
+                        net_sent REAL,
+                        net_recv REAL,
+                        PRIMARY KEY (client_id, ts)) WITHOUT ROWID''')
+                # Databases from before the rollups get them built once from the samples they hold
+                for (table, step, _), (source, _, _) in zip(METRICS_TIERS[1:], METRICS_TIERS):
+                    if c.execute(f'SELECT 1 FROM {table} LIMIT 1').fetchone() is None:
+                        c.execute(f'''INSERT OR IGNORE INTO {table}
+                            (client_id, ts, samples, cpu, cpu_max, {', '.join(METRIC_FIELDS[2:])})
+                            SELECT client_id, ts / {step} * {step} AS bucket,
+                            {', '.join(metric_aggregates(source))} FROM {source}
+                            GROUP BY client_id, bucket''')
+
+                # Id blocks handed out to writers that assign ids before inserting
+                c.execute('''CREATE TABLE IF NOT EXISTS id_sequences
+                    (name TEXT PRIMARY KEY,
+                    next_id INTEGER NOT NULL)''')
+
                 conn.commit()
         except Exception as e:
             logger.error(f"Error creating tables: {e}")
             raise
 
+    @db_timed
     def create_user(self, username, password):
         try:
             api_key = str(uuid.uuid4())
-            hashed_password = generate_password_hash(password)
+            hashed_password = password_hasher.hash(password)
 
-            with sqlite3.connect(self.db_path) as conn:
+            with self.pool.connection() as conn:
                 c = conn.cursor()
                 c.execute('''INSERT INTO users
                     (username, password, api_key, created_at)
                     VALUES (?, ?, ?, ?)''',
                     (username, hashed_password, api_key, datetime.datetime.now()))
                 conn.commit()
-                return api_key
+            # Drop any negative entry cached for this key
+            self.auth_cache.invalidate(api_key)
+            return api_key
+        except HasherBusy:
+            raise
         except sqlite3.IntegrityError:
             logger.warning(f"User creation failed: Username {username} already exists")
             return None
@@ -105,38 +731,53 @@ class Database:
             logger.error(f"Error creating user: {e}")
             return None
 
+    @db_timed
     def verify_user(self, username, password):
         try:
-            with sqlite3.connect(self.db_path) as conn:
+            with self.pool.connection() as conn:
                 c = conn.cursor()
                 c.execute('''SELECT id, password, api_key FROM users
                     WHERE username = ?''', (username,))
                 user = c.fetchone()
 
-                if user and check_password_hash(user[1], password):
-                    # Update last login
-                    c.execute('''UPDATE users SET last_login = ?
-                        WHERE id = ?''', (datetime.datetime.now(), user[0]))
-                    conn.commit()
-                    return (user[0], user[2])
+            # Checked without holding a pooled connection
+            if not user or not password_hasher.verify(user[1], password):
                 return None
+
+            with self.pool.connection() as conn:
+                # Update last login
+                conn.execute('''UPDATE users SET last_login = ?
+                    WHERE id = ?''', (datetime.datetime.now(), user[0]))
+                conn.commit()
+            return (user[0], user[2])
+        except HasherBusy:
+            raise
         except Exception as e:
             logger.error(f"Error verifying user: {e}")
             return None
 
+    @db_timed
     def get_user_by_api_key(self, api_key):
+        user = self.auth_cache.get(api_key)
+        if user is not None:
+            return None if user is AuthCache.MISSING else user
+
         try:
-            with sqlite3.connect(self.db_path) as conn:
+            with self.pool.connection() as conn:
                 c = conn.cursor()
                 c.execute('SELECT id, username FROM users WHERE api_key = ?', (api_key,))
-                return c.fetchone()
+                user = c.fetchone()
         except Exception as e:
             logger.error(f"Error getting user by API key: {e}")
             return None
 
+        self.auth_cache.put(api_key, user)
+        return user
+
+    @db_timed
     def register_client(self, client_id, user_id, api_key, system_info=None):
         try:
-            with sqlite3.connect(self.db_path) as conn:
+            with self.pool.connection() as conn:
                 c = conn.cursor()
                 c.execute('''INSERT OR REPLACE INTO clients
                     (client_id, user_id, system_info, last_seen, status, api_key)
@@ -148,9 +789,10 @@ class Database:
             logger.error(f"Error registering client: {e}")
             return False
 
+    @db_timed
     def update_client_status(self, client_id, status, system_info=None):
         try:
-            with sqlite3.connect(self.db_path) as conn:
+            with self.pool.connection() as conn:
                 c = conn.cursor()
                 if system_info:
                     c.execute('''UPDATE clients SET status = ?, last_seen = ?, system_info = ?
@@ -166,9 +808,24 @@ class Database:
             logger.error(f"Error updating client status: {e}")
             return False
 
+    @db_timed
+    def update_client_statuses(self, rows):
+        # rows: (status, last_seen, system_info or None, client_id)
+        try:
+            with self.pool.connection() as conn:
+                conn.executemany('''UPDATE clients SET status = ?, last_seen = ?,
+                    system_info = COALESCE(?, system_info)
+                    WHERE client_id = ?''', rows)
+                conn.commit()
+                return True
+        except Exception as e:
+            logger.error(f"Error updating client statuses: {e}")
+            return False
+
+    @db_timed
     def log_command(self, user_id, client_id, command, parameters=None, status='sent'):
         try:
-            with sqlite3.connect(self.db_path) as conn:
+            with self.pool.connection() as conn:
                 c = conn.cursor()
                 c.execute('''INSERT INTO command_logs
                     (user_id, client_id, command, parameters, status, executed_at)
@@ -180,9 +837,172 @@ class Database:
             logger.error(f"Error logging command: {e}")
             return None
 
+    @db_timed
+    def get_client_owner(self, client_id):
+        try:
+            with self.pool.connection() as conn:
+                c = conn.cursor()
+                c.execute('SELECT user_id FROM clients WHERE client_id = ?', (client_id,))
+                row = c.fetchone()
+                return row[0] if row else None
+        except Exception as e:
+            logger.error(f"Error getting client owner: {e}")
+            return None
+
+    @db_timed
+    def enqueue_outbox(self, command_id, client_id, user_id, command, parameters, ttl, max_depth):
+        # Returns True when queued, False when the client's outbox is full, None on error
+        try:
+            with self.pool.connection() as conn:
+                conn.execute('BEGIN IMMEDIATE')
+                c = conn.cursor()
+                c.execute('''SELECT COUNT(*) FROM command_outbox
+                    WHERE client_id = ? AND expires_at > ?''', (client_id, time.time()))
+                if c.fetchone()[0] >= max_depth:
+                    conn.rollback()
+                    return False
+                c.execute('''INSERT INTO command_outbox
+                    (command_id, client_id, user_id, command, parameters, created_at, expires_at)
+                    VALUES (?, ?, ?, ?, ?, ?, ?)''',
+                    (command_id, client_id, user_id, command, parameters,
+                     datetime.datetime.now(), time.time() + ttl))
+                conn.commit()
+                return True
+        except Exception as e:
+            logger.error(f"Error queueing command for {client_id}: {e}")
+            return None
+
+    @db_timed
+    def take_outbox(self, client_id, max_attempts):
+        # Returns (rows to deliver, expired command ids, command ids out of attempts)
+        try:
+            with self.pool.connection() as conn:
+                conn.execute('BEGIN IMMEDIATE')
+                c = conn.cursor()
+                c.execute('''SELECT command_id FROM command_outbox
+                    WHERE client_id = ? AND expires_at <= ?''', (client_id, time.time()))
+                expired = [row[0] for row in c.fetchall()]
+                c.execute('''SELECT command_id FROM command_outbox
+                    WHERE client_id = ? AND attempts >= ?''', (client_id, max_attempts))
+                exhausted = [row[0] for row in c.fetchall()]
+                c.executemany('DELETE FROM command_outbox WHERE command_id = ?',
+                    [(command_id,) for command_id in expired + exhausted])
+
+                c.execute('''SELECT command_id, command, parameters FROM command_outbox
+                    WHERE client_id = ? ORDER BY id''', (client_id,))
+                rows = c.fetchall()
+                c.execute('''UPDATE command_outbox SET attempts = attempts + 1, delivered_at = ?
+                    WHERE client_id = ?''', (datetime.datetime.now(), client_id))
+                conn.commit()
+                return rows, expired, exhausted
+        except Exception as e:
+            logger.error(f"Error reading outbox for {client_id}: {e}")
+            return [], [], []
+
+    @db_timed
+    def mark_outbox_due(self, client_id):
+        try:
+            with self.pool.connection() as conn:
+                conn.execute('''INSERT OR IGNORE INTO command_outbox_due (client_id)
+                    SELECT ? WHERE EXISTS (SELECT 1 FROM command_outbox WHERE client_id = ?)''',
+                    (client_id, client_id))
+                conn.commit()
+        except Exception as e:
+            logger.error(f"Error marking outbox due for {client_id}: {e}")
+
+    @db_timed
+    def claim_outbox_due(self, client_id):
+        # Called on every event, so the common case is a read; the delete decides the winner
+        try:
+            with self.pool.connection() as conn:
+                if conn.execute('SELECT 1 FROM command_outbox_due WHERE client_id = ?',
+                        (client_id,)).fetchone() is None:
+                    return False
+                claimed = conn.execute('DELETE FROM command_outbox_due WHERE client_id = ?',
+                    (client_id,)).rowcount > 0
+                conn.commit()
+                return claimed
+        except Exception as e:
+            logger.error(f"Error claiming outbox for {client_id}: {e}")
+            return False
+
+    @db_timed
+    def reserve_ids(self, table, count):
+        try:
+            with self.pool.connection() as conn:
+                conn.execute('BEGIN IMMEDIATE')
+                row = conn.execute('SELECT next_id FROM id_sequences WHERE name = ?',
+                    (table,)).fetchone()
+                if row:
+                    start = row[0]
+                else:
+                    start = conn.execute(f'SELECT COALESCE(MAX(id), 0) + 1 FROM {table}').fetchone()[0]
+                conn.execute('INSERT OR REPLACE INTO id_sequences (name, next_id) VALUES (?, ?)',
+                    (table, start + count))
+                conn.commit()
+                return start, start + count
+        except Exception as e:
+            logger.error(f"Error reserving ids for {table}: {e}")
+            return None
+
+    @db_timed
+    def write_command_batch(self, ops):
+        # ops: ordered (kind, row) pairs; consecutive kinds share an executemany, all in one transaction
+        statements = {
+            # With several workers the result can be committed before the insert; a result
+            # recorded for the same client is kept, anything else is overwritten
+            'insert': '''INSERT INTO command_logs
+                (id, user_id, client_id, command, parameters, status, executed_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT (id) DO UPDATE SET user_id = excluded.user_id,
+                command = excluded.command, parameters = excluded.parameters,
+                executed_at = excluded.executed_at,
+                status = CASE WHEN client_id = excluded.client_id THEN status ELSE excluded.status END,
+                response = CASE WHEN client_id = excluded.client_id THEN response END,
+                completed_at = CASE WHEN client_id = excluded.client_id THEN completed_at END,
+                client_id = excluded.client_id''',
+            'update': '''UPDATE command_logs SET status = ?, response = ?, completed_at = ?
+                WHERE id = ?''',
+            # Results only complete commands sent to the reporting client, or create the row
+            # when the worker that sent the command hasn't committed it yet
+            'complete': '''INSERT INTO command_logs
+                (id, client_id, status, response, completed_at) VALUES (?, ?, ?, ?, ?)
+                ON CONFLICT (id) DO UPDATE SET status = excluded.status,
+                response = excluded.response, completed_at = excluded.completed_at
+                WHERE client_id = excluded.client_id''',
+            'ack': 'DELETE FROM command_outbox WHERE command_id = ?',
+            # Progress never overwrites a result that was already recorded
+            'progress': '''UPDATE command_logs SET status = ?
+                WHERE id = ? AND completed_at IS NULL''',
+            # Agents resend unacknowledged samples, so duplicates are ignored
+            'metrics': '''INSERT OR IGNORE INTO client_metrics
+                (client_id, ts, cpu, mem_percent, mem_used, disk_percent,
+                disk_read, disk_write, net_sent, net_recv)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''',
+            # Rollup rows are recomputed from the tier below, so resent samples don't double count
+            'rollup_1m': rollup_statement(METRICS_TIERS[1][0], METRICS_TIERS[0][0]),
+            'rollup_1h': rollup_statement(METRICS_TIERS[2][0], METRICS_TIERS[1][0])
+        }
+        try:
+            with self.pool.connection() as conn:
+                start = 0
+                while start < len(ops):
+                    kind = ops[start][0]
+                    end = start
+                    while end < len(ops) and ops[end][0] == kind:
+                        end += 1
+                    conn.executemany(statements[kind], [op[1] for op in ops[start:end]])
+                    start = end
+                conn.commit()
+                return True
+        except Exception as e:
+            logger.error(f"Error writing command batch: {e}")
+            return False
+
+    @db_timed
     def update_command_status(self, command_id, status, response=None):
         try:
-            with sqlite3.connect(self.db_path) as conn:
+            with self.pool.connection() as conn:
                 c = conn.cursor()
                 c.execute('''UPDATE command_logs SET status = ?, response = ?, completed_at = ?
                     WHERE id = ?''',
@@ -193,231 +1013,2260 @@ class Database:
             logger.error(f"Error updating command status: {e}")
             return False
 
-db = Database()
+    @db_timed
+    def get_command_history(self, user_id, client_id=None, status=None, command=None,
+                            since=None, until=None, after=None, limit=HISTORY_PAGE_SIZE):
+        # Keyset pagination, newest first; after is the (executed_at, id) of the last row seen
+        clauses = ['user_id = ?']
+        params = [user_id]
+        for column, value in (('client_id', client_id), ('status', status), ('command', command)):
+            if value is not None:
+                clauses.append(f'{column} = ?')
+                params.append(value)
+        if since is not None:
+            clauses.append('executed_at >= ?')
+            params.append(since)
+        if until is not None:
+            clauses.append('executed_at < ?')
+            params.append(until)
+        if after is not None:
+            clauses.append('executed_at <= ? AND (executed_at < ? OR id < ?)')
+            params.extend([after[0], after[0], after[1]])
+        params.append(limit)
 
-def create_token(user_id, api_key):
-    payload = {
-        'user_id': user_id,
-        'api_key': api_key,
-        'exp': datetime.datetime.utcnow() + datetime.timedelta(days=1)
-    }
-    return jwt.encode(payload, app.config['SECRET_KEY'], algorithm='HS256')
+        try:
+            with self.pool.connection() as conn:
+                c = conn.cursor()
+                c.execute(f'''SELECT id, client_id, command, parameters, status, response,
+                    executed_at, completed_at FROM command_logs
+                    WHERE {' AND '.join(clauses)}
+                    ORDER BY executed_at DESC, id DESC
+                    LIMIT ?''', params)
+                return c.fetchall()
+        except Exception as e:
+            logger.error(f"Error reading command history: {e}")
+            return None
 
-def require_api_key(f):
-    @wraps(f)
-    def decorated_function(*args, **kwargs):
-        api_key = request.headers.get('X-API-KEY')
-        if not api_key:
-            return jsonify({'status': 'error', 'message': 'API key required'}), 401
+    @db_timed
+    def get_command_results(self, user_id, command_ids):
+        command_ids = list(command_ids)
+        if not command_ids:
+            return []
+        try:
+            with self.pool.connection() as conn:
+                placeholders = ','.join('?' * len(command_ids))
+                c = conn.cursor()
+                c.execute(f'''SELECT id, status, response FROM command_logs
+                    WHERE user_id = ? AND id IN ({placeholders})
+                    AND completed_at IS NOT NULL''', [user_id] + command_ids)
+                return c.fetchall()
+        except Exception as e:
+            logger.error(f"Error reading command results: {e}")
+            return []
 
-        user = db.get_user_by_api_key(api_key)
-        if not user:
-            return jsonify({'status': 'error', 'message': 'Invalid API key'}), 401
+    @db_timed
+    def get_client_metrics(self, client_id, since, until, step, table=METRICS_TIERS[0][0]):
+        # One row per step-sized bucket: averages, plus the peak CPU inside the bucket
+        try:
+            with self.pool.connection() as conn:
+                c = conn.cursor()
+                c.execute(f'''SELECT (ts / ?) * ? AS bucket, {', '.join(metric_aggregates(table))}
+                    FROM {table}
+                    WHERE client_id = ? AND ts >= ? AND ts < ?
+                    GROUP BY bucket ORDER BY bucket''', (step, step, client_id, since, until))
+                return c.fetchall()
+        except Exception as e:
+            logger.error(f"Error reading client metrics: {e}")
+            return None
 
-        return f(*args, **kwargs)
-    return decorated_function
+    @db_timed
+    def prune_metrics(self, cutoffs):
+        # cutoffs: {table: oldest ts to keep}. Deleting per client walks the (client_id, ts)
+        # primary key, and each client gets its own short transaction so writers aren't held up
+        try:
+            with self.pool.connection() as conn:
+                client_ids = [row[0] for row in conn.execute('SELECT client_id FROM clients')]
+            deleted = 0
+            for client_id in client_ids:
+                with self.pool.connection() as conn:
+                    for table, cutoff in cutoffs.items():
+                        deleted += conn.execute(f'DELETE FROM {table} WHERE client_id = ? AND ts < ?',
+                            (client_id, cutoff)).rowcount
+                    conn.commit()
+            return deleted
+        except Exception as e:
+            logger.error(f"Error pruning client metrics: {e}")
+            return None
 
-# Connected clients dictionary with expanded info
-connected_clients = {}
+    def pool_stats(self):
+        return self.pool.stats()
 
-@app.route('/')
-def index():
-    return render_template('index.html')
+    def close(self):
+        self.pool.close()
 
-@app.route('/register', methods=['POST'])
-@limiter.limit("5 per minute")
-def register():
-    data = request.json
-    username = data.get('username')
-    password = data.get('password')
+db = Database()
 
-    if not username or not password:
-        return jsonify({
-            'status': 'error',
-            'message': 'Username and password are required'
-        }), 400
+class PresenceBuffer:
+    def __init__(self, database, interval=PRESENCE_FLUSH_INTERVAL):
+        self.db = database
+        self.interval = interval
+        # client_id -> [status, last_seen, system_info, queued_at]
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self._stats = {
+            'updates': 0,
+            'coalesced': 0,
+            'flushes': 0,
+            'rows_flushed': 0,
+            'last_flush_size': 0,
+            'last_flush_lag': 0.0,
+            'max_flush_lag': 0.0,
+            'errors': 0
+        }
 
-    api_key = db.create_user(username, password)
-    if api_key:
-        return jsonify({
-            'status': 'success',
-            'message': 'User created successfully',
-            'api_key': api_key
-        })
-    return jsonify({
-        'status': 'error',
-        'message': 'Username already exists'
-    }), 400
+    def update(self, client_id, status, system_info=None):
+        now = datetime.datetime.now()
+        with self._lock:
+            self._stats['updates'] += 1
+            entry = self._pending.get(client_id)
+            if entry is None:
+                self._pending[client_id] = [status, now, system_info, time.monotonic()]
+                return
+            self._stats['coalesced'] += 1
+            entry[0] = status
+            entry[1] = now
+            if system_info is not None:
+                entry[2] = system_info
 
-@app.route('/login', methods=['POST'])
-@limiter.limit("5 per minute")
-def login():
-    data = request.json
-    username = data.get('username')
-    password = data.get('password')
+    def discard(self, client_id):
+        with self._lock:
+            self._pending.pop(client_id, None)
 
-    user = db.verify_user(username, password)
-    if user:
-        token = create_token(user[0], user[1])
-        return jsonify({
-            'status': 'success',
-            'message': 'Login successful',
-            'token': token,
-            'api_key': user[1]
-        })
-    return jsonify({
-        'status': 'error',
-        'message': 'Invalid username or password'
-    }), 401
+    def flush(self):
+        with self._flush_lock:
+            with self._lock:
+                pending, self._pending = self._pending, {}
+            if not pending:
+                return 0
 
-@app.route('/clients', methods=['GET'])
-@require_api_key
-def get_clients():
-    api_key = request.headers.get('X-API-KEY')
-    user = db.get_user_by_api_key(api_key)
+            lag = time.monotonic() - min(entry[3] for entry in pending.values())
+            rows = [
+                (entry[0], entry[1], entry[2], client_id)
+                for client_id, entry in pending.items()
+            ]
+            if not self.db.update_client_statuses(rows):
+                # Put the batch back unless newer state arrived meanwhile
+                with self._lock:
+                    self._stats['errors'] += 1
+                    for client_id, entry in pending.items():
+                        newer = self._pending.setdefault(client_id, entry)
+                        if newer is not entry and newer[2] is None:
+                            newer[2] = entry[2]
+                return 0
 
-    if not user:
-        return jsonify({
-            'status': 'error',
-            'message': 'Invalid API key'
-        }), 401
+            with self._lock:
+                self._stats['flushes'] += 1
+                self._stats['rows_flushed'] += len(rows)
+                self._stats['last_flush_size'] = len(rows)
+                self._stats['last_flush_lag'] = lag
+                self._stats['max_flush_lag'] = max(self._stats['max_flush_lag'], lag)
+            return len(rows)
 
-    user_clients = {
-        k: v for k, v in connected_clients.items()
-        if v.get('user_id') == user[0]
-    }
+    def run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.flush()
+            except Exception as e:
+                logger.error(f"Error flushing presence buffer: {e}")
 
-    return jsonify({
-        'status': 'success',
-        'clients': [
-            {
-                'client_id': k,
-                'status': v.get('status', 'unknown'),
-                'last_seen': v.get('last_seen', ''),
-                'system_info': v.get('system_info', {})
-            }
-            for k, v in user_clients.items()
-        ]
-    })
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self.run, name='presence-flush', daemon=True)
+            self._thread.start()
 
-@app.route('/send-command', methods=['POST'])
-@require_api_key
-def send_command():
-    data = request.json
-    client_id = data.get('client_id')
-    command = data.get('command')
-    parameters = data.get('parameters', {})
-    api_key = request.headers.get('X-API-KEY')
-    user = db.get_user_by_api_key(api_key)
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(self.interval)
+        self.flush()
 
-    if not client_id or not command:
-        return jsonify({
-            'status': 'error',
-            'message': 'Client ID and command are required'
-        }), 400
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats['pending'] = len(self._pending)
+        return stats
 
-    if client_id not in connected_clients:
-        return jsonify({
-            'status': 'error',
-            'message': 'Client not found'
-        }), 404
+presence = PresenceBuffer(db)
+presence.start()
+atexit.register(presence.stop)
 
-    if connected_clients[client_id].get('user_id') != user[0]:
-        return jsonify({
-            'status': 'error',
-            'message': 'Access denied for this client'
-        }), 403
+class MetricsPruner:
+    # Drops load history past each tier's retention on its own thread, away from the command log writer
+    def __init__(self, database, interval=METRICS_PRUNE_INTERVAL, tiers=METRICS_TIERS):
+        self.db = database
+        self.interval = interval
+        self.tiers = tiers
+        self._stop = threading.Event()
+        self._thread = None
+        self._stats = {
+            'runs': 0,
+            'deleted': 0,
+            'errors': 0
+        }
 
-    command_id = db.log_command(user[0], client_id, command, str(parameters))
+    def prune(self):
+        now = time.time()
+        deleted = self.db.prune_metrics({table: int(now - retention) for table, _, retention in self.tiers})
+        if deleted is None:
+            self._stats['errors'] += 1
+            return 0
+        self._stats['runs'] += 1
+        self._stats['deleted'] += deleted
+        return deleted
 
-    socketio.emit('execute_command', {
-        'command': command,
-        'parameters': parameters,
-        'command_id': command_id,
-        'timestamp': datetime.datetime.now().isoformat()
-    }, room=client_id)
+    def run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.prune()
+            except Exception as e:
+                logger.error(f"Error pruning client metrics: {e}")
 
-    return jsonify({
-        'status': 'success',
-        'message': 'Command sent successfully',
-        'command_id': command_id
-    })
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self.run, name='metrics-prune', daemon=True)
+            self._thread.start()
 
-@socketio.on('connect')
-def handle_connect():
-    client_id = request.args.get('client_id')
-    api_key = request.args.get('api_key')
+    def stop(self):
+        self._stop.set()
 
-    if not client_id or not api_key:
-        disconnect()
-        return False
+    def stats(self):
+        return dict(self._stats)
 
-    user = db.get_user_by_api_key(api_key)
-    if not user:
-        disconnect()
-        return False
+metrics_pruner = MetricsPruner(db)
+metrics_pruner.start()
+atexit.register(metrics_pruner.stop)
 
-    connected_clients[client_id] = {
-        'sid': request.sid,
-        'user_id': user[0],
-        'status': 'active',
-        'last_seen': datetime.datetime.now().isoformat(),
-        'connected_at': datetime.datetime.now().isoformat()
-    }
+class CommandLogWriter:
+    def __init__(self, database, batch_size=AUDIT_BATCH_SIZE, max_queue=AUDIT_QUEUE_SIZE,
+                 id_block=AUDIT_ID_BLOCK):
+        self.db = database
+        self.batch_size = batch_size
+        self.id_block = id_block
+        self._queue = queue.Queue(max_queue)
+        self._id_lock = threading.Lock()
+        self._next_id = self._end_id = 0
+        self._overflowing = False
+        self._thread = None
+        self._stats_lock = threading.Lock()
+        self._stats = {
+            'queued': 0,
+            'written': 0,
+            'batches': 0,
+            'last_batch_size': 0,
+            'errors': 0,
+            'dropped': 0
+        }
 
-    db.register_client(client_id, user[0], api_key)
-    logger.info(f'Client connected: {client_id}')
-    return True
+    def next_id(self):
+        # Ids come from blocks reserved in the database, so no insert is needed first
+        with self._id_lock:
+            if self._next_id >= self._end_id:
+                block = self.db.reserve_ids('command_logs', self.id_block)
+                if block is None:
+                    return None
+                self._next_id, self._end_id = block
+            command_id = self._next_id
+            self._next_id += 1
+            return command_id
+
+    def _enqueue(self, ops):
+        # A list of ops is never split across transactions. Callers run on the gevent hub, which
+        # a blocking put would stall, so a full queue drops the ops; it only fills up when the
+        # database has fallen far behind
+        try:
+            self._queue.put_nowait(ops)
+        except queue.Full:
+            with self._stats_lock:
+                self._stats['dropped'] += len(ops)
+                overflowing, self._overflowing = self._overflowing, True
+            if not overflowing:
+                logger.error(f"Command log queue full ({self._queue.maxsize}), dropping writes until it drains")
+            return
+        with self._stats_lock:
+            self._stats['queued'] += len(ops)
+            overflowing, self._overflowing = self._overflowing, False
+        if overflowing:
+            logger.warning("Command log queue accepting writes again")
+
+    def log_command(self, user_id, client_id, command, parameters=None, status='sent', command_id=None):
+        if command_id is None:
+            command_id = self.next_id()
+        if command_id is None:
+            return None
+        self._enqueue([('insert', (command_id, user_id, client_id, command, parameters,
+                                   status, datetime.datetime.now()))])
+        return command_id
+
+    def log_commands(self, user_id, client_ids, command, parameters=None, status='sent'):
+        command_ids = {}
+        for client_id in client_ids:
+            command_id = self.next_id()
+            if command_id is None:
+                return None
+            command_ids[client_id] = command_id
+
+        now = datetime.datetime.now()
+        self._enqueue([
+            ('insert', (command_id, user_id, client_id, command, parameters, status, now))
+            for client_id, command_id in command_ids.items()
+        ])
+        return command_ids
+
+    def update_command_status(self, command_id, status, response=None):
+        self._enqueue([('update', (status, response, datetime.datetime.now(), command_id))])
+
+    def mark_command_progress(self, command_id, status):
+        self._enqueue([('progress', (status, command_id))])
+
+    def record_metrics(self, client_id, samples):
+        # samples: (ts, cpu, mem_percent, mem_used, disk_percent, disk_read, disk_write, net_sent, net_recv)
+        ops = [('metrics', (client_id, *sample)) for sample in samples]
+        # Then the minute and hour buckets the samples fall into, in the same transaction
+        for kind, (_, step, _) in (('rollup_1m', METRICS_TIERS[1]), ('rollup_1h', METRICS_TIERS[2])):
+            buckets = sorted({sample[0] // step * step for sample in samples})
+            ops.extend((kind, (client_id, bucket, bucket + step)) for bucket in buckets)
+        self._enqueue(ops)
+
+    def complete_command(self, command_id, client_id, status, response=None):
+        # Records the result and acknowledges any outbox entry in the same transaction
+        self._enqueue([
+            ('complete', (command_id, client_id, status, response, datetime.datetime.now())),
+            ('ack', (command_id,))
+        ])
+
+    def _write_with_retries(self, ops, attempts=AUDIT_WRITE_RETRIES):
+        for attempt in range(attempts):
+            if self.db.write_command_batch(ops):
+                with self._stats_lock:
+                    self._stats['written'] += len(ops)
+                return True
+            with self._stats_lock:
+                self._stats['errors'] += 1
+            if attempt + 1 < attempts:
+                time.sleep(0.1 * (attempt + 1))
+        return False
+
+    def _write(self, batch):
+        if self._write_with_retries(batch):
+            with self._stats_lock:
+                self._stats['batches'] += 1
+                self._stats['last_batch_size'] = len(batch)
+            return
+
+        # One bad op fails the whole transaction; retry each run of same-kind ops on its own,
+        # then row by row, so only the ops that keep failing are dropped
+        dropped = 0
+        start = 0
+        while start < len(batch):
+            end = start
+            while end < len(batch) and batch[end][0] == batch[start][0]:
+                end += 1
+            group = batch[start:end]
+            start = end
+            if self._write_with_retries(group):
+                continue
+            if len(group) == 1:
+                dropped += 1
+                continue
+            for op in group:
+                if not self._write_with_retries([op], attempts=1):
+                    dropped += 1
+
+        if dropped:
+            logger.error(f"Dropping {dropped} of {len(batch)} command log writes after {AUDIT_WRITE_RETRIES} attempts")
+            with self._stats_lock:
+                self._stats['dropped'] += dropped
+
+    def run(self):
+        stopping = False
+        while not stopping:
+            ops = self._queue.get()
+            batch = []
+            taken = 1
+            if ops is None:
+                stopping = True
+            else:
+                batch.extend(ops)
+            # Whatever queued up during the previous commit goes into this one
+            while len(batch) < self.batch_size:
+                try:
+                    ops = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                taken += 1
+                if ops is None:
+                    stopping = True
+                else:
+                    batch.extend(ops)
+            try:
+                if batch:
+                    self._write(batch)
+            finally:
+                for _ in range(taken):
+                    self._queue.task_done()
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self.run, name='command-log-writer', daemon=True)
+            self._thread.start()
+
+    def flush(self):
+        self._queue.join()
+
+    def stop(self):
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join()
+            self._thread = None
+
+    def stats(self):
+        with self._stats_lock:
+            stats = dict(self._stats)
+        stats['depth'] = self._queue.qsize()
+        return stats
+
+audit_log = CommandLogWriter(db)
+audit_log.start()
+atexit.register(audit_log.stop)
+
+def decode_response(response):
+    # Rows written before responses were stored as JSON hold a Python repr, returned as-is
+    if response is None:
+        return None
+    try:
+        return json.loads(response)
+    except ValueError:
+        return response
+
+class CommandResults:
+    def __init__(self, database, make_event=threading.Event, max_results=COMMAND_RESULT_CACHE,
+                 poll_interval=COMMAND_WAIT_POLL):
+        self.db = database
+        # Under gevent a threading.Event would block the hub, so the result could never arrive
+        self.make_event = make_event
+        self.max_results = max_results
+        self.poll_interval = poll_interval
+        # command_id -> (user_id, result), most recent last
+        self._results = OrderedDict()
+        # command_id -> events of requests waiting for it
+        self._waiters = {}
+        self._lock = threading.Lock()
+
+    def resolve(self, command_id, user_id, result):
+        with self._lock:
+            self._results[command_id] = (user_id, result)
+            self._results.move_to_end(command_id)
+            while len(self._results) > self.max_results:
+                self._results.popitem(last=False)
+            for event in self._waiters.get(command_id, ()):
+                event.set()
+
+    def _collect(self, user_id, command_ids, results):
+        for command_id in command_ids:
+            entry = self._results.get(command_id)
+            if entry is not None and entry[0] == user_id:
+                results[command_id] = entry[1]
+
+    def _poll_db(self, user_id, command_ids, results):
+        # Results from before a restart or from another worker only exist in the database
+        for command_id, status, response in self.db.get_command_results(user_id, command_ids):
+            results.setdefault(command_id, {
+                'command_id': command_id,
+                'status': status,
+                'result': decode_response(response)
+            })
+
+    def wait(self, user_id, command_ids, timeout, return_when='all'):
+        # Returns {command_id: result} for whatever finished before the timeout
+        command_ids = set(command_ids)
+        deadline = time.monotonic() + timeout
+        event = self.make_event()
+        results = {}
+
+        def done():
+            return len(results) == len(command_ids) or (return_when == 'any' and results)
+
+        with self._lock:
+            self._collect(user_id, command_ids, results)
+            for command_id in command_ids:
+                self._waiters.setdefault(command_id, set()).add(event)
+        try:
+            next_poll = time.monotonic()
+            while not done():
+                now = time.monotonic()
+                remaining = deadline - now
+                if remaining <= 0:
+                    break
+                if now >= next_poll:
+                    self._poll_db(user_id, command_ids - results.keys(), results)
+                    next_poll = now + self.poll_interval
+                    continue
+                event.wait(min(remaining, next_poll - now))
+                event.clear()
+                with self._lock:
+                    self._collect(user_id, command_ids - results.keys(), results)
+        finally:
+            with self._lock:
+                for command_id in command_ids:
+                    waiters = self._waiters.get(command_id)
+                    if waiters is not None:
+                        waiters.discard(event)
+                        if not waiters:
+                            del self._waiters[command_id]
+        return results
+
+command_results = CommandResults(db, socketio.server.eio.create_event)
+
+class CommandOutbox:
+    def __init__(self, database, audit, max_depth=OUTBOX_MAX_DEPTH, max_attempts=OUTBOX_MAX_ATTEMPTS):
+        self.db = database
+        self.audit = audit
+        self.max_depth = max_depth
+        self.max_attempts = max_attempts
+        # Clients whose outbox is checked on their first event after connecting
+        self._due = set()
+        self._lock = threading.Lock()
+
+    def enqueue(self, user_id, client_id, command, parameters, ttl):
+        # Returns (command_id, None) or (None, (http status, error message))
+        command_id = self.audit.next_id()
+        if command_id is None:
+            return None, (500, 'Could not allocate a command id')
+        queued = self.db.enqueue_outbox(command_id, client_id, user_id, command,
+                                        json.dumps(parameters), ttl, self.max_depth)
+        if queued is None:
+            return None, (500, 'Could not queue command')
+        if not queued:
+            return None, (429, f'Outbox for {client_id} is full')
+        self.audit.log_command(user_id, client_id, command, str(parameters), 'queued',
+                               command_id=command_id)
+        return command_id, None
+
+    def mark_due(self, client_id):
+        with self._lock:
+            self._due.add(client_id)
+
+    def discard(self, client_id):
+        with self._lock:
+            self._due.discard(client_id)
+
+    def _claim(self, client_id):
+        # True for exactly one caller after the client was marked due
+        with self._lock:
+            if client_id not in self._due:
+                return False
+            self._due.discard(client_id)
+            return True
+
+    def deliver_if_due(self, client_id):
+        if not self._claim(client_id):
+            return 0
+
+        rows, expired, exhausted = self.db.take_outbox(client_id, self.max_attempts)
+        for command_id in expired:
+            self.audit.update_command_status(command_id, 'expired')
+        for command_id in exhausted:
+            self.audit.update_command_status(command_id, 'failed', 'Delivery attempts exhausted')
+        # Rows stay in the outbox until command_result acknowledges them
+        for command_id, command, parameters in rows:
+            dispatch_command(client_id, command_id, command, json.loads(parameters))
+        if rows:
+            logger.info(f'Delivered {len(rows)} queued commands to {client_id}')
+        return len(rows)
+
+class SharedCommandOutbox(CommandOutbox):
+    # The due flag lives in the database, so a command sent through any worker first flushes
+    # what was queued for the client, whichever worker holds its socket
+
+    def mark_due(self, client_id):
+        self.db.mark_outbox_due(client_id)
+
+    def discard(self, client_id):
+        # The client may already have reconnected to another worker; a stale flag only costs
+        # one empty outbox read on its next event
+        pass
+
+    def _claim(self, client_id):
+        return self.db.claim_outbox_due(client_id)
+
+outbox = SharedCommandOutbox(db, audit_log) if PRESENCE_BACKEND == 'sqlite' else CommandOutbox(db, audit_log)
+
+class ScreenshotStore:
+    # Assembles chunked screenshot uploads in memory and keeps finished images for a while
+    def __init__(self, max_bytes=SCREENSHOT_MAX_BYTES, max_chunks=SCREENSHOT_MAX_CHUNKS,
+                 store_bytes=SCREENSHOT_STORE_BYTES, ttl=SCREENSHOT_TTL):
+        self.max_bytes = max_bytes
+        self.max_chunks = max_chunks
+        self.store_bytes = store_bytes
+        self.ttl = ttl
+        # transfer_id -> transfer record, oldest first
+        self._transfers = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._stats = {'completed': 0, 'rejected': 0, 'evicted': 0}
+
+    def add_chunk(self, user_id, client_id, chunk):
+        # Returns (record, None) with record['data'] set once complete, or (None, error)
+        transfer_id = chunk.get('transfer_id')
+        seq, total = chunk.get('seq'), chunk.get('total')
+        data = chunk.get('data')
+        if not isinstance(transfer_id, str) or not transfer_id or len(transfer_id) > 64:
+            return None, 'Invalid transfer_id'
+        if not isinstance(data, (bytes, bytearray)):
+            return None, 'Chunk data must be binary'
+        if not isinstance(total, int) or not 0 < total <= self.max_chunks:
+            return None, 'Invalid chunk count'
+        if not isinstance(seq, int) or not 0 <= seq < total:
+            return None, 'Invalid chunk sequence'
+
+        now = time.monotonic()
+        with self._lock:
+            self._expire(now)
+            record = self._transfers.get(transfer_id)
+            if record is None:
+                mime = chunk.get('mime', 'image/jpeg')
+                if mime not in SCREENSHOT_MIME_TYPES:
+                    self._stats['rejected'] += 1
+                    return None, f'Unsupported image type: {mime}'
+                record = {
+                    'transfer_id': transfer_id,
+                    'user_id': user_id,
+                    'client_id': client_id,
+                    'mime': mime,
+                    'width': chunk.get('width'),
+                    'height': chunk.get('height'),
+                    'total': total,
+                    'chunks': {},
+                    'size': 0,
+                    'data': None,
+                    'created': now
+                }
+                self._transfers[transfer_id] = record
+            elif record['client_id'] != client_id or record['total'] != total:
+                self._stats['rejected'] += 1
+                return None, 'Transfer does not belong to this client'
+
+            # Retransmitted chunks are acknowledged without being stored twice
+            if record['data'] is not None or seq in record['chunks']:
+                return record, None
+            if record['size'] + len(data) > self.max_bytes:
+                self._drop(transfer_id)
+                self._stats['rejected'] += 1
+                return None, f'Screenshot exceeds {self.max_bytes} bytes'
+
+            record['chunks'][seq] = bytes(data)
+            record['size'] += len(data)
+            self._bytes += len(data)
+            if len(record['chunks']) == total:
+                record['data'] = b''.join(record['chunks'][i] for i in range(total))
+                record['chunks'] = None
+                record['completed'] = now
+                self._stats['completed'] += 1
+            self._evict()
+        return record, None
+
+    def get(self, transfer_id, user_id):
+        with self._lock:
+            self._expire(time.monotonic())
+            record = self._transfers.get(transfer_id)
+        if record is None or record['user_id'] != user_id:
+            return None
+        return record
+
+    def _drop(self, transfer_id):
+        record = self._transfers.pop(transfer_id)
+        self._bytes -= record['size']
+
+    def _expire(self, now):
+        while self._transfers:
+            transfer_id, record = next(iter(self._transfers.items()))
+            if now - record['created'] < self.ttl:
+                break
+            self._drop(transfer_id)
+            self._stats['evicted'] += 1
+
+    def _evict(self):
+        # Oldest transfers go first when the memory budget is exceeded
+        while self._bytes > self.store_bytes and len(self._transfers) > 1:
+            self._drop(next(iter(self._transfers)))
+            self._stats['evicted'] += 1
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats['transfers'] = len(self._transfers)
+            stats['bytes'] = self._bytes
+        return stats
+
+screenshots = ScreenshotStore()
+
+class ConnectionRegistry:
+    # Fields that change on every heartbeat and don't count as a client change
+    VOLATILE_FIELDS = ('last_seen',)
+
+    def __init__(self, tombstones=REGISTRY_TOMBSTONES):
+        # client_id -> record, sid -> client_id, user_id -> {client_id}
+        self._clients = {}
+        self._sids = {}
+        self._users = {}
+        self._lock = threading.RLock()
+        # Versions start from wall-clock milliseconds so they keep growing across restarts
+        self._version = int(time.time() * 1000)
+        self._start_version = self._version
+        self._client_versions = {}
+        self._user_versions = {}
+        # user_id -> OrderedDict(client_id -> version removed), oldest first
+        self._removed = {}
+        # user_id -> oldest version a delta can still be computed from
+        self._horizons = {}
+        self.tombstones = tombstones
+
+    def _bump(self, user_id, client_id):
+        self._version += 1
+        self._user_versions[user_id] = self._version
+        if client_id in self._clients:
+            self._client_versions[client_id] = self._version
+        return self._version
+
+    def _tombstone(self, user_id, client_id):
+        version = self._bump(user_id, client_id)
+        self._client_versions.pop(client_id, None)
+        removed = self._removed.setdefault(user_id, OrderedDict())
+        removed.pop(client_id, None)
+        removed[client_id] = version
+        while len(removed) > self.tombstones:
+            _, evicted = removed.popitem(last=False)
+            self._horizons[user_id] = evicted
+
+    def add(self, client_id, sid, user_id, **fields):
+        record = dict(fields, sid=sid, user_id=user_id)
+        with self._lock:
+            previous = self._clients.get(client_id)
+            if previous is not None:
+                self._unindex(client_id, previous)
+                if previous['user_id'] != user_id:
+                    del self._clients[client_id]
+                    self._tombstone(previous['user_id'], client_id)
+            self._clients[client_id] = record
+            self._sids[sid] = client_id
+            self._users.setdefault(user_id, set()).add(client_id)
+            self._removed.get(user_id, {}).pop(client_id, None)
+            self._bump(user_id, client_id)
+        return previous
+
+    def _unindex(self, client_id, record):
+        if self._sids.get(record['sid']) == client_id:
+            del self._sids[record['sid']]
+        user_clients = self._users.get(record['user_id'])
+        if user_clients is not None:
+            user_clients.discard(client_id)
+            if not user_clients:
+                del self._users[record['user_id']]
+
+    def remove_sid(self, sid):
+        with self._lock:
+            client_id = self._sids.get(sid)
+            if client_id is None:
+                return None, None
+            record = self._clients.pop(client_id)
+            self._unindex(client_id, record)
+            self._tombstone(record['user_id'], client_id)
+            return client_id, record
+
+    def client_for_sid(self, sid):
+        return self._sids.get(sid)
+
+    def get(self, client_id):
+        with self._lock:
+            record = self._clients.get(client_id)
+            return dict(record) if record is not None else None
+
+    def update(self, client_id, **fields):
+        with self._lock:
+            record = self._clients.get(client_id)
+            if record is None:
+                return False
+            changed = any(
+                record.get(key) != value
+                for key, value in fields.items()
+                if key not in self.VOLATILE_FIELDS
+            )
+            record.update(fields)
+            if not changed:
+                return True
+            self._bump(record['user_id'], client_id)
+            record = dict(record)
+        self._changed(client_id, record)
+        return True
+
+    def _changed(self, client_id, record):
+        # Hook for registries that mirror client state elsewhere
+        pass
+
+    def user_version(self, user_id):
+        with self._lock:
+            return self._user_versions.get(user_id, self._start_version)
+
+    def changes_since(self, user_id, since):
+        # Returns (version, changed, removed), or None when since is too old to diff against
+        with self._lock:
+            version = self._user_versions.get(user_id, self._start_version)
+            if since < self._horizons.get(user_id, self._start_version):
+                return None
+            changed = [
+                (client_id, dict(self._clients[client_id]))
+                for client_id in self._users.get(user_id, ())
+                if self._client_versions.get(client_id, 0) > since
+            ]
+            removed = [
+                client_id
+                for client_id, removed_at in self._removed.get(user_id, {}).items()
+                if removed_at > since
+            ]
+            return version, changed, removed
+
+    def clients_for_user(self, user_id):
+        with self._lock:
+            return [
+                (client_id, dict(self._clients[client_id]))
+                for client_id in self._users.get(user_id, ())
+            ]
+
+    def partition(self, user_id, client_ids):
+        # Split targets into (owned, not_found, forbidden) in one consistent pass
+        owned, not_found, forbidden = [], [], []
+        with self._lock:
+            for client_id in client_ids:
+                record = self._clients.get(client_id)
+                if record is None:
+                    not_found.append(client_id)
+                elif record['user_id'] != user_id:
+                    forbidden.append(client_id)
+                else:
+                    owned.append(client_id)
+        return owned, not_found, forbidden
+
+    def client_ids_for_user(self, user_id):
+        with self._lock:
+            return list(self._users.get(user_id, ()))
+
+    def __contains__(self, client_id):
+        return client_id in self._clients
+
+    def __len__(self):
+        return len(self._clients)
+
+class SqlitePresenceStore:
+    # Presence shared by every worker process that opens the same database file
+
+    def __init__(self, pool, worker_id=WORKER_ID, lease=PRESENCE_LEASE,
+                 tombstone_ttl=PRESENCE_TOMBSTONE_TTL):
+        self.pool = pool
+        self.worker_id = worker_id
+        self.lease = lease
+        self.tombstone_ttl = tombstone_ttl
+        self._stop = threading.Event()
+        self._thread = None
+        self.init_db()
+
+    def init_db(self):
+        with self.pool.connection() as conn:
+            c = conn.cursor()
+            c.execute('''CREATE TABLE IF NOT EXISTS presence
+                (client_id TEXT PRIMARY KEY,
+                user_id INTEGER NOT NULL,
+                worker_id TEXT NOT NULL,
+                sid TEXT NOT NULL,
+                status TEXT,
+                system_info TEXT,
+                connected_at TEXT,
+                version INTEGER NOT NULL)''')
+            c.execute('''CREATE INDEX IF NOT EXISTS idx_presence_user_version
+                ON presence (user_id, version)''')
+            c.execute('''CREATE TABLE IF NOT EXISTS presence_removed
+                (user_id INTEGER NOT NULL,
+                client_id TEXT NOT NULL,
+                version INTEGER NOT NULL,
+                removed_at REAL NOT NULL,
+                PRIMARY KEY (user_id, client_id))''')
+            c.execute('''CREATE TABLE IF NOT EXISTS presence_workers
+                (worker_id TEXT PRIMARY KEY,
+                lease_until REAL NOT NULL)''')
+            conn.commit()
+        self.renew()
+
+    def _next_version(self, conn):
+        # Caller holds a write transaction
+        row = conn.execute("SELECT next_id FROM id_sequences WHERE name = 'presence'").fetchone()
+        version = row[0] if row else int(time.time() * 1000)
+        conn.execute("INSERT OR REPLACE INTO id_sequences (name, next_id) VALUES ('presence', ?)",
+            (version + 1,))
+        return version
+
+    def _remove(self, conn, rows):
+        # rows: (client_id, user_id) pairs currently in presence
+        now = time.time()
+        for client_id, user_id in rows:
+            version = self._next_version(conn)
+            conn.execute('DELETE FROM presence WHERE client_id = ?', (client_id,))
+            conn.execute('''INSERT OR REPLACE INTO presence_removed
+                (user_id, client_id, version, removed_at) VALUES (?, ?, ?, ?)''',
+                (user_id, client_id, version, now))
+
+    def publish(self, client_id, user_id, sid, status=None, system_info=None, connected_at=None):
+        try:
+            with self.pool.connection() as conn:
+                conn.execute('BEGIN IMMEDIATE')
+                previous = conn.execute('SELECT user_id FROM presence WHERE client_id = ?',
+                    (client_id,)).fetchone()
+                if previous and previous[0] != user_id:
+                    self._remove(conn, [(client_id, previous[0])])
+                conn.execute('''INSERT OR REPLACE INTO presence
+                    (client_id, user_id, worker_id, sid, status, system_info, connected_at, version)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?)''',
+                    (client_id, user_id, self.worker_id, sid, status,
+                     json.dumps(system_info, default=str) if system_info is not None else None,
+                     connected_at, self._next_version(conn)))
+                # The previous owner's tombstone stays so its listing drops the client
+                conn.execute('DELETE FROM presence_removed WHERE client_id = ? AND user_id = ?',
+                    (client_id, user_id))
+                conn.commit()
+        except Exception as e:
+            logger.error(f"Error publishing presence for {client_id}: {e}")
+
+    def update(self, client_id, status=None, system_info=None):
+        try:
+            with self.pool.connection() as conn:
+                conn.execute('BEGIN IMMEDIATE')
+                conn.execute('''UPDATE presence SET status = ?, system_info = ?, version = ?
+                    WHERE client_id = ? AND worker_id = ?''',
+                    (status, json.dumps(system_info, default=str) if system_info is not None else None,
+                     self._next_version(conn), client_id, self.worker_id))
+                conn.commit()
+        except Exception as e:
+            logger.error(f"Error updating presence for {client_id}: {e}")
+
+    def withdraw(self, client_id, sid):
+        try:
+            with self.pool.connection() as conn:
+                conn.execute('BEGIN IMMEDIATE')
+                # Only the socket that published the entry may remove it
+                rows = conn.execute('''SELECT client_id, user_id FROM presence
+                    WHERE client_id = ? AND sid = ? AND worker_id = ?''',
+                    (client_id, sid, self.worker_id)).fetchall()
+                self._remove(conn, rows)
+                conn.commit()
+        except Exception as e:
+            logger.error(f"Error withdrawing presence for {client_id}: {e}")
+
+    def renew(self):
+        now = time.time()
+        with self.pool.connection() as conn:
+            conn.execute('BEGIN IMMEDIATE')
+            conn.execute('INSERT OR REPLACE INTO presence_workers (worker_id, lease_until) VALUES (?, ?)',
+                (self.worker_id, now + self.lease))
+            # Reap clients of workers that died without withdrawing them
+            rows = conn.execute('''SELECT client_id, user_id FROM presence
+                WHERE worker_id NOT IN
+                (SELECT worker_id FROM presence_workers WHERE lease_until >= ?)''',
+                (now,)).fetchall()
+            self._remove(conn, rows)
+            conn.execute('DELETE FROM presence_workers WHERE lease_until < ?', (now,))
+
+            expired = conn.execute('SELECT MAX(version) FROM presence_removed WHERE removed_at < ?',
+                (now - self.tombstone_ttl,)).fetchone()[0]
+            if expired is not None:
+                conn.execute('DELETE FROM presence_removed WHERE version <= ?', (expired,))
+                conn.execute('''INSERT OR REPLACE INTO id_sequences (name, next_id)
+                    VALUES ('presence_horizon', MAX(?, COALESCE(
+                    (SELECT next_id FROM id_sequences WHERE name = 'presence_horizon'), 0)))''',
+                    (expired,))
+            conn.commit()
+
+    def run(self):
+        while not self._stop.wait(self.lease / 3):
+            try:
+                self.renew()
+            except Exception as e:
+                logger.error(f"Error renewing presence lease: {e}")
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self.run, name='presence-lease', daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        try:
+            with self.pool.connection() as conn:
+                conn.execute('BEGIN IMMEDIATE')
+                rows = conn.execute('SELECT client_id, user_id FROM presence WHERE worker_id = ?',
+                    (self.worker_id,)).fetchall()
+                self._remove(conn, rows)
+                conn.execute('DELETE FROM presence_workers WHERE worker_id = ?', (self.worker_id,))
+                conn.commit()
+        except Exception as e:
+            logger.error(f"Error releasing presence: {e}")
+
+    def _records(self, where, params):
+        with self.pool.connection() as conn:
+            rows = conn.execute(f'''SELECT p.client_id, p.user_id, p.sid, p.status, p.system_info,
+                p.connected_at, p.worker_id, c.last_seen
+                FROM presence p LEFT JOIN clients c ON c.client_id = p.client_id
+                WHERE {where}''', params).fetchall()
+        return [
+            (row[0], {
+                'user_id': row[1],
+                'sid': row[2],
+                'status': row[3],
+                'system_info': json.loads(row[4]) if row[4] else {},
+                'connected_at': row[5],
+                'worker_id': row[6],
+                'last_seen': datetime.datetime.fromisoformat(row[7]).isoformat() if row[7] else row[5]
+            })
+            for row in rows
+        ]
+
+    def get(self, client_id):
+        records = self._records('p.client_id = ?', (client_id,))
+        return records[0][1] if records else None
+
+    def owners(self, client_ids):
+        client_ids = list(client_ids)
+        if not client_ids:
+            return {}
+        with self.pool.connection() as conn:
+            placeholders = ','.join('?' * len(client_ids))
+            return dict(conn.execute(f'''SELECT client_id, user_id FROM presence
+                WHERE client_id IN ({placeholders})''', client_ids).fetchall())
+
+    def client_ids_for_user(self, user_id):
+        with self.pool.connection() as conn:
+            return [row[0] for row in conn.execute(
+                'SELECT client_id FROM presence WHERE user_id = ?', (user_id,))]
+
+    def clients_for_user(self, user_id):
+        return self._records('p.user_id = ?', (user_id,))
+
+    def user_version(self, user_id):
+        with self.pool.connection() as conn:
+            return conn.execute('''SELECT MAX(
+                COALESCE((SELECT MAX(version) FROM presence WHERE user_id = ?), 0),
+                COALESCE((SELECT MAX(version) FROM presence_removed WHERE user_id = ?), 0),
+                COALESCE((SELECT next_id FROM id_sequences WHERE name = 'presence_horizon'), 0))''',
+                (user_id, user_id)).fetchone()[0]
+
+    def changes_since(self, user_id, since):
+        with self.pool.connection() as conn:
+            horizon = conn.execute("SELECT next_id FROM id_sequences WHERE name = 'presence_horizon'").fetchone()
+            if horizon and since < horizon[0]:
+                return None
+            removed = [row[0] for row in conn.execute('''SELECT client_id FROM presence_removed
+                WHERE user_id = ? AND version > ?''', (user_id, since))]
+        changed = self._records('p.user_id = ? AND p.version > ?', (user_id, since))
+        return self.user_version(user_id), changed, removed
+
+class SharedConnectionRegistry(ConnectionRegistry):
+    # Sockets stay indexed locally; ownership and listings come from the shared store
+
+    def __init__(self, store, **kwargs):
+        super().__init__(**kwargs)
+        self.store = store
+
+    def add(self, client_id, sid, user_id, **fields):
+        previous = super().add(client_id, sid, user_id, **fields)
+        self.store.publish(client_id, user_id, sid, fields.get('status'),
+                           fields.get('system_info'), fields.get('connected_at'))
+        return previous
+
+    def remove_sid(self, sid):
+        client_id, record = super().remove_sid(sid)
+        if client_id is not None:
+            self.store.withdraw(client_id, sid)
+        return client_id, record
+
+    def _changed(self, client_id, record):
+        self.store.update(client_id, record.get('status'), record.get('system_info'))
+
+    def get(self, client_id):
+        record = super().get(client_id)
+        return record if record is not None else self.store.get(client_id)
+
+    def partition(self, user_id, client_ids):
+        owned, not_found, forbidden = super().partition(user_id, client_ids)
+        owners = self.store.owners(not_found)
+        for client_id in not_found:
+            if client_id not in owners:
+                continue
+            (owned if owners[client_id] == user_id else forbidden).append(client_id)
+        not_found = [client_id for client_id in not_found if client_id not in owners]
+        return owned, not_found, forbidden
+
+    def client_ids_for_user(self, user_id):
+        return self.store.client_ids_for_user(user_id)
+
+    def clients_for_user(self, user_id):
+        return self.store.clients_for_user(user_id)
+
+    def user_version(self, user_id):
+        return self.store.user_version(user_id)
+
+    def changes_since(self, user_id, since):
+        return self.store.changes_since(user_id, since)
+
+def parse_jwt_keys(spec):
+    keys = {}
+    for item in spec.split(','):
+        kid, sep, secret = item.strip().partition(':')
+        if not sep or not kid or not secret:
+            if item.strip():
+                raise ValueError(f"Invalid JWT_KEYS entry: {item.strip()!r}")
+            continue
+        keys[kid] = secret
+    return keys
+
+class TokenVerifier:
+    # Verifies JWTs locally; tokens already verified are remembered until they expire
+    def __init__(self, keys, active_kid=None, ttl=JWT_TTL, cache_size=JWT_CACHE_SIZE,
+                 legacy_secret=None):
+        if not keys:
+            raise ValueError('At least one JWT signing key is required')
+        self.keys = dict(keys)
+        self.active_kid = active_kid or next(iter(self.keys))
+        if self.active_kid not in self.keys:
+            raise ValueError(f"JWT_ACTIVE_KID {self.active_kid!r} is not in JWT_KEYS")
+        self.ttl = ttl
+        self.cache_size = cache_size
+        # Secret for tokens issued before key rotation support, which carry no kid
+        self.legacy_secret = legacy_secret
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+        self._stats = {'hits': 0, 'misses': 0, 'rejected': 0}
+
+    def issue(self, user_id, username, api_key):
+        now = datetime.datetime.now(datetime.timezone.utc)
+        payload = {
+            'user_id': user_id,
+            'username': username,
+            'api_key': api_key,
+            'iat': now,
+            'exp': now + datetime.timedelta(seconds=self.ttl)
+        }
+        return jwt.encode(payload, self.keys[self.active_kid], algorithm='HS256',
+                          headers={'kid': self.active_kid})
+
+    def issue_resume(self, client_id, user_id, api_key, ttl=RESUME_TTL):
+        # Lets an agent reconnect as client_id without a database lookup; not valid as a bearer token
+        now = datetime.datetime.now(datetime.timezone.utc)
+        payload = {
+            'typ': 'resume',
+            'client_id': client_id,
+            'user_id': user_id,
+            'api_key': api_key,
+            'iat': now,
+            'exp': now + datetime.timedelta(seconds=ttl)
+        }
+        return jwt.encode(payload, self.keys[self.active_kid], algorithm='HS256',
+                          headers={'kid': self.active_kid})
+
+    def verify_resume(self, token, client_id):
+        claims, _ = self._decode(token, 'resume')
+        if claims is None or claims.get('client_id') != client_id:
+            with self._lock:
+                self._stats['rejected'] += 1
+            return None
+        return claims
+
+    def verify(self, token):
+        # Returns the claims of a valid token or None
+        now = time.time()
+        with self._lock:
+            entry = self._cache.get(token)
+            if entry is not None:
+                claims, kid = entry
+                # A kid dropped from the key set revokes its tokens immediately
+                if claims['exp'] > now and kid in self.keys:
+                    self._cache.move_to_end(token)
+                    self._stats['hits'] += 1
+                    return claims
+                del self._cache[token]
+            self._stats['misses'] += 1
+
+        claims, kid = self._decode(token)
+        if claims is None:
+            with self._lock:
+                self._stats['rejected'] += 1
+            return None
+
+        with self._lock:
+            self._cache[token] = (claims, kid)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return claims
+
+    def _decode(self, token, typ='access'):
+        try:
+            kid = jwt.get_unverified_header(token).get('kid')
+            secret = self.keys.get(kid) if kid else self.legacy_secret
+            if secret is None:
+                return None, None
+            claims = jwt.decode(token, secret, algorithms=['HS256'],
+                                options={'require': ['exp', 'user_id', 'api_key']})
+        except jwt.InvalidTokenError:
+            return None, None
+        if claims.get('typ', 'access') != typ:
+            return None, None
+        return claims, kid
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats['size'] = len(self._cache)
+        return stats
+
+def build_token_verifier():
+    keys = parse_jwt_keys(JWT_KEYS)
+    if keys:
+        # With explicit keys, kid-less tokens are no longer accepted so rotation can revoke them
+        return TokenVerifier(keys, JWT_ACTIVE_KID)
+    secret = app.config['SECRET_KEY']
+    if secret == DEFAULT_SECRET_KEY:
+        # The default key is public, anyone could sign tokens with it
+        logger.warning('Bearer and resume tokens disabled: set JWT_KEYS or SECRET_KEY')
+        return None
+    return TokenVerifier({'default': secret}, JWT_ACTIVE_KID, legacy_secret=secret)
+
+tokens = build_token_verifier()
+
+def create_token(user_id, username, api_key):
+    return tokens.issue(user_id, username, api_key) if tokens is not None else None
+
+def authenticate(token=None, api_key=None):
+    # Bearer tokens are checked without touching the database
+    if token:
+        if tokens is None:
+            return None, None
+        claims = tokens.verify(token)
+        if not claims:
+            return None, None
+        return (claims['user_id'], claims.get('username')), claims['api_key']
+    if api_key:
+        return db.get_user_by_api_key(api_key), api_key
+    return None, None
+
+class ConnectGate:
+    # Token bucket for new agent connections. Refused agents get increasing retry-after
+    # hints so a fleet reconnecting after a restart is spread out instead of retrying in waves
+    def __init__(self, rate=CONNECT_RATE, burst=CONNECT_BURST, retry_max=CONNECT_RETRY_MAX):
+        self.rate = rate
+        self.burst = burst
+        self.retry_max = retry_max
+        self._tokens = burst
+        # Refused connections not yet expected back, drained at the admission rate
+        self._backlog = 0.0
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        # Returns 0 when admitted, otherwise the seconds to wait before retrying
+        if self.rate <= 0:
+            return 0
+        with self._lock:
+            now = time.monotonic()
+            refill = (now - self._updated) * self.rate
+            self._updated = now
+            self._tokens = min(self.burst, self._tokens + refill)
+            self._backlog = max(0.0, self._backlog - refill)
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return 0
+            self._backlog += 1
+            return round(min(self.retry_max, max(1.0, self._backlog / self.rate)), 1)
+
+class ResumableSessions:
+    # Registry entries of recently dropped agents, restored when they come back with a resume token
+    def __init__(self, ttl=RESUME_PARK_TTL, max_size=RESUME_PARK_MAX):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._parked = OrderedDict()
+        self._lock = threading.Lock()
+
+    def park(self, client_id, record):
+        now = time.monotonic()
+        with self._lock:
+            self._parked.pop(client_id, None)
+            self._parked[client_id] = (now + self.ttl, record)
+            # Oldest entries first: drop the expired ones and anything over the size limit
+            while self._parked and (len(self._parked) > self.max_size
+                                    or next(iter(self._parked.values()))[0] < now):
+                self._parked.popitem(last=False)
+
+    def claim(self, client_id, user_id):
+        with self._lock:
+            entry = self._parked.pop(client_id, None)
+        if entry is None or entry[0] < time.monotonic() or entry[1].get('user_id') != user_id:
+            return None
+        return entry[1]
+
+connect_gate = ConnectGate()
+resumable = ResumableSessions()
+# client_id -> (when its current resume token was issued, user_id, api_key)
+resume_issued = {}
+
+def issue_resume_token(client_id, user_id, api_key):
+    if tokens is None:
+        return None
+    resume_issued[client_id] = (time.time(), user_id, api_key)
+    return tokens.issue_resume(client_id, user_id, api_key)
+
+def bearer_token():
+    scheme, _, token = request.headers.get('Authorization', '').partition(' ')
+    return token.strip() if scheme.lower() == 'bearer' else None
+
+def require_api_key(f):
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        token = bearer_token()
+        api_key = request.headers.get('X-API-KEY')
+        if not token and not api_key:
+            return jsonify({'status': 'error', 'message': 'API key or bearer token required'}), 401
+
+        user, api_key = authenticate(token, api_key)
+        if not user:
+            message = 'Invalid or expired token' if token else 'Invalid API key'
+            return jsonify({'status': 'error', 'message': message}), 401
+
+        g.user = user
+        g.api_key = api_key
+        return f(*args, **kwargs)
+    return decorated_function
+
+# Connected clients indexed by client_id, socket sid and owning user
+if PRESENCE_BACKEND == 'sqlite':
+    presence_store = SqlitePresenceStore(db.pool)
+    presence_store.start()
+    atexit.register(presence_store.stop)
+    connected_clients = SharedConnectionRegistry(presence_store)
+elif PRESENCE_BACKEND == 'local':
+    connected_clients = ConnectionRegistry()
+else:
+    raise ValueError(f"Unknown PRESENCE_BACKEND: {PRESENCE_BACKEND}")
+
+metrics.sampled('rc_log_dropped_total', 'Log records dropped because the log queue was full',
+                lambda: log_handler.dropped, 'counter')
+metrics.sampled('rc_connected_clients', 'Agents connected to this worker', lambda: len(connected_clients))
+metrics.sampled('rc_commands_in_flight', 'Dispatched commands awaiting a result', lambda: len(command_timer))
+metrics.sampled('rc_audit_queue_depth', 'Command log writes waiting to be committed',
+                lambda: audit_log.stats()['depth'])
+metrics.sampled('rc_audit_write_errors_total', 'Failed command log batch writes',
+                lambda: audit_log.stats()['errors'], 'counter')
+metrics.sampled('rc_audit_dropped_total', 'Command log writes dropped after retries or on a full queue',
+                lambda: audit_log.stats()['dropped'], 'counter')
+metrics.sampled('rc_presence_pending', 'Client status updates waiting to be flushed',
+                lambda: presence.stats()['pending'])
+metrics.sampled('rc_presence_flush_lag_seconds', 'Age of the oldest update in the last presence flush',
+                lambda: presence.stats()['last_flush_lag'])
+metrics.sampled('rc_presence_flush_errors_total', 'Failed presence flushes',
+                lambda: presence.stats()['errors'], 'counter')
+metrics.sampled('rc_client_metrics_pruned_total', 'Agent load rows removed past retention',
+                lambda: metrics_pruner.stats()['deleted'], 'counter')
+metrics.sampled('rc_db_pool_in_use', 'Database connections checked out', lambda: db.pool_stats()['in_use'])
+metrics.sampled('rc_db_pool_waits_total', 'Checkouts that had to wait for a connection',
+                lambda: db.pool_stats()['waits'], 'counter')
+metrics.sampled('rc_db_pool_timeouts_total', 'Checkouts that timed out',
+                lambda: db.pool_stats()['timeouts'], 'counter')
+metrics.sampled('rc_password_hash_rejected_total', 'Logins/registrations shed because hashing was saturated',
+                lambda: password_hasher.stats()['rejected'] + password_hasher.stats()['timeouts'], 'counter')
+metrics.sampled('rc_token_cache_hits_total', 'Bearer tokens served from the verified-token cache',
+                lambda: tokens.stats()['hits'] if tokens is not None else 0, 'counter')
+metrics.sampled('rc_token_rejected_total', 'Bearer tokens that failed verification',
+                lambda: tokens.stats()['rejected'] if tokens is not None else 0, 'counter')
+metrics.sampled('rc_screenshot_store_bytes', 'Screenshot bytes held in memory',
+                lambda: screenshots.stats()['bytes'])
+metrics.sampled('rc_screenshots_completed_total', 'Screenshot transfers assembled',
+                lambda: screenshots.stats()['completed'], 'counter')
+metrics.sampled('rc_auth_cache_hits_total', 'API key lookups served from cache',
+                lambda: db.auth_cache.stats()['hits'], 'counter')
+metrics.sampled('rc_auth_cache_misses_total', 'API key lookups that went to the database',
+                lambda: db.auth_cache.stats()['misses'], 'counter')
+
+@app.route('/')
+def index():
+    return render_template('index.html')
+
+@app.route('/metrics')
+def get_metrics():
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+def hasher_busy_response():
+    response = jsonify({
+        'status': 'error',
+        'message': 'Server busy, try again shortly'
+    })
+    response.status_code = 503
+    response.headers['Retry-After'] = '1'
+    return response
+
+@app.route('/register', methods=['POST'])
+@limiter.limit("5 per minute")
+def register():
+    data = request.json
+    username = data.get('username')
+    password = data.get('password')
+
+    if not username or not password:
+        return jsonify({
+            'status': 'error',
+            'message': 'Username and password are required'
+        }), 400
+
+    try:
+        api_key = db.create_user(username, password)
+    except HasherBusy:
+        return hasher_busy_response()
+    if api_key:
+        return jsonify({
+            'status': 'success',
+            'message': 'User created successfully',
+            'api_key': api_key
+        })
+    return jsonify({
+        'status': 'error',
+        'message': 'Username already exists'
+    }), 400
+
+@app.route('/login', methods=['POST'])
+@limiter.limit("5 per minute")
+def login():
+    data = request.json
+    username = data.get('username')
+    password = data.get('password')
+
+    try:
+        user = db.verify_user(username, password)
+    except HasherBusy:
+        return hasher_busy_response()
+    if user:
+        token = create_token(user[0], username, user[1])
+        return jsonify({
+            'status': 'success',
+            'message': 'Login successful',
+            'token': token,
+            'api_key': user[1]
+        })
+    return jsonify({
+        'status': 'error',
+        'message': 'Invalid username or password'
+    }), 401
+
+@app.route('/clients', methods=['GET'])
+@require_api_key
+def get_clients():
+    user = g.user
+    version = connected_clients.user_version(user[0])
+    etag = str(version)
+
+    if request.if_none_match.contains(etag):
+        response = app.response_class(status=304)
+        response.set_etag(etag)
+        return response
+
+    since = request.args.get('since', type=int)
+    delta = connected_clients.changes_since(user[0], since) if since is not None else None
+
+    if delta is not None:
+        version, changed, removed = delta
+        response = jsonify({
+            'status': 'success',
+            'delta': True,
+            'version': version,
+            'changed': [serialize_client(k, v) for k, v in changed],
+            'removed': removed
+        })
+    else:
+        # Read the version first so a concurrent change is never skipped by the next delta
+        version = connected_clients.user_version(user[0])
+        user_clients = connected_clients.clients_for_user(user[0])
+        response = jsonify({
+            'status': 'success',
+            'delta': False,
+            'version': version,
+            'clients': [serialize_client(k, v) for k, v in user_clients]
+        })
+
+    response.set_etag(str(version))
+    return response
+
+def serialize_client(client_id, record):
+    return {
+        'client_id': client_id,
+        'status': record.get('status', 'unknown'),
+        'last_seen': record.get('last_seen', ''),
+        'system_info': record.get('system_info', {})
+    }
+
+@app.route('/send-command', methods=['POST'])
+@require_api_key
+def send_command():
+    data = request.json
+    client_id = data.get('client_id')
+    command = data.get('command')
+    parameters = data.get('parameters', {})
+    user = g.user
+
+    if not client_id or not command:
+        return jsonify({
+            'status': 'error',
+            'message': 'Client ID and command are required'
+        }), 400
+
+    client = connected_clients.get(client_id)
+    owner = client.get('user_id') if client is not None else db.get_client_owner(client_id)
+    if owner is None:
+        return jsonify({
+            'status': 'error',
+            'message': 'Client not found'
+        }), 404
+
+    if owner != user[0]:
+        return jsonify({
+            'status': 'error',
+            'message': 'Access denied for this client'
+        }), 403
+
+    if client is None:
+        # Known but offline: hold the command until the client reconnects
+        if not data.get('queue', True):
+            return jsonify({
+                'status': 'error',
+                'message': 'Client not connected'
+            }), 404
+        try:
+            ttl = min(float(data.get('ttl', OUTBOX_DEFAULT_TTL)), OUTBOX_MAX_TTL)
+        except (TypeError, ValueError):
+            return jsonify({
+                'status': 'error',
+                'message': 'ttl must be a number of seconds'
+            }), 400
+
+        command_id, error = outbox.enqueue(user[0], client_id, command, parameters, ttl)
+        if command_id is None:
+            return jsonify({
+                'status': 'error',
+                'message': error[1]
+            }), error[0]
+        return jsonify({
+            'status': 'queued',
+            'message': 'Client offline, command queued for delivery',
+            'command_id': command_id
+        }), 202
+
+    if not client_supports(client, command):
+        return jsonify({
+            'status': 'error',
+            'message': f'Command not supported by this client: {command}'
+        }), 400
+
+    try:
+        wait = float(request.args.get('wait', data.get('wait', 0)))
+    except (TypeError, ValueError):
+        return jsonify({
+            'status': 'error',
+            'message': 'wait must be a number of seconds'
+        }), 400
+
+    command_id = audit_log.log_command(user[0], client_id, command, str(parameters))
+    dispatch_command(client_id, command_id, command, parameters)
+
+    if wait > 0 and command_id is not None:
+        results = command_results.wait(user[0], [command_id], min(wait, COMMAND_WAIT_MAX))
+        if command_id not in results:
+            return jsonify({
+                'status': 'pending',
+                'message': 'Command sent, result not received yet',
+                'command_id': command_id
+            }), 202
+        return jsonify({
+            'status': 'success',
+            'message': 'Command executed',
+            'command_id': command_id,
+            'result': results[command_id]
+        })
+
+    return jsonify({
+        'status': 'success',
+        'message': 'Command sent successfully',
+        'command_id': command_id
+    })
+
+@app.route('/send-command/batch', methods=['POST'])
+@require_api_key
+def send_command_batch():
+    data = request.json
+    client_ids = data.get('client_ids')
+    selector = data.get('selector')
+    command = data.get('command')
+    parameters = data.get('parameters', {})
+    user = g.user
+
+    if not command or (client_ids is None and selector is None):
+        return jsonify({
+            'status': 'error',
+            'message': 'Command and client_ids or selector are required'
+        }), 400
+
+    if selector is not None:
+        if selector != 'all':
+            return jsonify({
+                'status': 'error',
+                'message': f'Unknown selector: {selector}'
+            }), 400
+        client_ids = connected_clients.client_ids_for_user(user[0])
+    elif not isinstance(client_ids, list) or not all(
+            isinstance(client_id, str) and client_id for client_id in client_ids):
+        return jsonify({
+            'status': 'error',
+            'message': 'client_ids must be a list of non-empty strings'
+        }), 400
+
+    client_ids = list(dict.fromkeys(client_ids))
+    if len(client_ids) > BATCH_MAX_TARGETS:
+        return jsonify({
+            'status': 'error',
+            'message': f'At most {BATCH_MAX_TARGETS} clients per batch'
+        }), 400
+
+    owned, not_found, forbidden = connected_clients.partition(user[0], client_ids)
+    results = {client_id: {'status': 'error', 'message': 'Client not found'} for client_id in not_found}
+    results.update({
+        client_id: {'status': 'error', 'message': 'Access denied for this client'}
+        for client_id in forbidden
+    })
+    unsupported = [client_id for client_id in owned
+                   if not client_supports(connected_clients.get(client_id), command)]
+    if unsupported:
+        results.update({
+            client_id: {'status': 'error', 'message': 'Command not supported by this client'}
+            for client_id in unsupported
+        })
+        skipped = set(unsupported)
+        owned = [client_id for client_id in owned if client_id not in skipped]
+
+    command_ids = audit_log.log_commands(user[0], owned, command, str(parameters)) if owned else {}
+    if command_ids is None:
+        return jsonify({
+            'status': 'error',
+            'message': 'Could not allocate command ids'
+        }), 500
+
+    for index, client_id in enumerate(owned):
+        dispatch_command(client_id, command_ids[client_id], command, parameters)
+        results[client_id] = {'status': 'sent', 'command_id': command_ids[client_id]}
+        # Yield to the event loop so large fan-outs don't starve socket traffic
+        if (index + 1) % BATCH_EMIT_CHUNK == 0:
+            socketio.sleep(BATCH_EMIT_PAUSE)
+
+    return jsonify({
+        'status': 'success',
+        'message': f'Command sent to {len(owned)} of {len(client_ids)} clients',
+        'results': results
+    })
+
+def client_supports(record, command):
+    # Agents report the commands they can run in system_info; older agents report nothing
+    system_info = record.get('system_info') if record is not None else None
+    if not isinstance(system_info, dict) or not isinstance(system_info.get('capabilities'), list):
+        return True
+    return command in system_info['capabilities']
+
+def dispatch_command(client_id, command_id, command, parameters):
+    # Commands queued while the client was offline go out first so delivery stays in order
+    outbox.deliver_if_due(client_id)
+    commands_sent_total.inc()
+    command_timer.start(command_id, command)
+    socketio.emit('execute_command', {
+        'command': command,
+        'parameters': parameters,
+        'command_id': command_id,
+        'timestamp': datetime.datetime.now().isoformat()
+    }, room=client_id)
+
+@app.route('/clients/<client_id>/metrics', methods=['GET'])
+@require_api_key
+def get_client_metrics(client_id):
+    user = g.user
+    client = connected_clients.get(client_id)
+    owner = client.get('user_id') if client is not None else db.get_client_owner(client_id)
+    if owner is None:
+        return jsonify({
+            'status': 'error',
+            'message': 'Client not found'
+        }), 404
+    if owner != user[0]:
+        return jsonify({
+            'status': 'error',
+            'message': 'Access denied for this client'
+        }), 403
+
+    now = int(time.time())
+    try:
+        until = int(float(request.args.get('until', now)))
+        since = int(float(request.args.get('since', until - 3600)))
+        step = int(float(request.args.get('step', 0)))
+    except ValueError:
+        return jsonify({
+            'status': 'error',
+            'message': 'since, until and step must be unix timestamps / seconds'
+        }), 400
+    if since >= until:
+        return jsonify({
+            'status': 'error',
+            'message': 'since must be before until'
+        }), 400
+    # Coarser buckets for long ranges keep the response at METRICS_MAX_POINTS or fewer
+    step = max(step, 1, -(-(until - since) // METRICS_MAX_POINTS))
+    # Raw samples serve sub-minute steps, 1-minute rollups sub-hour steps and 1-hour rollups the
+    # rest, skipping tiers whose retention no longer covers since; the step is then rounded up to
+    # whole buckets of the tier
+    table, resolution = METRICS_TIERS[-1][:2]
+    for tier, tier_resolution, retention in METRICS_TIERS:
+        if since >= now - retention and step < tier_resolution * 60:
+            table, resolution = tier, tier_resolution
+            break
+    step = -(-step // resolution) * resolution
+
+    rows = db.get_client_metrics(client_id, since, until, step, table)
+    if rows is None:
+        return jsonify({
+            'status': 'error',
+            'message': 'Could not read metrics'
+        }), 500
+
+    return jsonify({
+        'status': 'success',
+        'client_id': client_id,
+        'since': since,
+        'until': until,
+        'step': step,
+        'fields': ['ts', 'samples', 'cpu', 'cpu_max', 'mem_percent', 'mem_used', 'disk_percent',
+                   'disk_read', 'disk_write', 'net_sent', 'net_recv'],
+        'points': [
+            [row[0], row[1]] + [round(value, 2) if value is not None else None for value in row[2:]]
+            for row in rows
+        ]
+    })
+
+@app.route('/screenshots/<transfer_id>', methods=['GET'])
+@require_api_key
+def get_screenshot(transfer_id):
+    user = g.user
+    record = screenshots.get(transfer_id, user[0])
+    if record is None:
+        return jsonify({
+            'status': 'error',
+            'message': 'Screenshot not found'
+        }), 404
+    if record['data'] is None:
+        return jsonify({
+            'status': 'pending',
+            'received': len(record['chunks']),
+            'total': record['total']
+        }), 202
+
+    # Transfers are immutable, so the id doubles as the validator
+    etag = f'"{transfer_id}"'
+    if request.headers.get('If-None-Match') == etag:
+        return Response(status=304, headers={'ETag': etag})
+    response = Response(record['data'], mimetype=record['mime'])
+    response.headers['ETag'] = etag
+    response.headers['Cache-Control'] = 'private, max-age=3600, immutable'
+    return response
+
+def parse_command_ids(value):
+    return [int(command_id) for command_id in value.split(',') if command_id]
+
+@app.route('/commands/wait', methods=['GET'])
+@require_api_key
+def wait_for_commands():
+    user = g.user
+
+    try:
+        command_ids = parse_command_ids(request.args.get('ids', ''))
+        timeout = min(float(request.args.get('timeout', 30)), COMMAND_WAIT_MAX)
+    except ValueError:
+        return jsonify({
+            'status': 'error',
+            'message': 'ids must be comma separated integers and timeout a number'
+        }), 400
+
+    return_when = request.args.get('mode', 'all')
+    if not command_ids or return_when not in ('all', 'any'):
+        return jsonify({
+            'status': 'error',
+            'message': 'ids are required and mode must be all or any'
+        }), 400
+
+    results = command_results.wait(user[0], command_ids, timeout, return_when)
+    return jsonify({
+        'status': 'success',
+        'results': {str(k): v for k, v in results.items()},
+        'pending': [command_id for command_id in command_ids if command_id not in results]
+    })
+
+@app.route('/commands/stream', methods=['GET'])
+@require_api_key
+def stream_commands():
+    user = g.user
+
+    try:
+        command_ids = set(parse_command_ids(request.args.get('ids', '')))
+        timeout = min(float(request.args.get('timeout', 30)), COMMAND_WAIT_MAX)
+    except ValueError:
+        return jsonify({
+            'status': 'error',
+            'message': 'ids must be comma separated integers and timeout a number'
+        }), 400
+
+    def events():
+        # One server-sent event per finished command, then a final 'done' event
+        deadline = time.monotonic() + timeout
+        pending = set(command_ids)
+        while pending:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            results = command_results.wait(user[0], pending, remaining, 'any')
+            for command_id, result in results.items():
+                pending.discard(command_id)
+                yield f'event: result\ndata: {json.dumps(result, default=str)}\n\n'
+        yield f'event: done\ndata: {json.dumps({"pending": sorted(pending)})}\n\n'
+
+    return Response(events(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache'})
+
+def encode_cursor(executed_at, command_id):
+    raw = json.dumps([executed_at, command_id]).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+def decode_cursor(cursor):
+    raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+    executed_at, command_id = json.loads(raw)
+    if not isinstance(executed_at, str) or not isinstance(command_id, int):
+        raise ValueError('Malformed cursor')
+    return executed_at, command_id
+
+def parse_timestamp(value):
+    # Match the format sqlite3 stores datetime.datetime values in
+    return str(datetime.datetime.fromisoformat(value)) if value else None
+
+@app.route('/commands/history', methods=['GET'])
+@require_api_key
+def get_command_history():
+    user = g.user
+    args = request.args
+
+    try:
+        limit = min(int(args.get('limit', HISTORY_PAGE_SIZE)), HISTORY_MAX_PAGE_SIZE)
+        after = decode_cursor(args['cursor']) if args.get('cursor') else None
+        since = parse_timestamp(args.get('since'))
+        until = parse_timestamp(args.get('until'))
+    except (ValueError, TypeError):
+        return jsonify({
+            'status': 'error',
+            'message': 'Invalid limit, cursor or time range'
+        }), 400
+
+    if limit < 1:
+        return jsonify({
+            'status': 'error',
+            'message': 'Limit must be positive'
+        }), 400
+
+    rows = db.get_command_history(
+        user[0],
+        client_id=args.get('client_id'),
+        status=args.get('status'),
+        command=args.get('command'),
+        since=since,
+        until=until,
+        after=after,
+        limit=limit
+    )
+    if rows is None:
+        return jsonify({
+            'status': 'error',
+            'message': 'Could not read command history'
+        }), 500
+
+    next_cursor = encode_cursor(rows[-1][6], rows[-1][0]) if len(rows) == limit else None
+
+    return jsonify({
+        'status': 'success',
+        'commands': [
+            {
+                'command_id': row[0],
+                'client_id': row[1],
+                'command': row[2],
+                'parameters': row[3],
+                'status': row[4],
+                'response': decode_response(row[5]),
+                'executed_at': row[6],
+                'completed_at': row[7]
+            }
+            for row in rows
+        ],
+        'next_cursor': next_cursor
+    })
+
+def user_room(user_id):
+    return f'user:{user_id}'
+
+# Dashboard socket sid -> user_id
+dashboards = {}
+
+@socketio.on('connect')
+def handle_connect(auth=None):
+    client_id = request.args.get('client_id')
+    token = request.args.get('token')
+    if not token and isinstance(auth, dict):
+        token = auth.get('token')
+    api_key = request.args.get('api_key')
+    resume = auth.get('resume') if isinstance(auth, dict) else None
+
+    if client_id:
+        retry_after = connect_gate.acquire()
+        if retry_after:
+            connects_refused_total.inc()
+            raise ConnectionRefusedError('Server busy', {'retry_after': retry_after})
+
+    # A valid resume token stands in for the credential lookup
+    claims = None
+    if resume and client_id and tokens is not None:
+        claims = tokens.verify_resume(resume, client_id)
+    if claims:
+        user, api_key = (claims['user_id'], None), claims['api_key']
+    else:
+        if not (token or api_key):
+            disconnect()
+            return False
+
+        user, api_key = authenticate(token, api_key)
+        if not user:
+            disconnect()
+            return False
+
+    if not client_id:
+        # Dashboards connect without a client_id and receive their user's relayed streams
+        join_room(user_room(user[0]))
+        dashboards[request.sid] = user[0]
+        logger.info(f'Dashboard connected for user {user[0]}')
+        return True
+
+    # Restoring the parked entry keeps the known system_info, so the agent only sends its hash
+    parked = resumable.claim(client_id, user[0]) if claims else None
+    restored = {}
+    if parked is not None:
+        restored = {key: parked[key] for key in ('system_info', 'info_hash') if key in parked}
+
+    # send_command addresses agents by their client_id room
+    join_room(client_id)
+    connected_clients.add(
+        client_id,
+        request.sid,
+        user[0],
+        status='active',
+        last_seen=datetime.datetime.now().isoformat(),
+        connected_at=datetime.datetime.now().isoformat(),
+        **restored
+    )
+
+    # A buffered 'inactive' from a previous session must not overwrite this one
+    presence.discard(client_id)
+    if claims:
+        # The clients row already exists; a buffered status update is enough
+        presence.update(client_id, 'active')
+        connects_resumed_total.inc()
+    else:
+        db.register_client(client_id, user[0], api_key)
+    # Queued commands go out once the client's first event shows the connection is up
+    outbox.mark_due(client_id)
+    emit('session', {
+        'resumed': bool(claims),
+        'resume_token': issue_resume_token(client_id, user[0], api_key)
+    })
+    connects_total.inc()
+    logger.info(f'Client {"resumed" if claims else "connected"}: {client_id}')
+    return True
 
 @socketio.on('disconnect')
 def handle_disconnect():
-    client_id = None
-    for cid, data in connected_clients.items():
-        if data.get('sid') == request.sid:
-            client_id = cid
-            break
+    if dashboards.pop(request.sid, None) is not None:
+        return
+    client_id, record = connected_clients.remove_sid(request.sid)
 
     if client_id:
-        db.update_client_status(client_id, 'inactive')
-        del connected_clients[client_id]
+        if record is not None:
+            resumable.park(client_id, record)
+        resume_issued.pop(client_id, None)
+        presence.update(client_id, 'inactive')
+        outbox.discard(client_id)
+        disconnects_total.inc()
         logger.info(f'Client disconnected: {client_id}')
 
+def system_info_hash(system_info):
+    # Must match RemoteClient.system_info_hash in client.py
+    raw = json.dumps(system_info, sort_keys=True, separators=(',', ':'), default=str)
+    return hashlib.sha256(raw.encode()).hexdigest()[:16]
+
+def apply_system_info(client_id, data):
+    # Returns the new system_info document when it changed, None otherwise
+    record = connected_clients.get(client_id)
+    if record is None:
+        return None
+    current_hash = record.get('info_hash')
+
+    if 'system_info' in data:
+        system_info = data['system_info']
+    elif 'system_info_delta' in data:
+        delta = data['system_info_delta']
+        if current_hash is None or delta.get('base_hash') != current_hash:
+            emit('system_info_resync', {'info_hash': current_hash})
+            return None
+        system_info = dict(record.get('system_info') or {})
+        system_info.update(delta.get('changed', {}))
+        for key in delta.get('removed', []):
+            system_info.pop(key, None)
+    else:
+        if data.get('info_hash') not in (None, current_hash):
+            emit('system_info_resync', {'info_hash': current_hash})
+        return None
+
+    new_hash = system_info_hash(system_info)
+    if data.get('info_hash') not in (None, new_hash):
+        # Client and server disagree about the document, start over with a full copy
+        emit('system_info_resync', {'info_hash': current_hash})
+        return None
+    if new_hash == current_hash:
+        return None
+
+    connected_clients.update(client_id, system_info=system_info, info_hash=new_hash)
+    return system_info
+
+@socketio.on('system_info')
+def handle_system_info(data):
+    client_id = connected_clients.client_for_sid(request.sid)
+
+    if client_id:
+        system_info = apply_system_info(client_id, data)
+        if system_info is not None:
+            presence.update(client_id, 'active', json.dumps(system_info, default=str))
+        outbox.deliver_if_due(client_id)
+
 @socketio.on('heartbeat')
 def handle_heartbeat(data):
-    client_id = None
-    for cid, cdata in connected_clients.items():
-        if cdata.get('sid') == request.sid:
-            client_id = cid
-            break
+    heartbeats_total.inc()
+    client_id = connected_clients.client_for_sid(request.sid)
 
     if client_id:
-        connected_clients[client_id]['last_seen'] = datetime.datetime.now().isoformat()
-        connected_clients[client_id]['status'] = 'active'
-        if 'system_info' in data:
-            connected_clients[client_id]['system_info'] = data['system_info']
-            db.update_client_status(client_id, 'active', str(data['system_info']))
+        connected_clients.update(
+            client_id,
+            last_seen=datetime.datetime.now().isoformat(),
+            status='active'
+        )
+        system_info = apply_system_info(client_id, data)
+        if system_info is not None:
+            presence.update(client_id, 'active', json.dumps(system_info, default=str))
         else:
-            db.update_client_status(client_id, 'active')
+            presence.update(client_id, 'active')
+        outbox.deliver_if_due(client_id)
+        ack = {}
+        if isinstance(data.get('metrics'), dict):
+            # The ack tells the agent which samples it can drop from its buffer
+            ack.update(store_metrics(client_id, data['metrics']))
+        issued = resume_issued.get(client_id)
+        if issued is not None and time.time() - issued[0] > RESUME_TTL / 2:
+            # Long-lived connections get a fresh token before the current one expires
+            ack['resume_token'] = issue_resume_token(client_id, *issued[1:])
+        return ack or None
+
+def metric_value(value):
+    # Agent-supplied values go straight into SQLite, so only numbers and None are accepted
+    if value is None:
+        return None
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return float(value)
+    raise ValueError(f'Invalid metric value: {value!r}')
+
+def store_metrics(client_id, batch):
+    # The ack means the samples were queued for the command log writer, not committed. Samples
+    # the writer later drops are lost rather than resent; they are load history, not results
+    fields, rows = batch.get('fields'), batch.get('rows')
+    if not isinstance(fields, list) or not isinstance(rows, list) or 'ts' not in fields:
+        return {'metrics_seq': None}
+    # Columns are matched by name so agents with more or fewer fields still work
+    columns = [fields.index(name) if name in fields else None for name in METRIC_FIELDS]
+    seq = batch.get('seq')
+    if len(rows) > METRICS_BATCH_MAX:
+        # Oversized batches are taken from the front; the agent resends the rest
+        if isinstance(seq, int):
+            seq -= len(rows) - METRICS_BATCH_MAX
+        rows = rows[:METRICS_BATCH_MAX]
+    # Older samples would land in minute buckets whose raw rows were already pruned
+    oldest = time.time() - METRICS_RAW_RETENTION + METRICS_TIERS[1][1]
+    samples = []
+    for row in rows:
+        if not isinstance(row, list) or len(row) != len(fields):
+            continue
+        try:
+            # Second resolution matches the primary key, so resent samples are ignored
+            sample = [int(metric_value(row[columns[0]]))]
+            if sample[0] < oldest:
+                continue
+            sample.extend(metric_value(row[i]) if i is not None else None for i in columns[1:])
+        except (TypeError, ValueError, OverflowError):
+            continue
+        samples.append(tuple(sample))
+    if samples:
+        audit_log.record_metrics(client_id, samples)
+        metric_samples_total.inc(amount=len(samples))
+    return {'metrics_seq': seq}
 
 @socketio.on('command_result')
 def handle_command_result(data):
-    client_id = None
-    for cid, cdata in connected_clients.items():
-        if cdata.get('sid') == request.sid:
-            client_id = cid
-            break
+    client_id = connected_clients.client_for_sid(request.sid)
 
-    if client_id and 'command_id' in data:
+    command_id = data.get('command_id')
+    # The id becomes a command_logs key, so anything but an integer is ignored
+    if client_id and isinstance(command_id, int) and not isinstance(command_id, bool):
+        command_timer.finish(command_id)
         status = 'completed' if data.get('success', False) else 'failed'
-        db.update_command_status(
-            data['command_id'],
+        if data.get('state') in ('cancelled', 'timeout'):
+            status = data['state']
+        audit_log.complete_command(
+            command_id,
+            client_id,
             status,
-            str(data.get('result', ''))
+            # Stored as JSON so history and waiters get the structured result back
+            json.dumps(data.get('result', data.get('error')), separators=(',', ':'), default=str)
         )
+        record = connected_clients.get(client_id)
+        if record is not None:
+            command_results.resolve(command_id, record['user_id'], {
+                'command_id': command_id,
+                'status': status,
+                'result': data.get('result'),
+                'error': data.get('error')
+            })
+
+@socketio.on('screenshot_chunk')
+def handle_screenshot_chunk(data):
+    # The return value is the ack the agent waits on before sending more chunks
+    client_id = connected_clients.client_for_sid(request.sid)
+    record = connected_clients.get(client_id) if client_id else None
+    if record is None or not isinstance(data, dict):
+        return {'ok': False, 'error': 'Unknown client'}
+
+    transfer, error = screenshots.add_chunk(record['user_id'], client_id, data)
+    if error:
+        logger.warning(f'Rejected screenshot chunk from {client_id}: {error}')
+        return {'ok': False, 'error': error}
+    if transfer['data'] is not None:
+        return {'ok': True, 'complete': True, 'size': transfer['size']}
+    return {'ok': True, 'complete': False}
+
+@socketio.on('command_status')
+def handle_command_status(data):
+    client_id = connected_clients.client_for_sid(request.sid)
+    record = connected_clients.get(client_id) if client_id else None
+    if record is None or not isinstance(data, dict) or 'command_id' not in data:
+        return
+
+    state = data.get('state')
+    # Only 'running' is persisted; 'queued' on the agent would double the writes per command
+    if state == 'running':
+        audit_log.mark_command_progress(data['command_id'], 'running')
+    socketio.emit('command_status', {
+        'client_id': client_id,
+        'command_id': data['command_id'],
+        'command': data.get('command'),
+        'state': state,
+        'timestamp': data.get('timestamp')
+    }, room=user_room(record['user_id']))
+
+@socketio.on('command_output')
+def handle_command_output(data):
+    # The ack releases the agent's output window, so a stalled relay slows the process down
+    client_id = connected_clients.client_for_sid(request.sid)
+    record = connected_clients.get(client_id) if client_id else None
+    if record is None or not isinstance(data, dict) or 'command_id' not in data:
+        return {'ok': False}
+
+    socketio.emit('command_output', {
+        'client_id': client_id,
+        'command_id': data['command_id'],
+        'seq': data.get('seq'),
+        'stdout': data.get('stdout'),
+        'stderr': data.get('stderr')
+    }, room=user_room(record['user_id']))
+    command_output_total.inc()
+    return {'ok': True}
+
+@socketio.on('screen_frame')
+def handle_screen_frame(data):
+    # Acked once relayed so the agent's watcher can pace itself against the server
+    client_id = connected_clients.client_for_sid(request.sid)
+    record = connected_clients.get(client_id) if client_id else None
+    if record is None or not isinstance(data, dict):
+        return {'ok': False, 'stop': True}
+
+    tiles = data.get('tiles')
+    if not isinstance(tiles, list):
+        return {'ok': False, 'error': 'Invalid frame'}
+    size = sum(len(tile.get('data') or b'') for tile in tiles if isinstance(tile, dict))
+    if size > WATCH_MAX_FRAME_BYTES:
+        return {'ok': False, 'error': f'Frame exceeds {WATCH_MAX_FRAME_BYTES} bytes'}
+
+    socketio.emit('screen_frame', {**data, 'client_id': client_id}, room=user_room(record['user_id']))
+    screen_frames_total.inc()
+    screen_frame_bytes_total.inc(amount=size)
+    return {'ok': True}
+
+@socketio.on('screen_watch_end')
+def handle_screen_watch_end(data):
+    client_id = connected_clients.client_for_sid(request.sid)
+    record = connected_clients.get(client_id) if client_id else None
+    if record is not None and isinstance(data, dict):
+        socketio.emit('screen_watch_end', {**data, 'client_id': client_id},
+                      room=user_room(record['user_id']))
+
+@socketio.on('screen_keyframe_request')
+def handle_screen_keyframe_request(data):
+    # A dashboard that starts watching mid-stream needs a full frame to draw onto
+    user_id = dashboards.get(request.sid)
+    client_id = data.get('client_id') if isinstance(data, dict) else None
+    record = connected_clients.get(client_id) if user_id is not None and client_id else None
+    if record is None or record['user_id'] != user_id:
+        return {'ok': False, 'error': 'Client not found'}
+    socketio.emit('screen_keyframe_request', {'watch_id': data.get('watch_id')}, room=client_id)
+    return {'ok': True}
 
 @app.errorhandler(Exception)
 def handle_error(error):
     message = str(error)
+    errors_total.inc('http')
     logger.error(f"An error occurred: {message}")
     return jsonify({'status': 'error', 'message': message}), 500
 
@@ -0,0 +1,372 @@
+# bench.py
+# Fleet load generator for app.py: simulated agents speak the same Socket.IO
+# protocol as client.RemoteClient while commands are driven over HTTP.
+#
+# Requires: pip install "python-socketio[asyncio_client]" aiohttp psutil
+#
+# Example:
+#   python bench.py --url http://127.0.0.1:5000 --username bench --password bench \
+#       --clients 2000 --connect-rate 200 --command-rate 100 --duration 60 --server-pid 1234
+#
+# Start the server with CONNECT_RATE=0 when measuring connect throughput, otherwise
+# its admission gate refuses agents above the configured rate.
+import argparse
+import asyncio
+import hashlib
+import json
+import random
+import re
+import statistics
+import time
+import uuid
+from datetime import datetime
+
+import aiohttp
+import socketio
+
+# Database methods that write, as labelled in rc_db_operation_seconds
+DB_WRITE_METHODS = (
+    'create_user', 'register_client', 'update_client_status', 'update_client_statuses',
+    'log_command', 'enqueue_outbox', 'take_outbox', 'reserve_ids', 'write_command_batch',
+    'update_command_status'
+)
+
+def system_info_hash(system_info):
+    # Same hashing as client.RemoteClient.system_info_hash
+    raw = json.dumps(system_info, sort_keys=True, separators=(',', ':'), default=str)
+    return hashlib.sha256(raw.encode()).hexdigest()[:16]
+
+def percentile(values, pct):
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, int(round(pct / 100 * len(ordered))) - 1))
+    return ordered[index]
+
+class SimulatedAgent:
+    def __init__(self, url, api_key, heartbeat_interval, stats):
+        self.url = url
+        self.api_key = api_key
+        self.heartbeat_interval = heartbeat_interval
+        self.stats = stats
+        self.client_id = f'bench-{uuid.uuid4()}'
+        self.system_info = {
+            'platform': 'bench',
+            'processor': 'simulated',
+            'hostname': self.client_id,
+            'python_version': '3'
+        }
+        self.info_hash = system_info_hash(self.system_info)
+        self.sio = socketio.AsyncClient(reconnection=False)
+        self._heartbeat_task = None
+        self.setup_handlers()
+
+    def setup_handlers(self):
+        @self.sio.event
+        async def connect():
+            await self.sio.emit('system_info', {
+                'client_id': self.client_id,
+                'v': 2,
+                'info_hash': self.info_hash,
+                'system_info': self.system_info,
+                'timestamp': datetime.now().isoformat()
+            })
+
+        @self.sio.on('system_info_resync')
+        async def on_system_info_resync(data):
+            await self.sio.emit('heartbeat', {
+                'v': 2,
+                'info_hash': self.info_hash,
+                'system_info': self.system_info,
+                'timestamp': datetime.now().isoformat()
+            })
+
+        @self.sio.on('execute_command')
+        async def on_execute_command(data):
+            received = time.time()
+            sent = data.get('parameters', {}).get('bench_sent_at')
+            if sent:
+                self.stats['dispatch_latencies'].append(received - sent)
+            self.stats['commands_received'] += 1
+            await self.sio.emit('command_result', {
+                'command': data.get('command'),
+                'command_id': data.get('command_id'),
+                'success': True,
+                'result': {'status': 'simulated'},
+                'timestamp': data.get('timestamp')
+            })
+            if sent:
+                # Send to result on the agent side, independent of how /send-command waits
+                self.stats['result_latencies'].append(time.time() - sent)
+
+    async def heartbeat(self):
+        # Spread heartbeats so the fleet doesn't beat in lockstep
+        await asyncio.sleep(random.uniform(0, self.heartbeat_interval))
+        while self.sio.connected:
+            await self.sio.emit('heartbeat', {
+                'v': 2,
+                'info_hash': self.info_hash,
+                'timestamp': datetime.now().isoformat()
+            })
+            self.stats['heartbeats'] += 1
+            await asyncio.sleep(self.heartbeat_interval)
+
+    async def start(self):
+        started = time.perf_counter()
+        try:
+            await self.sio.connect(
+                f'{self.url}?client_id={self.client_id}&api_key={self.api_key}',
+                headers={'X-API-KEY': self.api_key},
+                transports=['websocket']
+            )
+        except Exception as e:
+            self.stats['connect_errors'] += 1
+            self.stats['last_error'] = str(e)
+            return False
+        self.stats['connect_latencies'].append(time.perf_counter() - started)
+        self._heartbeat_task = asyncio.create_task(self.heartbeat())
+        return True
+
+    async def stop(self):
+        if self._heartbeat_task is not None:
+            self._heartbeat_task.cancel()
+        if self.sio.connected:
+            await self.sio.disconnect()
+
+async def authenticate(session, args):
+    if args.api_key:
+        return args.api_key
+    payload = {'username': args.username, 'password': args.password}
+    async with session.post(f'{args.url}/register', json=payload) as response:
+        await response.read()
+    async with session.post(f'{args.url}/login', json=payload) as response:
+        data = await response.json()
+        if data.get('status') != 'success':
+            raise SystemExit(f"Login failed: {data.get('message')}")
+        return data['api_key']
+
+async def scrape_metrics(session, url):
+    try:
+        async with session.get(f'{url}/metrics') as response:
+            text = await response.text()
+    except Exception:
+        return {}
+    values = {}
+    for line in text.splitlines():
+        match = re.match(r'^(\w+)(\{[^}]*\})? (\S+)$', line)
+        if match:
+            values[match.group(1) + (match.group(2) or '')] = float(match.group(3))
+    return values
+
+def db_write_count(scraped):
+    return sum(
+        scraped.get(f'rc_db_operation_seconds_count{{method="{method}"}}', 0)
+        for method in DB_WRITE_METHODS
+    )
+
+async def sample_server(pid, samples, stop):
+    import psutil
+    process = psutil.Process(pid)
+    process.cpu_percent(None)
+    while not stop.is_set():
+        await asyncio.sleep(1)
+        try:
+            samples.append((process.cpu_percent(None), process.memory_info().rss))
+        except psutil.Error:
+            return
+
+async def connect_fleet(args, api_key, stats):
+    agents = [SimulatedAgent(args.url, api_key, args.heartbeat_interval, stats)
+              for _ in range(args.clients)]
+    semaphore = asyncio.Semaphore(args.connect_concurrency)
+
+    async def connect(agent):
+        async with semaphore:
+            return await agent.start()
+
+    started = time.perf_counter()
+    tasks = []
+    for index, agent in enumerate(agents):
+        tasks.append(asyncio.create_task(connect(agent)))
+        if args.connect_rate:
+            # Pace connects at the requested rate
+            delay = started + (index + 1) / args.connect_rate - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+    results = await asyncio.gather(*tasks)
+    elapsed = time.perf_counter() - started
+    connected = [agent for agent, ok in zip(agents, results) if ok]
+    return agents, connected, elapsed
+
+async def drive_commands(session, args, api_key, connected, stats):
+    headers = {'X-API-KEY': api_key}
+    semaphore = asyncio.Semaphore(args.command_concurrency)
+    deadline = time.perf_counter() + args.duration
+    pending = set()
+
+    async def send(agent):
+        async with semaphore:
+            body = {
+                'client_id': agent.client_id,
+                'command': args.command,
+                'parameters': {'bench_sent_at': time.time()},
+                'wait': args.wait
+            }
+            started = time.perf_counter()
+            try:
+                async with session.post(f'{args.url}/send-command', json=body,
+                                        headers=headers) as response:
+                    await response.read()
+                    status = response.status
+            except Exception as e:
+                stats['command_errors'] += 1
+                stats['last_error'] = str(e)
+                return
+            if status == 200:
+                # Without wait the 200 only means the command was dispatched
+                if args.wait > 0:
+                    stats['round_trips'].append(time.perf_counter() - started)
+            elif status == 202:
+                stats['command_timeouts'] += 1
+            else:
+                stats['command_errors'] += 1
+
+    started = time.perf_counter()
+    sent = 0
+    while time.perf_counter() < deadline and connected:
+        task = asyncio.create_task(send(random.choice(connected)))
+        pending.add(task)
+        task.add_done_callback(pending.discard)
+        sent += 1
+        if args.command_rate:
+            delay = started + sent / args.command_rate - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+        elif len(pending) >= args.command_concurrency:
+            # Unthrottled: keep command_concurrency requests in flight
+            await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+    if pending:
+        await asyncio.gather(*pending)
+    return sent
+
+def format_ms(value):
+    return f'{value * 1000:.1f} ms' if value is not None else 'n/a'
+
+async def run(args):
+    stats = {
+        'connect_latencies': [],
+        'connect_errors': 0,
+        'dispatch_latencies': [],
+        'result_latencies': [],
+        'round_trips': [],
+        'commands_received': 0,
+        'command_errors': 0,
+        'command_timeouts': 0,
+        'heartbeats': 0,
+        'last_error': None
+    }
+    server_samples = []
+    stop_sampling = asyncio.Event()
+
+    async with aiohttp.ClientSession() as session:
+        api_key = await authenticate(session, args)
+        sampler = None
+        if args.server_pid:
+            sampler = asyncio.create_task(sample_server(args.server_pid, server_samples, stop_sampling))
+
+        agents, connected, connect_elapsed = await connect_fleet(args, api_key, stats)
+        before = await scrape_metrics(session, args.url)
+        drive_started = time.perf_counter()
+        sent = await drive_commands(session, args, api_key, connected, stats)
+        drive_elapsed = time.perf_counter() - drive_started
+        after = await scrape_metrics(session, args.url)
+
+        stop_sampling.set()
+        if sampler is not None:
+            await sampler
+        await asyncio.gather(*(agent.stop() for agent in agents), return_exceptions=True)
+
+    report = {
+        'clients_requested': args.clients,
+        'clients_connected': len(connected),
+        'connect_errors': stats['connect_errors'],
+        'connect_seconds': connect_elapsed,
+        'connects_per_second': len(connected) / connect_elapsed if connect_elapsed else None,
+        'connect_p50': percentile(stats['connect_latencies'], 50),
+        'connect_p99': percentile(stats['connect_latencies'], 99),
+        'commands_sent': sent,
+        'commands_per_second': sent / drive_elapsed if drive_elapsed else None,
+        'commands_received': stats['commands_received'],
+        'command_errors': stats['command_errors'],
+        'command_timeouts': stats['command_timeouts'],
+        'round_trip_p50': percentile(stats['round_trips'], 50),
+        'round_trip_p99': percentile(stats['round_trips'], 99),
+        'round_trip_mean': statistics.mean(stats['round_trips']) if stats['round_trips'] else None,
+        'dispatch_p50': percentile(stats['dispatch_latencies'], 50),
+        'dispatch_p99': percentile(stats['dispatch_latencies'], 99),
+        'result_p50': percentile(stats['result_latencies'], 50),
+        'result_p99': percentile(stats['result_latencies'], 99),
+        'heartbeats_sent': stats['heartbeats'],
+        'db_writes_per_second': (db_write_count(after) - db_write_count(before)) / drive_elapsed
+        if before and after and drive_elapsed else None,
+        'server_cpu_percent_avg': statistics.mean(s[0] for s in server_samples) if server_samples else None,
+        'server_cpu_percent_max': max(s[0] for s in server_samples) if server_samples else None,
+        'server_rss_max_mb': max(s[1] for s in server_samples) / 2 ** 20 if server_samples else None,
+        'last_error': stats['last_error']
+    }
+    return report
+
+def print_report(report):
+    print(f"Clients connected:   {report['clients_connected']}/{report['clients_requested']} "
+          f"({report['connect_errors']} errors)")
+    if report['connects_per_second'] is not None:
+        print(f"Connect throughput:  {report['connects_per_second']:.1f}/s "
+              f"(p50 {format_ms(report['connect_p50'])}, p99 {format_ms(report['connect_p99'])})")
+    if report['commands_per_second'] is not None:
+        print(f"Commands:            {report['commands_sent']} sent at {report['commands_per_second']:.1f}/s, "
+              f"{report['commands_received']} received, {report['command_errors']} errors, "
+              f"{report['command_timeouts']} timeouts")
+    print(f"Round trip:          p50 {format_ms(report['round_trip_p50'])}, "
+          f"p99 {format_ms(report['round_trip_p99'])}")
+    print(f"Dispatch latency:    p50 {format_ms(report['dispatch_p50'])}, "
+          f"p99 {format_ms(report['dispatch_p99'])}")
+    print(f"Result latency:      p50 {format_ms(report['result_p50'])}, "
+          f"p99 {format_ms(report['result_p99'])}")
+    if report['db_writes_per_second'] is not None:
+        print(f"DB write txns:       {report['db_writes_per_second']:.1f}/s")
+    if report['server_cpu_percent_avg'] is not None:
+        print(f"Server CPU:          avg {report['server_cpu_percent_avg']:.1f}%, "
+              f"max {report['server_cpu_percent_max']:.1f}%")
+        print(f"Server RSS:          max {report['server_rss_max_mb']:.1f} MB")
+    if report['last_error']:
+        print(f"Last error:          {report['last_error']}")
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Load-test app.py with simulated agents')
+    parser.add_argument('--url', default='http://127.0.0.1:5000')
+    parser.add_argument('--api-key')
+    parser.add_argument('--username', default='bench')
+    parser.add_argument('--password', default='bench')
+    parser.add_argument('--clients', type=int, default=100)
+    parser.add_argument('--connect-rate', type=float, default=100,
+                        help='new connections per second, 0 for as fast as possible')
+    parser.add_argument('--connect-concurrency', type=int, default=200)
+    parser.add_argument('--heartbeat-interval', type=float, default=30)
+    parser.add_argument('--command', default='sysinfo')
+    parser.add_argument('--command-rate', type=float, default=50,
+                        help='commands per second, 0 for as fast as --command-concurrency allows')
+    parser.add_argument('--command-concurrency', type=int, default=100)
+    parser.add_argument('--wait', type=float, default=10,
+                        help='seconds /send-command waits for the result, 0 to skip HTTP round trips')
+    parser.add_argument('--duration', type=float, default=30, help='seconds to drive commands')
+    parser.add_argument('--server-pid', type=int, help='sample CPU and RSS of this process')
+    parser.add_argument('--json', action='store_true', help='print the report as JSON')
+    return parser.parse_args()
+
+if __name__ == '__main__':
+    args = parse_args()
+    report = asyncio.run(run(args))
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print_report(report)
@@ -2,30 +2,194 @@
 import socketio
 import os
 import time
-import pyautogui
 import platform
 import logging
 import json
 import uuid
 import sqlite3
+import hashlib
+import importlib
+import importlib.util
+import io
+import codecs
+import queue
+import random
+import shlex
+import signal
+import subprocess
+import sys
+import threading
+from array import array
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 from datetime import datetime
 
-# Logging konfigürasyonu
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.FileHandler('client.log'),
-        logging.StreamHandler()
-    ]
-)
+from logsetup import setup_logging
+
 logger = logging.getLogger(__name__)
 
 # Konfigürasyon
 SERVER_URL = "https://your-domain.com"  # Production URL'inizi buraya yazın
-RECONNECT_DELAY = 5
-MAX_RECONNECT_ATTEMPTS = 5
+# Yeniden bağlanma: üstel geri çekilmenin başlangıç ve en uzun bekleme süresi (saniye), deneme sınırı yok
+RECONNECT_BASE_DELAY = 1
+RECONNECT_MAX_DELAY = 60
 DB_PATH = "client_config.db"
+# Ekran görüntüsü aktarımı: parça boyutu ve onay beklemeden gönderilebilecek parça sayısı
+SCREENSHOT_CHUNK_SIZE = 64 * 1024
+SCREENSHOT_WINDOW = 4
+SCREENSHOT_ACK_TIMEOUT = 30
+SCREENSHOT_FORMATS = {"jpeg": "image/jpeg", "webp": "image/webp", "png": "image/png"}
+# Canlı ekran izleme: kare aralığı sınırları, anahtar kare sıklığı ve onaysız paket sınırı
+WATCH_MAX_INTERVAL = 2.0
+WATCH_KEYFRAME_INTERVAL = 10
+WATCH_MAX_UNACKED = 2
+WATCH_MAX_PACKET_BYTES = 256 * 1024
+# Komut yürütücü: paralel iş parçacığı sayısı ve varsayılan zaman aşımları (saniye)
+COMMAND_WORKERS = 4
+COMMAND_TIMEOUT = 120
+# exec: varsayılan ve en uzun çalışma süresi, toplam çıktı sınırı, parça boyutu/aralığı
+# ve onay beklemeden gönderilebilecek çıktı parçası sayısı
+EXEC_TIMEOUT = 300
+EXEC_MAX_TIMEOUT = 3600
+EXEC_MAX_OUTPUT = 10 * 1024 * 1024
+EXEC_CHUNK_BYTES = 16 * 1024
+EXEC_FLUSH_INTERVAL = 0.2
+EXEC_WINDOW = 4
+# Ek komut eklentileri: "komut=modül:fonksiyon" virgülle ayrılmış; modül ilk kullanımda yüklenir
+# ve fonksiyon (client, **parametreler) ile çağrılır
+COMMAND_PLUGINS = os.environ.get("COMMAND_PLUGINS", "")
+# Loglama: dosya, seviyeler (logger başına), format ("text" veya "json") ve döndürme ayarları
+LOG_FILE = "client.log"
+LOG_LEVEL = "INFO"
+LOG_LEVELS = {"engineio.client": "WARNING", "socketio.client": "INFO"}
+LOG_FORMAT = "text"
+LOG_MAX_BYTES = 10 * 1024 * 1024
+LOG_BACKUPS = 5
+# Paket logları: saniyede kayıt, ani artış payı ve fazlanın 1/N örneklemesi
+LOG_PACKET_RATE = 5
+LOG_PACKET_BURST = 20
+LOG_PACKET_SAMPLE = 50
+PACKET_LOGGERS = ("engineio.client", "socketio.client")
+
+# Loglar kuyruğa yazılır; dosyaya yazma ve sıkıştırma ayrı bir iş parçacığında yapılır
+setup_logging(
+    LOG_FILE,
+    level=LOG_LEVEL,
+    levels=LOG_LEVELS,
+    json_format=LOG_FORMAT == "json",
+    max_bytes=LOG_MAX_BYTES,
+    backups=LOG_BACKUPS,
+    rate_limits={name: (LOG_PACKET_RATE, LOG_PACKET_BURST, LOG_PACKET_SAMPLE) for name in PACKET_LOGGERS}
+)
+# Süreç listesi: ilk örnekten önce CPU ölçümü için beklenecek süre ve saklanan anlık görüntü sayısı
+PROCESS_PRIME_INTERVAL = 0.5
+PROCESS_SNAPSHOT_HISTORY = 8
+# Yük örnekleri: örnekleme aralığı (saniye), halka tampon kapasitesi ve heartbeat başına gönderilen örnek
+METRICS_INTERVAL = 5
+METRICS_BUFFER = 720
+METRICS_BATCH = 120
+# Sunucudaki METRIC_FIELDS ile aynı sırada olmalı
+METRIC_FIELDS = ("ts", "cpu", "mem_percent", "mem_used", "disk_percent",
+                 "disk_read", "disk_write", "net_sent", "net_recv")
+
+class LazyModule:
+    # Ağır bağımlılıklar (pyautogui; Pillow, pymsgbox, pyscreeze vb. ile birlikte) ilk kullanımda yüklenir
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    def __getattr__(self, attr):
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+        return getattr(self._module, attr)
+
+pyautogui = LazyModule("pyautogui")
+
+def has_display():
+    # Linux'ta X11/Wayland oturumu yoksa pyautogui içe aktarılırken hata verir
+    if platform.system() != "Linux":
+        return True
+    return bool(os.environ.get("DISPLAY") or os.environ.get("WAYLAND_DISPLAY"))
+
+def module_available(name):
+    if name in sys.modules:
+        return True
+    try:
+        return importlib.util.find_spec(name) is not None
+    except (ImportError, ValueError):
+        return False
+
+class CommandSpec:
+    def __init__(self, name, handler, requires=(), lane="serial", timeout=COMMAND_TIMEOUT,
+                 display=False):
+        self.name = name
+        # RemoteClient metot adı ya da eklentiler için "modül:fonksiyon"
+        self.handler = handler
+        self.requires = tuple(requires)
+        # parallel: salt okunur komutlar, serial: giriş ve güç komutları, inline: iptal
+        self.lane = lane
+        self.timeout = timeout
+        self.display = display
+
+class CommandRegistry:
+    # Komutlar ve bağımlılıkları burada bildirilir; hiçbir modül komut ilk çalıştırılana kadar yüklenmez
+    def __init__(self):
+        self._specs = OrderedDict()
+        self._available = {}
+        self._plugins = {}
+        self._lock = threading.Lock()
+
+    def register(self, name, handler, **options):
+        self._specs[name] = CommandSpec(name, handler, **options)
+        self._available.pop(name, None)
+
+    def command(self, name, **options):
+        def decorator(method):
+            self.register(name, method.__name__, **options)
+            return method
+        return decorator
+
+    def load_plugins(self, config):
+        for entry in filter(None, (part.strip() for part in config.split(","))):
+            name, _, target = entry.partition("=")
+            module = target.partition(":")[0].strip()
+            if not module or ":" not in target:
+                logger.warning(f"Geçersiz eklenti tanımı: {entry}")
+                continue
+            self.register(name.strip(), target.strip(), requires=(module,), lane="parallel")
+
+    def get(self, name):
+        return self._specs.get(name)
+
+    def available(self, name):
+        # Bağımlılıklar içe aktarılmadan yalnızca bulunabilir olup olmadıkları kontrol edilir
+        spec = self._specs.get(name)
+        if spec is None:
+            return False
+        if name not in self._available:
+            self._available[name] = (
+                (not spec.display or has_display())
+                and all(module_available(module) for module in spec.requires)
+            )
+        return self._available[name]
+
+    def capabilities(self):
+        return sorted(name for name in self._specs if self.available(name))
+
+    def resolve(self, client, name):
+        spec = self._specs[name]
+        if ":" not in spec.handler:
+            return getattr(client, spec.handler)
+        with self._lock:
+            function = self._plugins.get(name)
+            if function is None:
+                module, _, attr = spec.handler.partition(":")
+                function = getattr(importlib.import_module(module), attr)
+                self._plugins[name] = function
+        return partial(function, client)
+
+command_registry = CommandRegistry()
 
 class ClientDatabase:
     def __init__(self):
@@ -52,12 +216,753 @@ class ClientDatabase:
                       ('api_key', api_key))
             conn.commit()
 
+class FrameSource:
+    # Kare kaynağı arayüzü: grab() HxWx3 uint8 NumPy dizisi döndürür
+    def grab(self):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+class ScreenFrameSource(FrameSource):
+    def __init__(self, scale=1.0):
+        self.scale = scale
+
+    def grab(self):
+        import numpy as np
+        image = pyautogui.screenshot()
+        if self.scale < 1.0:
+            image = image.resize((max(1, int(image.width * self.scale)), max(1, int(image.height * self.scale))))
+        return np.asarray(image.convert("RGB"))
+
+class SyntheticFrameSource(FrameSource):
+    # Test için: sabit bir arka plan üzerinde hareket eden bir kare
+    def __init__(self, width=640, height=360, box=48, speed=8):
+        import numpy as np
+        self.width, self.height = width, height
+        self.box, self.speed = box, speed
+        self.frame_no = 0
+        x = np.linspace(0, 255, width, dtype=np.uint8)
+        y = np.linspace(0, 255, height, dtype=np.uint8)
+        self.background = np.stack(np.broadcast_arrays(x[None, :], y[:, None], np.uint8(96)), axis=2).copy()
+
+    def grab(self):
+        frame = self.background.copy()
+        span_x = max(1, self.width - self.box)
+        span_y = max(1, self.height - self.box)
+        x = (self.frame_no * self.speed) % span_x
+        y = (self.frame_no * self.speed // 2) % span_y
+        frame[y:y + self.box, x:x + self.box] = (255, 32, 32)
+        self.frame_no += 1
+        return frame
+
+def changed_regions(previous, frame, tile):
+    # Değişen karolar NumPy ile bulunur, her satırdaki bitişik karolar tek bölgede birleştirilir
+    import numpy as np
+    height, width = frame.shape[:2]
+    rows, cols = -(-height // tile), -(-width // tile)
+    changed = np.zeros((rows * tile, cols * tile), dtype=bool)
+    changed[:height, :width] = (previous != frame).any(axis=2)
+    dirty = changed.reshape(rows, tile, cols, tile).any(axis=(1, 3))
+    return tile_regions(dirty, tile, width, height)
+
+def tile_regions(dirty, tile, width, height):
+    regions = []
+    for row in range(dirty.shape[0]):
+        col = 0
+        while col < dirty.shape[1]:
+            if not dirty[row, col]:
+                col += 1
+                continue
+            start = col
+            while col < dirty.shape[1] and dirty[row, col]:
+                col += 1
+            x, y = start * tile, row * tile
+            regions.append((x, y, min(col * tile, width) - x, min(tile, height - y)))
+    return regions
+
+class ScreenWatcher:
+    # Kareleri uyarlanabilir hızla yakalar ve yalnızca değişen bölgeleri gönderir.
+    # Aralık değişiklik oldukça kısalır, ekran durgunken ve sunucu geride kaldığında uzar.
+    def __init__(self, sio, source, watch_id, fps=5, duration=60, quality=60, tile=64,
+                 keyframe_interval=WATCH_KEYFRAME_INTERVAL, on_finish=None):
+        self.sio = sio
+        self.source = source
+        self.watch_id = watch_id
+        self.min_interval = 1.0 / max(0.1, min(float(fps), 30.0))
+        self.interval = self.min_interval
+        self.duration = duration
+        self.quality = max(1, min(int(quality), 100))
+        self.tile = max(16, int(tile))
+        self.keyframe_interval = keyframe_interval
+        self.on_finish = on_finish
+        self.stats = {"frames": 0, "keyframes": 0, "packets": 0, "bytes": 0, "skipped": 0}
+        self._unacked = 0
+        self._force_keyframe = False
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name=f"screen-watch-{self.watch_id}")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def request_keyframe(self):
+        self._force_keyframe = True
+
+    def _on_ack(self, response=None):
+        with self._lock:
+            self._unacked -= 1
+            if response and response.get("ok") and self._unacked == 0:
+                self.interval = max(self.min_interval, self.interval * 0.8)
+        if response and response.get("stop"):
+            self.stop()
+
+    def _encode(self, frame, region):
+        from PIL import Image
+        x, y, w, h = region
+        buffer = io.BytesIO()
+        Image.fromarray(frame[y:y + h, x:x + w]).save(buffer, format="JPEG", quality=self.quality)
+        return {"x": x, "y": y, "w": w, "h": h, "data": buffer.getvalue()}
+
+    def _send(self, frame, regions, keyframe, seq):
+        height, width = frame.shape[:2]
+        tiles, size = [], 0
+
+        def flush(last):
+            with self._lock:
+                self._unacked += 1
+            self.sio.emit("screen_frame", {
+                "watch_id": self.watch_id,
+                "seq": seq,
+                "keyframe": keyframe,
+                "width": width,
+                "height": height,
+                "mime": "image/jpeg",
+                "tiles": tiles,
+                "last": last
+            }, callback=self._on_ack)
+            self.stats["packets"] += 1
+
+        # Büyük kareler engine.io paket sınırını aşmamak için birden fazla pakete bölünür
+        for region in regions:
+            encoded = self._encode(frame, region)
+            if tiles and size + len(encoded["data"]) > WATCH_MAX_PACKET_BYTES:
+                flush(False)
+                tiles, size = [], 0
+            tiles.append(encoded)
+            size += len(encoded["data"])
+            self.stats["bytes"] += len(encoded["data"])
+        flush(True)
+
+    def _run(self):
+        deadline = time.monotonic() + self.duration
+        previous, last_keyframe, seq = None, 0, 0
+        logger.info(f"Ekran izleme başladı: {self.watch_id}")
+        try:
+            while not self._stop.is_set() and self.sio.connected and time.monotonic() < deadline:
+                started = time.monotonic()
+                if self._unacked >= WATCH_MAX_UNACKED:
+                    # Sunucu onayları gecikiyor, kare atla ve yavaşla
+                    self.stats["skipped"] += 1
+                    with self._lock:
+                        self.interval = min(WATCH_MAX_INTERVAL, self.interval * 2)
+                    self._stop.wait(self.interval)
+                    continue
+
+                frame = self.source.grab()
+                keyframe = (previous is None or previous.shape != frame.shape or self._force_keyframe
+                            or started - last_keyframe >= self.keyframe_interval)
+                if keyframe:
+                    self._force_keyframe = False
+                    height, width = frame.shape[:2]
+                    regions = [(0, y, width, min(self.tile, height - y)) for y in range(0, height, self.tile)]
+                    last_keyframe = started
+                    self.stats["keyframes"] += 1
+                else:
+                    regions = changed_regions(previous, frame, self.tile)
+
+                if regions:
+                    seq += 1
+                    self._send(frame, regions, keyframe, seq)
+                    self.stats["frames"] += 1
+                else:
+                    with self._lock:
+                        self.interval = min(WATCH_MAX_INTERVAL, self.interval * 1.25)
+                previous = frame
+                self._stop.wait(max(0, self.interval - (time.monotonic() - started)))
+        except Exception as e:
+            logger.error(f"Ekran izleme hatası: {str(e)}")
+        finally:
+            self.source.close()
+            if self.on_finish:
+                self.on_finish(self.watch_id)
+            if self.sio.connected:
+                self.sio.emit("screen_watch_end", {"watch_id": self.watch_id, "stats": self.stats})
+            logger.info(f"Ekran izleme bitti: {self.watch_id} {self.stats}")
+
+class ProcessMonitor:
+    # Süreç nesneleri PID başına saklanır; cpu_percent her çağrıda bir önceki örneğe göre ölçülür
+    FIELDS = ('pid', 'name', 'username', 'status', 'cpu_percent', 'memory_percent', 'rss_mb',
+              'num_threads', 'create_time', 'cmdline')
+    DEFAULT_FIELDS = FIELDS[:-1]
+    SORT_FIELDS = ('pid', 'name', 'username', 'cpu_percent', 'memory_percent', 'rss_mb',
+                   'num_threads', 'create_time')
+
+    def __init__(self, history=PROCESS_SNAPSHOT_HISTORY):
+        self.history = history
+        self._procs = {}
+        # token -> (görünüm anahtarı, {pid: satır})
+        self._snapshots = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _discover(self):
+        import psutil
+        procs, fresh = {}, set()
+        for pid in psutil.pids():
+            proc = self._procs.get(pid)
+            # is_running() PID yeniden kullanımını da yakalar
+            if proc is None or not proc.is_running():
+                try:
+                    proc = psutil.Process(pid)
+                    proc.cpu_percent(None)
+                except (psutil.NoSuchProcess, psutil.AccessDenied):
+                    continue
+                fresh.add(pid)
+            procs[pid] = proc
+        primed = bool(self._procs)
+        self._procs = procs
+        if not primed and procs:
+            # İlk çağrıda CPU ölçümü anlamlı olsun diye kısa bir süre bekle
+            time.sleep(PROCESS_PRIME_INTERVAL)
+            fresh = set()
+        return fresh
+
+    def _sample(self, filters, fields):
+        import psutil
+        fresh = self._discover()
+        attrs = ['name', 'username', 'status', 'cpu_percent', 'memory_percent', 'memory_info',
+                 'num_threads', 'create_time']
+        if 'cmdline' in fields:
+            attrs.append('cmdline')
+        name_filter = (filters.get('name') or '').lower()
+        pid_filter = set(filters.get('pids') or ())
+
+        rows = []
+        for pid, proc in self._procs.items():
+            if pid_filter and pid not in pid_filter:
+                continue
+            try:
+                # Ucuz filtreler pahalı örneklemeden önce uygulanır
+                if name_filter and name_filter not in proc.name().lower():
+                    continue
+                info = proc.as_dict(attrs, ad_value=None)
+            except (psutil.NoSuchProcess, psutil.ZombieProcess, psutil.AccessDenied):
+                continue
+            memory = info.pop('memory_info')
+            info['pid'] = pid
+            info['rss_mb'] = round(memory.rss / (1024 * 1024), 1) if memory else None
+            info['cpu_percent'] = None if pid in fresh else round(info['cpu_percent'] or 0.0, 1)
+            if info['memory_percent'] is not None:
+                info['memory_percent'] = round(info['memory_percent'], 2)
+            rows.append(info)
+        return rows
+
+    @staticmethod
+    def _filter(rows, filters):
+        user = filters.get('user')
+        status = filters.get('status')
+        min_cpu = filters.get('min_cpu')
+        min_memory = filters.get('min_memory')
+        for row in rows:
+            if user is not None and row['username'] != user:
+                continue
+            if status is not None and row['status'] != status:
+                continue
+            if min_cpu is not None and (row['cpu_percent'] or 0.0) < min_cpu:
+                continue
+            if min_memory is not None and (row['memory_percent'] or 0.0) < min_memory:
+                continue
+            yield row
+
+    def snapshot(self, filters=None, sort='-cpu_percent', top=None, fields=None, since=None):
+        filters = dict(filters or {})
+        fields = list(fields or self.DEFAULT_FIELDS)
+        unknown = [field for field in fields if field not in self.FIELDS]
+        if unknown:
+            raise ValueError(f"Bilinmeyen alanlar: {', '.join(unknown)}")
+        if 'pid' not in fields:
+            fields.insert(0, 'pid')
+        descending = sort.startswith('-')
+        sort_field = sort.lstrip('-')
+        if sort_field not in self.SORT_FIELDS:
+            raise ValueError(f"Geçersiz sıralama alanı: {sort_field}")
+        if top is not None:
+            top = max(1, int(top))
+        view_key = json.dumps([filters, sort, top, fields], sort_keys=True)
+
+        with self._lock:
+            rows = list(self._filter(self._sample(filters, fields), filters))
+            # Henüz ölçülmemiş değerler iki yönde de en sona düşer
+            rows.sort(key=lambda row: ((row[sort_field] is None) != descending, row[sort_field]),
+                      reverse=descending)
+            total = len(rows)
+            if top is not None:
+                rows = rows[:top]
+            view = OrderedDict((row['pid'], {field: row.get(field) for field in fields}) for row in rows)
+
+            token = uuid.uuid4().hex[:12]
+            base = self._snapshots.get(since) if since else None
+            self._snapshots[token] = (view_key, view)
+            while len(self._snapshots) > self.history:
+                self._snapshots.popitem(last=False)
+
+        result = {'token': token, 'total': total, 'sampled_at': datetime.now().isoformat()}
+        if base is None or base[0] != view_key:
+            # Bilinmeyen ya da farklı sorguya ait token: tam liste
+            result['delta'] = False
+            result['processes'] = list(view.values())
+            return result
+
+        previous = base[1]
+        changed = []
+        for pid, row in view.items():
+            old = previous.get(pid)
+            if old is not None and old != row:
+                diff = {field: value for field, value in row.items() if old.get(field) != value}
+                diff['pid'] = pid
+                changed.append(diff)
+        result.update({
+            'delta': True,
+            'base': since,
+            'started': [row for pid, row in view.items() if pid not in previous],
+            'exited': [pid for pid in previous if pid not in view],
+            'changed': changed,
+            'order': list(view)
+        })
+        return result
+
+class MetricsRing:
+    # Örnekler tek bir düz double dizisinde tutulur; dolunca en eski örneklerin üzerine yazılır
+    def __init__(self, capacity=METRICS_BUFFER, width=len(METRIC_FIELDS)):
+        self.capacity = capacity
+        self.width = width
+        self._data = array("d", bytes(8 * capacity * width))
+        # Son eklenen örneğin sıra numarası ve sunucunun onayladığı son sıra numarası
+        self._seq = 0
+        self._acked = 0
+        self._lock = threading.Lock()
+
+    def append(self, row):
+        with self._lock:
+            self._seq += 1
+            start = (self._seq % self.capacity) * self.width
+            self._data[start:start + self.width] = array("d", row)
+            return self._seq
+
+    def _row(self, seq):
+        start = (seq % self.capacity) * self.width
+        # NaN ölçülemeyen değer demektir ve JSON'da null olarak gider
+        return [None if value != value else value for value in self._data[start:start + self.width]]
+
+    def latest(self):
+        with self._lock:
+            return self._row(self._seq) if self._seq else None
+
+    def batch(self, limit=METRICS_BATCH):
+        # Onaylanmamış en eski örnekler; üzerine yazılmış olanlar atlanır
+        with self._lock:
+            first = max(self._acked, self._seq - self.capacity) + 1
+            last = min(self._seq, first + limit - 1)
+            if first > last:
+                return None
+            return last, [self._row(seq) for seq in range(first, last + 1)]
+
+    def ack(self, seq):
+        with self._lock:
+            if isinstance(seq, int) and self._acked < seq <= self._seq:
+                self._acked = seq
+
+class MetricsSampler:
+    # CPU, bellek, disk ve ağ sayaçlarını arka planda örnekler; disk/ağ değerleri saniyelik hızdır
+    def __init__(self, ring, interval=METRICS_INTERVAL):
+        self.ring = ring
+        # Sunucu örnekleri saniye çözünürlüğünde saklar
+        self.interval = max(interval, 1)
+        self.disk_path = os.environ.get("SystemDrive", "C:") + "\\" if os.name == "nt" else "/"
+        self._counters = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def _read_counters(self, psutil):
+        disk = psutil.disk_io_counters()
+        net = psutil.net_io_counters()
+        return (time.monotonic(),
+                disk.read_bytes if disk else 0, disk.write_bytes if disk else 0,
+                net.bytes_sent if net else 0, net.bytes_recv if net else 0)
+
+    def sample(self):
+        import psutil
+        memory = psutil.virtual_memory()
+        try:
+            disk_percent = psutil.disk_usage(self.disk_path).percent
+        except OSError:
+            disk_percent = float("nan")
+        counters = self._read_counters(psutil)
+        previous, self._counters = self._counters, counters
+        elapsed = counters[0] - previous[0]
+        # Sayaçlar sıfırlanırsa (ör. arayüz yeniden başlatıldı) negatif hız yerine 0 yazılır
+        rates = [max(now - before, 0) / elapsed if elapsed > 0 else 0.0
+                 for now, before in zip(counters[1:], previous[1:])]
+        return [time.time(), psutil.cpu_percent(None), memory.percent, memory.used,
+                disk_percent, *rates]
+
+    def _run(self):
+        try:
+            import psutil
+            # İlk cpu_percent çağrısı ve sayaç okuması yalnızca referans noktası oluşturur
+            psutil.cpu_percent(None)
+            self._counters = self._read_counters(psutil)
+        except Exception as e:
+            logger.error(f"Yük örnekleyici başlatılamadı: {e}")
+            return
+        while not self._stop.wait(self.interval):
+            try:
+                self.ring.append(self.sample())
+            except Exception as e:
+                logger.error(f"Yük örneği alınamadı: {e}")
+
+class CommandTask:
+    def __init__(self, command_id, command, fn, params, timeout, timestamp):
+        self.command_id = command_id
+        self.command = command
+        self.fn = fn
+        self.params = params
+        self.timeout = timeout
+        self.timestamp = timestamp
+        self.state = "queued"
+        # İşbirlikçi komutlar (exec gibi) iptal ve zaman aşımında bunu kontrol eder
+        self.cancel_event = threading.Event()
+        self.finished = False
+        self.lock = threading.Lock()
+
+class CommandExecutor:
+    # Komutları Socket.IO geri çağrısı dışında çalıştırır ve durumlarını sunucuya bildirir.
+    # Python iş parçacıkları durdurulamaz: zaman aşımı ya da iptal sonucu hemen bildirir,
+    # komutun geç gelen sonucu ise atılır.
+    def __init__(self, emit, workers=COMMAND_WORKERS):
+        self.emit = emit
+        self._parallel = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="command")
+        self._serial = ThreadPoolExecutor(max_workers=1, thread_name_prefix="command-serial")
+        self._tasks = {}
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def submit(self, command_id, command, fn, params, timeout=COMMAND_TIMEOUT, lane="serial", timestamp=None):
+        task = CommandTask(command_id, command, fn, params or {}, timeout, timestamp)
+        with self._lock:
+            self._tasks[command_id] = task
+        if lane == "inline":
+            self._run(task)
+            return task
+        self._status(task, "queued")
+        pool = self._parallel if lane == "parallel" else self._serial
+        pool.submit(self._run, task)
+        return task
+
+    def current_task(self):
+        return getattr(self._local, "task", None)
+
+    def _run(self, task):
+        if task.cancel_event.is_set():
+            return
+        task.state = "running"
+        self._status(task, "running")
+        timer = threading.Timer(task.timeout, self._expire, args=(task,))
+        timer.daemon = True
+        timer.start()
+        self._local.task = task
+        try:
+            result = task.fn(**task.params)
+            self._finish(task, "done", result=result)
+        except Exception as e:
+            error_msg = f"Komut çalıştırılırken hata: {str(e)}"
+            logger.error(error_msg)
+            self._finish(task, "failed", error=error_msg)
+        finally:
+            timer.cancel()
+            self._local.task = None
+
+    def _expire(self, task):
+        task.cancel_event.set()
+        if self._finish(task, "timeout", error=f"Komut {task.timeout} saniye içinde tamamlanmadı"):
+            logger.warning(f"Komut zaman aşımına uğradı: {task.command} - ID: {task.command_id}")
+
+    def cancel(self, command_id):
+        with self._lock:
+            task = self._tasks.get(command_id)
+        if task is None:
+            return {"cancelled": False, "message": f"Command {command_id} is not pending"}
+        previous_state = task.state
+        task.cancel_event.set()
+        self._finish(task, "cancelled", error="Komut iptal edildi")
+        return {"cancelled": True, "previous_state": previous_state}
+
+    def _finish(self, task, state, result=None, error=None):
+        # Her komut için tek bir sonuç gönderilir
+        with task.lock:
+            if task.finished:
+                return False
+            task.finished = True
+            task.state = state
+        with self._lock:
+            self._tasks.pop(task.command_id, None)
+
+        payload = {
+            "command": task.command,
+            "command_id": task.command_id,
+            "success": state == "done",
+            "state": state,
+            "timestamp": task.timestamp
+        }
+        if state == "done":
+            payload["result"] = result
+        else:
+            payload["error"] = error
+        self._emit("command_result", payload)
+        return True
+
+    def _status(self, task, state):
+        self._emit("command_status", {
+            "command_id": task.command_id,
+            "command": task.command,
+            "state": state,
+            "timestamp": datetime.now().isoformat()
+        })
+
+    def _emit(self, event, data):
+        try:
+            self.emit(event, data)
+        except Exception as e:
+            logger.warning(f"{event} gönderilemedi: {str(e)}")
+
+    def shutdown(self):
+        with self._lock:
+            tasks = list(self._tasks.values())
+        for task in tasks:
+            task.cancel_event.set()
+        self._parallel.shutdown(wait=False, cancel_futures=True)
+        self._serial.shutdown(wait=False, cancel_futures=True)
+
+class ProcessRunner:
+    # Süreci kabuk olmadan başlatır, stdout/stderr'i parça parça gönderir.
+    # Okuyucu kuyruğu sınırlı olduğundan sunucu onayları gecikince boru dolar ve süreç yavaşlar.
+    def __init__(self, emit, command_id, argv, cwd=None, env=None, timeout=EXEC_TIMEOUT,
+                 max_output=EXEC_MAX_OUTPUT, cancel_event=None):
+        self.emit = emit
+        self.command_id = command_id
+        self.argv = argv
+        self.cwd = cwd
+        self.env = env
+        self.timeout = timeout
+        self.max_output = max_output
+        self.cancel_event = cancel_event or threading.Event()
+        self._chunks = queue.Queue(maxsize=64)
+        self._window = threading.BoundedSemaphore(EXEC_WINDOW)
+        self.seq = 0
+        self.sent = 0
+        self.counts = {"stdout": 0, "stderr": 0}
+
+    def _read(self, name, stream):
+        try:
+            for data in iter(lambda: stream.read1(EXEC_CHUNK_BYTES), b""):
+                self._chunks.put((name, data))
+        finally:
+            stream.close()
+            self._chunks.put((name, None))
+
+    def _kill(self, proc):
+        if proc.poll() is not None:
+            return
+        try:
+            if os.name == "posix":
+                # Alt süreçler de aynı oturumda, hepsi birlikte sonlanır
+                os.killpg(proc.pid, signal.SIGKILL)
+            else:
+                proc.kill()
+        except (ProcessLookupError, PermissionError):
+            proc.kill()
+
+    def _flush(self, pending, decoders, final=False):
+        data = {}
+        for name, parts in pending.items():
+            text = decoders[name].decode(b"".join(parts), final)
+            if text:
+                data[name] = text
+            parts.clear()
+        if not data:
+            return True
+        if not self._window.acquire(timeout=self.timeout):
+            return False
+        self.seq += 1
+        self.emit("command_output", {"command_id": self.command_id, "seq": self.seq, **data},
+                  callback=lambda *args: self._window.release())
+        return True
+
+    def run(self):
+        started = time.monotonic()
+        kwargs = {"start_new_session": True} if os.name == "posix" else {
+            "creationflags": subprocess.CREATE_NEW_PROCESS_GROUP}
+        env = {**os.environ, **self.env} if self.env else None
+        proc = subprocess.Popen(self.argv, cwd=self.cwd, env=env, stdin=subprocess.DEVNULL,
+                                stdout=subprocess.PIPE, stderr=subprocess.PIPE, **kwargs)
+        readers = [threading.Thread(target=self._read, args=(name, stream), daemon=True)
+                   for name, stream in (("stdout", proc.stdout), ("stderr", proc.stderr))]
+        for reader in readers:
+            reader.start()
+
+        decoders = {name: codecs.getincrementaldecoder("utf-8")(errors="replace") for name in self.counts}
+        pending = {name: [] for name in self.counts}
+        buffered, last_flush, open_streams = 0, time.monotonic(), 2
+        reason = None
+        while open_streams:
+            now = time.monotonic()
+            if reason is None:
+                if self.cancel_event.is_set():
+                    reason = "cancelled"
+                elif now - started > self.timeout:
+                    reason = "timeout"
+                if reason:
+                    self._kill(proc)
+            try:
+                name, data = self._chunks.get(timeout=EXEC_FLUSH_INTERVAL)
+            except queue.Empty:
+                name, data = None, b""
+            if data is None:
+                open_streams -= 1
+            elif data and reason is None:
+                if self.sent + buffered + len(data) > self.max_output:
+                    # Çıktı sınırı aşıldı: sığan kısmı gönder ve süreci sonlandır
+                    data = data[:max(0, self.max_output - self.sent - buffered)]
+                    reason = "truncated"
+                    self._kill(proc)
+                pending[name].append(data)
+                self.counts[name] += len(data)
+                buffered += len(data)
+            if buffered >= EXEC_CHUNK_BYTES or (buffered and time.monotonic() - last_flush >= EXEC_FLUSH_INTERVAL):
+                if not self._flush(pending, decoders):
+                    reason = reason or "timeout"
+                    self._kill(proc)
+                self.sent += buffered
+                buffered, last_flush = 0, time.monotonic()
+
+        self._flush(pending, decoders, final=True)
+        self.sent += buffered
+        exit_code = proc.wait()
+        return {
+            "exit_code": exit_code,
+            "timed_out": reason == "timeout",
+            "cancelled": reason == "cancelled",
+            "truncated": reason == "truncated",
+            "stdout_bytes": self.counts["stdout"],
+            "stderr_bytes": self.counts["stderr"],
+            "chunks": self.seq,
+            "duration": round(time.monotonic() - started, 3)
+        }
+
+class ReconnectManager:
+    # Bağlantı koptuğunda sınırsız yeniden dener. Bekleme süresi tam jitter'lı üstel geri çekilmedir,
+    # böylece sunucu yeniden başladığında istemciler aynı anda bağlanmaya çalışmaz
+    def __init__(self, connect, wait, base=RECONNECT_BASE_DELAY, cap=RECONNECT_MAX_DELAY):
+        self.connect = connect
+        self.wait = wait
+        self.base = base
+        self.cap = cap
+        self.attempts = 0
+        # Sunucunun yoğunluk sırasında önerdiği bekleme süresi
+        self.retry_after = None
+        self._stop = threading.Event()
+
+    def next_delay(self):
+        delay = random.uniform(0, min(self.cap, self.base * 2 ** self.attempts))
+        if self.retry_after:
+            delay = max(delay, self.retry_after)
+            self.retry_after = None
+        return delay
+
+    def stop(self):
+        self._stop.set()
+
+    def stopped(self):
+        return self._stop.is_set()
+
+    def sleep(self, seconds):
+        # Durdurulduysa True döner
+        return self._stop.wait(seconds)
+
+    def run(self):
+        while not self._stop.is_set():
+            try:
+                logger.info(f"Sunucuya bağlanılıyor... Deneme {self.attempts + 1}")
+                self.connect()
+            except Exception as e:
+                delay = self.next_delay()
+                self.attempts += 1
+                logger.error(f"Bağlantı hatası: {str(e)}")
+                logger.info(f"{delay:.1f} saniye sonra tekrar denenecek...")
+                self._stop.wait(delay)
+                continue
+
+            logger.info("Sunucuya bağlantı başarılı!")
+            self.attempts = 0
+            try:
+                self.wait()
+            except Exception as e:
+                # Ör. WinError 10054: bağlantı karşı taraftan kapatıldı
+                logger.error(f"Bağlantı hatası: {str(e)}")
+            if not self._stop.is_set():
+                # Kopan bağlantıdan sonraki ilk deneme de jitter'lı beklenir; yoksa sunucu yeniden
+                # başladığında tüm istemciler aynı saniyede bağlanır
+                self.attempts = 1
+                delay = self.next_delay()
+                logger.warning(f"Bağlantı koptu, {delay:.1f} saniye sonra yeniden bağlanılacak")
+                self._stop.wait(delay)
+
 class RemoteClient:
     def __init__(self):
-        self.sio = socketio.Client(logger=True, engineio_logger=True)
+        # Yeniden bağlanmayı ReconnectManager yönetir
+        # Logger nesneleri verilir; True verilirse kütüphaneler kendi engelleyici handler'larını ekler
+        self.sio = socketio.Client(reconnection=False, logger=logging.getLogger("socketio.client"),
+                                   engineio_logger=logging.getLogger("engineio.client"))
         self.db = ClientDatabase()
         self.system = platform.system().lower()
         self.client_id = str(uuid.uuid4())
+        # Sunucunun bildiği son system_info ve özeti
+        self.sent_system_info = None
+        self.sent_info_hash = None
+        # Devam eden ekran izleme oturumları
+        self.watchers = {}
+        self.process_monitor = ProcessMonitor()
+        self.executor = CommandExecutor(lambda event, data: self.sio.emit(event, data))
+        self.api_key = None
+        # Sunucunun verdiği oturum devam anahtarı; yeniden bağlanırken kayıt adımları atlanır
+        self.resume_token = None
+        self.reconnect = ReconnectManager(self.connect_to_server, self.sio.wait)
+        self.metrics = MetricsRing()
+        self.sampler = MetricsSampler(self.metrics)
         self.setup_handlers()
 
         # Sistem bilgilerini topla
@@ -66,56 +971,115 @@ class RemoteClient:
             'processor': platform.processor(),
             'memory': self.get_memory_info(),
             'hostname': platform.node(),
-            'python_version': platform.python_version()
-        }
-
-        # Komut haritası genişletildi
-        self.commands = {
-            "shutdown": self.shutdown,
-            "restart": self.restart,
-            "sleep": self.sleep,
-            "lock": self.lock_system,
-            "logout": self.logout_user,
-            "volumeup": self.volume_up,
-            "volumedown": self.volume_down,
-            "mute": self.mute,
-            "screenshot": self.take_screenshot,
-            "processes": self.list_processes,
-            "kill": self.kill_process,
-            "exec": self.execute_command,
-            "sysinfo": self.get_system_info,
-            "clipboard": self.get_clipboard,
-            "setclipboard": self.set_clipboard,
-            "type": self.type_text,
-            "press": self.press_key,
-            "battery": self.get_battery_info
+            'python_version': platform.python_version(),
+            # Sunucu desteklenmeyen komutları istemciye göndermeden reddeder
+            'capabilities': command_registry.capabilities()
         }
 
     def get_memory_info(self):
+        # Yalnızca değişmeyen toplam bellek; anlık kullanım yük örnekleriyle gönderilir
         try:
             import psutil
             memory = psutil.virtual_memory()
             return {
-                'total': memory.total,
-                'available': memory.available,
-                'percent': memory.percent
+                'total': memory.total
             }
         except:
             return "Unable to get memory info"
 
+    @staticmethod
+    def system_info_hash(system_info):
+        # Sunucudaki system_info_hash ile aynı olmalı
+        raw = json.dumps(system_info, sort_keys=True, separators=(',', ':'), default=str)
+        return hashlib.sha256(raw.encode()).hexdigest()[:16]
+
+    def build_heartbeat(self):
+        info_hash = self.system_info_hash(self.system_info)
+        payload = {
+            'v': 2,
+            'info_hash': info_hash,
+            'timestamp': datetime.now().isoformat()
+        }
+
+        if self.sent_info_hash is None:
+            payload['system_info'] = self.system_info
+        elif info_hash != self.sent_info_hash:
+            # Yalnızca değişen alanları gönder
+            payload['system_info_delta'] = {
+                'base_hash': self.sent_info_hash,
+                'changed': {
+                    k: v for k, v in self.system_info.items()
+                    if self.sent_system_info.get(k) != v
+                },
+                'removed': [k for k in self.sent_system_info if k not in self.system_info]
+            }
+
+        self.sent_system_info = json.loads(json.dumps(self.system_info, default=str))
+        self.sent_info_hash = info_hash
+        return payload
+
+    def send_heartbeat(self):
+        payload = self.build_heartbeat()
+        pending = self.metrics.batch()
+        if pending is not None:
+            last_seq, rows = pending
+            payload['metrics'] = {
+                'seq': last_seq,
+                'fields': list(METRIC_FIELDS),
+                'rows': rows
+            }
+        # Sunucu kaydettiği son örneğin sıra numarasını onaylar; onaylanmayanlar tekrar gönderilir
+        self.sio.emit('heartbeat', payload, callback=self.on_heartbeat_ack)
+
+    def on_heartbeat_ack(self, response=None):
+        if isinstance(response, dict):
+            self.metrics.ack(response.get('metrics_seq'))
+            if response.get('resume_token'):
+                self.resume_token = response['resume_token']
+
     def setup_handlers(self):
         @self.sio.event
         def connect():
             logger.info(f"Bağlantı başarılı! Client ID: {self.client_id}")
-            # Sistem bilgilerini gönder
+            # Sistem bilgilerini gönder, sonraki heartbeat'ler yalnızca özet taşır. Oturum devam
+            # ettiriliyorsa sunucu bilgileri zaten biliyor; özet uyuşmazsa tam kopyayı kendisi ister
+            if self.resume_token is None:
+                self.sent_info_hash = None
             self.sio.emit('system_info', {
                 'client_id': self.client_id,
-                'system_info': self.system_info
+                **self.build_heartbeat()
             })
 
+        @self.sio.event
+        def connect_error(data):
+            # Sunucu yoğunken bağlantıyı reddeder ve ne kadar sonra denenmesi gerektiğini bildirir
+            hint = data.get("data") if isinstance(data, dict) else None
+            if isinstance(hint, dict) and hint.get("retry_after"):
+                self.reconnect.retry_after = float(hint["retry_after"])
+                logger.warning(f"Sunucu meşgul, {hint['retry_after']} saniye sonra tekrar denenecek")
+
+        @self.sio.on("session")
+        def on_session(data):
+            self.resume_token = data.get("resume_token")
+            if data.get("resumed"):
+                logger.info("Önceki oturum devam ettirildi")
+
+        @self.sio.on("system_info_resync")
+        def on_system_info_resync(data):
+            logger.info("Sunucu tam sistem bilgisi istedi")
+            self.sent_info_hash = None
+            self.send_heartbeat()
+
         @self.sio.event
         def disconnect():
             logger.warning("Sunucu bağlantısı kesildi!")
+            self.screen_watch_stop()
+
+        @self.sio.on("screen_keyframe_request")
+        def on_screen_keyframe_request(data):
+            watcher = self.watchers.get((data or {}).get("watch_id"))
+            for watcher in ([watcher] if watcher else list(self.watchers.values())):
+                watcher.request_keyframe()
 
         @self.sio.on("execute_command")
         def on_execute_command(data):
@@ -126,28 +1090,17 @@ class RemoteClient:
 
             logger.info(f"Komut alındı: {command} - ID: {command_id}")
 
-            if command in self.commands:
-                try:
-                    result = self.commands[command](**params) if params else self.commands[command]()
-                    self.sio.emit("command_result", {
-                        "command": command,
-                        "command_id": command_id,
-                        "success": True,
-                        "result": result,
-                        "timestamp": timestamp
-                    })
-                except Exception as e:
-                    error_msg = f"Komut çalıştırılırken hata: {str(e)}"
-                    logger.error(error_msg)
-                    self.sio.emit("command_result", {
-                        "command": command,
-                        "command_id": command_id,
-                        "success": False,
-                        "error": error_msg,
-                        "timestamp": timestamp
-                    })
+            spec = command_registry.get(command)
+            if spec is not None and command_registry.available(command):
+                # Komutun modülü çalışan iş parçacığında, zaman aşımı içinde yüklenir
+                run = lambda **kwargs: command_registry.resolve(self, command)(**kwargs)
+                self.executor.submit(command_id, command, run, params, timeout=spec.timeout,
+                                     lane=spec.lane, timestamp=timestamp)
             else:
-                error_msg = f"Bilinmeyen komut: {command}"
+                if spec is None:
+                    error_msg = f"Bilinmeyen komut: {command}"
+                else:
+                    error_msg = f"Bu istemcide desteklenmeyen komut: {command}"
                 logger.warning(error_msg)
                 self.sio.emit("command_result", {
                     "command": command,
@@ -158,6 +1111,7 @@ class RemoteClient:
                 })
 
     # Yeni sistem komutları
+    @command_registry.command("lock")
     def lock_system(self):
         if self.system == "windows":
             os.system("rundll32.exe user32.dll,LockWorkStation")
@@ -167,6 +1121,7 @@ class RemoteClient:
             os.system("loginctl lock-session")
         return {"status": "System locked"}
 
+    @command_registry.command("logout")
     def logout_user(self):
         if self.system == "windows":
             os.system("shutdown -l")
@@ -177,6 +1132,7 @@ class RemoteClient:
         return {"status": "User logged out"}
 
     # Mevcut komutlar güncellendi
+    @command_registry.command("shutdown")
     def shutdown(self):
         if self.system == "windows":
             os.system("shutdown /s /t 1")
@@ -184,6 +1140,7 @@ class RemoteClient:
             os.system("shutdown now")
         return {"status": "System shutting down"}
 
+    @command_registry.command("restart")
     def restart(self):
         if self.system == "windows":
             os.system("shutdown /r /t 1")
@@ -191,6 +1148,7 @@ class RemoteClient:
             os.system("shutdown -r now")
         return {"status": "System restarting"}
 
+    @command_registry.command("sleep")
     def sleep(self):
         if self.system == "windows":
             os.system("rundll32.exe powrprof.dll,SetSuspendState 0,1,0")
@@ -200,34 +1158,150 @@ class RemoteClient:
             os.system("pmset sleepnow")
         return {"status": "System going to sleep"}
 
+    @command_registry.command("volumeup", requires=("pyautogui",), display=True)
     def volume_up(self):
         pyautogui.press("volumeup")
         return {"status": "Volume increased"}
 
+    @command_registry.command("volumedown", requires=("pyautogui",), display=True)
     def volume_down(self):
         pyautogui.press("volumedown")
         return {"status": "Volume decreased"}
 
+    @command_registry.command("mute", requires=("pyautogui",), display=True)
     def mute(self):
         pyautogui.press("volumemute")
         return {"status": "Volume muted"}
 
-    def take_screenshot(self):
-        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-        filename = f"screenshot_{timestamp}.png"
-        pyautogui.screenshot(filename)
-        return {"filename": filename, "status": "Screenshot taken"}
+    @command_registry.command("screenshot", requires=("pyautogui", "PIL"), lane="parallel",
+                              timeout=60, display=True)
+    def take_screenshot(self, format="jpeg", quality=70, scale=1.0):
+        format = format.lower()
+        if format not in SCREENSHOT_FORMATS:
+            raise ValueError(f"Desteklenmeyen format: {format}")
+        quality = max(1, min(int(quality), 100))
+        scale = max(0.05, min(float(scale), 1.0))
 
-    def list_processes(self):
-        import psutil
-        processes = []
-        for proc in psutil.process_iter(['pid', 'name', 'cpu_percent', 'memory_percent']):
-            try:
-                processes.append(proc.info)
-            except (psutil.NoSuchProcess, psutil.AccessDenied):
-                pass
-        return {"processes": processes}
+        # Görüntü diske yazılmadan bellekte kodlanır
+        image = pyautogui.screenshot()
+        if scale < 1.0:
+            image = image.resize((max(1, int(image.width * scale)), max(1, int(image.height * scale))))
+        if format != "png":
+            image = image.convert("RGB")
+        buffer = io.BytesIO()
+        if format == "png":
+            image.save(buffer, format="PNG")
+        else:
+            image.save(buffer, format=format.upper(), quality=quality)
+
+        transfer_id = uuid.uuid4().hex
+        size = self.send_screenshot(transfer_id, buffer.getbuffer(), {
+            "mime": SCREENSHOT_FORMATS[format],
+            "width": image.width,
+            "height": image.height
+        })
+        return {
+            "transfer_id": transfer_id,
+            "url": f"/screenshots/{transfer_id}",
+            "size": size,
+            "mime": SCREENSHOT_FORMATS[format],
+            "width": image.width,
+            "height": image.height,
+            "status": "Screenshot taken"
+        }
+
+    def send_screenshot(self, transfer_id, data, meta):
+        # Parçalar ikili ek olarak gider; en fazla SCREENSHOT_WINDOW parça onaysız bekleyebilir
+        total = max(1, -(-len(data) // SCREENSHOT_CHUNK_SIZE))
+        window = threading.BoundedSemaphore(SCREENSHOT_WINDOW)
+        errors = []
 
+        def on_ack(response=None):
+            if not response or not response.get("ok"):
+                errors.append((response or {}).get("error", "Onay alınamadı"))
+            window.release()
+
+        for seq in range(total):
+            if not window.acquire(timeout=SCREENSHOT_ACK_TIMEOUT):
+                raise TimeoutError("Ekran görüntüsü parçası için onay zaman aşımına uğradı")
+            if errors:
+                window.release()
+                break
+            start = seq * SCREENSHOT_CHUNK_SIZE
+            self.sio.emit("screenshot_chunk", {
+                "transfer_id": transfer_id,
+                "seq": seq,
+                "total": total,
+                **meta,
+                "data": bytes(data[start:start + SCREENSHOT_CHUNK_SIZE])
+            }, callback=on_ack)
+
+        # Son parçaların onayını bekle
+        for _ in range(SCREENSHOT_WINDOW):
+            if not window.acquire(timeout=SCREENSHOT_ACK_TIMEOUT):
+                raise TimeoutError("Ekran görüntüsü parçası için onay zaman aşımına uğradı")
+        if errors:
+            raise RuntimeError(f"Ekran görüntüsü gönderilemedi: {errors[0]}")
+        return len(data)
+
+    @command_registry.command("exec", lane="parallel", timeout=EXEC_MAX_TIMEOUT + 30)
+    def execute_command(self, argv=None, cmd=None, cwd=None, env=None, timeout=EXEC_TIMEOUT,
+                        max_output=EXEC_MAX_OUTPUT):
+        # Kabuk kullanılmaz: argv liste olarak ya da cmd dize olarak verilip bölünür
+        if argv is None:
+            if not cmd:
+                raise ValueError("argv veya cmd gerekli")
+            argv = shlex.split(cmd, posix=self.system != "windows")
+        if not isinstance(argv, list) or not argv or not all(isinstance(arg, str) for arg in argv):
+            raise ValueError("argv boş olmayan bir dize listesi olmalı")
+        timeout = max(1, min(float(timeout), EXEC_MAX_TIMEOUT))
+        max_output = max(0, min(int(max_output), EXEC_MAX_OUTPUT))
+
+        task = self.executor.current_task()
+        runner = ProcessRunner(self.sio.emit, task.command_id if task else None, argv, cwd=cwd,
+                               env=env, timeout=timeout, max_output=max_output,
+                               cancel_event=task.cancel_event if task else None)
+        return runner.run()
+
+    @command_registry.command("cancel", lane="inline")
+    def cancel_command(self, command_id):
+        return self.executor.cancel(command_id)
+
+    @command_registry.command("screen_watch", requires=("numpy", "PIL"), lane="parallel")
+    def screen_watch(self, fps=5, duration=60, quality=60, scale=0.5, tile=64, source="screen"):
+        if source == "synthetic":
+            frame_source = SyntheticFrameSource()
+        else:
+            # Yetenek listesi sentetik kaynak için pyautogui ve ekran istemez; gerçek ekranda
+            # başarı bildirmeden önce ikisi de kontrol edilir ve bir kare alınır
+            if not has_display() or not module_available("pyautogui"):
+                raise RuntimeError("Ekran kaynağı kullanılamıyor: görüntü oturumu ya da pyautogui yok")
+            frame_source = ScreenFrameSource(max(0.05, min(float(scale), 1.0)))
+            frame_source.grab()
+        watch_id = uuid.uuid4().hex
+        watcher = ScreenWatcher(self.sio, frame_source, watch_id, fps=fps, duration=duration,
+                                quality=quality, tile=tile,
+                                on_finish=lambda key: self.watchers.pop(key, None))
+        self.watchers[watch_id] = watcher
+        watcher.start()
+        return {"watch_id": watch_id, "status": "Screen watch started"}
+
+    @command_registry.command("screen_watch_stop", lane="parallel")
+    def screen_watch_stop(self, watch_id=None):
+        stopped = []
+        for key, watcher in list(self.watchers.items()):
+            if watch_id is None or key == watch_id:
+                watcher.stop()
+                stopped.append(key)
+        return {"stopped": stopped, "status": "Screen watch stopped"}
+
+    @command_registry.command("processes", requires=("psutil",), lane="parallel", timeout=60)
+    def list_processes(self, filters=None, sort="-cpu_percent", top=None, fields=None, since=None):
+        # since: önceki yanıttaki token; aynı sorgu için yalnızca farklar döner
+        return self.process_monitor.snapshot(filters=filters, sort=sort, top=top,
+                                             fields=fields, since=since)
+
+    @command_registry.command("kill", requires=("psutil",))
     def kill_process(self, pid):
         import psutil
         try:
@@ -237,26 +1311,35 @@ class RemoteClient:
         except psutil.NoSuchProcess:
             return {"success": False, "message": f"Process {pid} not found"}
 
+    @command_registry.command("sysinfo", lane="parallel")
     def get_system_info(self):
-        return self.system_info
+        latest = self.metrics.latest()
+        if latest is None:
+            return self.system_info
+        return {**self.system_info, 'load': dict(zip(METRIC_FIELDS, latest))}
 
+    @command_registry.command("clipboard", requires=("pyperclip",), lane="parallel")
     def get_clipboard(self):
         import pyperclip
         return {"text": pyperclip.paste()}
 
+    @command_registry.command("setclipboard", requires=("pyperclip",))
     def set_clipboard(self, text):
         import pyperclip
         pyperclip.copy(text)
         return {"status": "Clipboard content set"}
 
+    @command_registry.command("type", requires=("pyautogui",), display=True)
     def type_text(self, text):
         pyautogui.write(text)
         return {"status": "Text typed"}
 
+    @command_registry.command("press", requires=("pyautogui",), display=True)
     def press_key(self, key):
         pyautogui.press(key)
         return {"status": f"Key {key} pressed"}
 
+    @command_registry.command("battery", requires=("psutil",), lane="parallel")
     def get_battery_info(self):
         try:
             import psutil
@@ -271,62 +1354,52 @@ class RemoteClient:
         except:
             return {"error": "Unable to get battery info"}
 
-    def connect_with_retry(self):
-        api_key = self.db.get_api_key()
+    def connect_to_server(self):
+        # Geçersiz veya süresi dolmuş devam anahtarında sunucu API key ile normal kayda döner
+        auth = {"resume": self.resume_token} if self.resume_token else None
+        self.sio.connect(
+            f"{SERVER_URL}?client_id={self.client_id}&api_key={self.api_key}",
+            headers={"X-API-KEY": self.api_key},
+            auth=auth
+        )
 
-        if not api_key:
-            api_key = input("API Key'inizi girin: ")
-            self.db.save_api_key(api_key)
-
-        attempts = 0
-        while attempts < MAX_RECONNECT_ATTEMPTS:
-            try:
-                logger.info(f"Sunucuya bağlanılıyor... Deneme {attempts + 1}/{MAX_RECONNECT_ATTEMPTS}")
-                self.sio.connect(
-                    f"{SERVER_URL}?client_id={self.client_id}&api_key={api_key}",
-                    headers={"X-API-KEY": api_key}
-                )
-                logger.info("Sunucuya bağlantı başarılı!")
-                return True
-            except Exception as e:
-                attempts += 1
-                logger.error(f"Bağlantı hatası: {str(e)}")
-                if attempts < MAX_RECONNECT_ATTEMPTS:
-                    logger.info(f"{RECONNECT_DELAY} saniye sonra tekrar denenecek...")
-                    time.sleep(RECONNECT_DELAY)
-
-        logger.error("Maksimum bağlantı deneme sayısına ulaşıldı!")
-        return False
+    def heartbeat_loop(self):
+        while not self.reconnect.stopped():
+            if self.sio.connected:
+                try:
+                    self.send_heartbeat()
+                except socketio.exceptions.SocketIOError as e:
+                    logger.warning(f"Heartbeat gönderilemedi: {e}")
+            self.reconnect.sleep(30)  # Her 30 saniyede bir heartbeat gönder
 
     def run(self):
+        self.api_key = self.db.get_api_key()
+        if not self.api_key:
+            self.api_key = input("API Key'inizi girin: ")
+            self.db.save_api_key(self.api_key)
+
         try:
-            if self.connect_with_retry():
-                # Heartbeat sistemini başlat
-                def send_heartbeat():
-                    while self.sio.connected:
-                        self.sio.emit('heartbeat', {
-                            'system_info': self.system_info,
-                            'timestamp': datetime.now().isoformat()
-                        })
-                        time.sleep(30)  # Her 30 saniyede bir heartbeat gönder
-
-                import threading
-                heartbeat_thread = threading.Thread(target=send_heartbeat)
-                heartbeat_thread.daemon = True
-                heartbeat_thread.start()
-
-                logger.info("İstemci çalışıyor ve komut bekliyor...")
-                self.sio.wait()
-            else:
-                logger.error("Sunucuya bağlanılamadı, program sonlandırılıyor.")
+            self.sampler.start()
+            # Heartbeat sistemini başlat; bağlantı koptuğunda bekler, yeniden bağlanınca devam eder
+            heartbeat_thread = threading.Thread(target=self.heartbeat_loop)
+            heartbeat_thread.daemon = True
+            heartbeat_thread.start()
+
+            logger.info("İstemci çalışıyor ve komut bekliyor...")
+            self.reconnect.run()
         except KeyboardInterrupt:
             logger.info("İstemci kullanıcı tarafından sonlandırıldı.")
         except Exception as e:
             logger.error(f"Beklenmeyen hata: {str(e)}")
         finally:
+            self.reconnect.stop()
+            self.executor.shutdown()
+            self.sampler.stop()
             if self.sio.connected:
                 self.sio.disconnect()
 
+command_registry.load_plugins(COMMAND_PLUGINS)
+
 if __name__ == "__main__":
     client = RemoteClient()
     client.run()
\ No newline at end of file
@@ -0,0 +1,138 @@
+# logsetup.py
+# Logging pipeline shared by app.py and client.py. Callers only put records on a queue;
+# a listener thread formats them and writes a size-rotated, gzip-compressed log file.
+import atexit
+import datetime
+import gzip
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import shutil
+import threading
+import time
+
+TEXT_FORMAT = '%(asctime)s - %(levelname)s - %(message)s'
+
+class JsonFormatter(logging.Formatter):
+    # One JSON object per line; values passed with extra={...} become top-level fields
+    RESERVED = set(vars(logging.makeLogRecord({}))) | {'message', 'asctime'}
+
+    def format(self, record):
+        entry = {
+            'ts': datetime.datetime.fromtimestamp(record.created, datetime.timezone.utc)
+                  .isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'msg': record.getMessage(),
+            'thread': record.threadName
+        }
+        for key, value in vars(record).items():
+            if key not in self.RESERVED and not key.startswith('_'):
+                entry[key] = value
+        if record.exc_info:
+            entry['exc'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+class CompressingRotatingFileHandler(logging.handlers.RotatingFileHandler):
+    # Rotated files are gzipped (server.log.1.gz, ...); this runs on the listener thread
+    def __init__(self, filename, max_bytes, backups):
+        super().__init__(filename, maxBytes=max_bytes, backupCount=backups, encoding='utf-8',
+                         delay=True)
+        self.namer = lambda name: name + '.gz'
+        self.rotator = self._compress
+
+    @staticmethod
+    def _compress(source, dest):
+        with open(source, 'rb') as src, gzip.open(dest, 'wb') as dst:
+            shutil.copyfileobj(src, dst)
+        os.remove(source)
+
+class RateLimitFilter(logging.Filter):
+    # Token bucket for chatty loggers such as per-packet Socket.IO logs. Bursts pass, the
+    # excess is sampled 1 in `sample` (0 drops all of it), and the next record that passes
+    # says how many were dropped
+    def __init__(self, rate, burst, sample=0):
+        super().__init__()
+        self.rate = rate
+        self.burst = burst
+        self.sample = sample
+        self._tokens = burst
+        self._updated = time.monotonic()
+        self._dropped = 0
+        self._lock = threading.Lock()
+
+    def filter(self, record):
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            if self._tokens >= 1:
+                self._tokens -= 1
+            else:
+                self._dropped += 1
+                if not self.sample or self._dropped % self.sample:
+                    return False
+                self._dropped -= 1
+            dropped, self._dropped = self._dropped, 0
+        if dropped:
+            record.msg = f'{record.msg} [{dropped} similar records dropped]'
+            record.dropped = dropped
+        return True
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    # Never blocks the caller: when the listener falls behind, records are counted and dropped.
+    # SimpleQueue has no size limit of its own and, unlike queue.Queue, keeps working from a
+    # real thread after gevent monkey patching
+    def __init__(self, log_queue, max_size):
+        super().__init__(log_queue)
+        self.max_size = max_size
+        self.dropped = 0
+
+    def enqueue(self, record):
+        if self.queue.qsize() >= self.max_size:
+            self.dropped += 1
+            return
+        self.queue.put_nowait(record)
+
+def parse_levels(spec):
+    # "engineio.server=WARNING,socketio.server=INFO" -> {'engineio.server': 'WARNING', ...}
+    levels = {}
+    for entry in filter(None, (part.strip() for part in spec.split(','))):
+        name, _, level = entry.partition('=')
+        if name.strip() and level.strip():
+            levels[name.strip()] = level.strip().upper()
+    return levels
+
+def setup_logging(filename=None, level='INFO', levels=None, json_format=False,
+                  max_bytes=10 * 1024 * 1024, backups=5, console=True, queue_size=10000,
+                  rate_limits=None):
+    # rate_limits: {logger name: (records per second, burst, sample)}
+    # Replaces any handlers on the root logger and returns the queue handler
+    formatter = JsonFormatter() if json_format else logging.Formatter(TEXT_FORMAT)
+    handlers = []
+    if filename:
+        handlers.append(CompressingRotatingFileHandler(filename, max_bytes, backups))
+    if console:
+        handlers.append(logging.StreamHandler())
+    for handler in handlers:
+        handler.setFormatter(formatter)
+
+    log_queue = queue.SimpleQueue()
+    queue_handler = DroppingQueueHandler(log_queue, queue_size)
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(queue_handler)
+    root.setLevel(level)
+
+    for name, logger_level in (levels or {}).items():
+        logging.getLogger(name).setLevel(logger_level)
+    for name, (rate, burst, sample) in (rate_limits or {}).items():
+        logging.getLogger(name).addFilter(RateLimitFilter(rate, burst, sample))
+
+    listener = logging.handlers.QueueListener(log_queue, *handlers, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+    return queue_handler
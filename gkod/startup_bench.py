@@ -0,0 +1,124 @@
+# startup_bench.py
+# Agent cold-start benchmark: every run starts a fresh interpreter, imports client.py and
+# builds a RemoteClient, then reports wall time, peak RSS and the number of loaded modules.
+# The "eager" variant first imports the modules client.py used to load at import time
+# (pyautogui, which pulls in Pillow, pymsgbox, pyscreeze, ...) for comparison with the
+# lazily loaded command registry.
+#
+# Example:
+#   python startup_bench.py --runs 10
+#   python startup_bench.py --preload pyautogui,PIL.Image,numpy --json
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+CLIENT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Runs inside the child interpreter; prints one JSON line
+CHILD = '''
+import importlib, json, os, sys, time
+started = time.perf_counter()
+for name in filter(None, os.environ['BENCH_PRELOAD'].split(',')):
+    importlib.import_module(name)
+sys.path.insert(0, os.environ['BENCH_CLIENT_DIR'])
+import client
+imported = time.perf_counter()
+agent = client.RemoteClient()
+ready = time.perf_counter()
+try:
+    import resource
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and kilobytes elsewhere
+    rss_kb = rss / 1024 if sys.platform == 'darwin' else rss
+except ImportError:
+    import psutil
+    rss_kb = psutil.Process().memory_info().peak_wset / 1024
+print(json.dumps({
+    'import_seconds': imported - started,
+    'init_seconds': ready - imported,
+    'rss_kb': rss_kb,
+    'modules': len(sys.modules),
+    'capabilities': agent.system_info['capabilities']
+}))
+'''
+
+def run_once(preload, workdir):
+    env = dict(os.environ, BENCH_PRELOAD=preload, BENCH_CLIENT_DIR=CLIENT_DIR)
+    started = time.perf_counter()
+    # Runs in a scratch directory so client_config.db and client.log don't touch the real ones
+    result = subprocess.run([sys.executable, '-c', CHILD], cwd=workdir, env=env,
+                            capture_output=True, text=True)
+    elapsed = time.perf_counter() - started
+    if result.returncode != 0:
+        lines = result.stderr.strip().splitlines()
+        raise RuntimeError(lines[-1] if lines else f'exit status {result.returncode}')
+    sample = json.loads(result.stdout.strip().splitlines()[-1])
+    sample['process_seconds'] = elapsed
+    return sample
+
+def measure(preload, runs):
+    samples = []
+    with tempfile.TemporaryDirectory() as workdir:
+        for _ in range(runs):
+            samples.append(run_once(preload, workdir))
+    return {
+        'preload': preload.split(',') if preload else [],
+        'runs': runs,
+        'process_seconds': statistics.median(s['process_seconds'] for s in samples),
+        'import_seconds': statistics.median(s['import_seconds'] for s in samples),
+        'init_seconds': statistics.median(s['init_seconds'] for s in samples),
+        'rss_mb': statistics.median(s['rss_kb'] for s in samples) / 1024,
+        'modules': statistics.median(s['modules'] for s in samples),
+        'capabilities': samples[-1]['capabilities']
+    }
+
+def run(args):
+    report = {'lazy': measure('', args.runs)}
+    try:
+        report['eager'] = measure(args.preload, args.runs)
+    except RuntimeError as e:
+        report['eager'] = {'preload': args.preload.split(','), 'error': str(e)}
+    return report
+
+def format_ms(seconds):
+    return f'{seconds * 1000:.0f} ms'
+
+def print_report(report):
+    for name in ('lazy', 'eager'):
+        result = report[name]
+        label = f"{name} ({', '.join(result['preload']) or 'no preload'})"
+        if 'error' in result:
+            print(f'{label}: failed: {result["error"]}')
+            continue
+        print(f'{label}:')
+        print(f"  Cold start:        {format_ms(result['process_seconds'])} "
+              f"(import {format_ms(result['import_seconds'])}, init {format_ms(result['init_seconds'])})")
+        print(f"  Peak RSS:          {result['rss_mb']:.1f} MB")
+        print(f"  Loaded modules:    {result['modules']:.0f}")
+    lazy, eager = report['lazy'], report['eager']
+    if 'error' not in eager:
+        print(f"Saved:               {format_ms(eager['process_seconds'] - lazy['process_seconds'])}, "
+              f"{eager['rss_mb'] - lazy['rss_mb']:.1f} MB, "
+              f"{eager['modules'] - lazy['modules']:.0f} modules")
+    print(f"Capabilities:        {', '.join(lazy['capabilities'])}")
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Measure agent cold start with and without eager imports')
+    parser.add_argument('--runs', type=int, default=5, help='fresh interpreters per variant')
+    parser.add_argument('--preload', default='pyautogui',
+                        help='comma-separated modules the eager variant imports first')
+    parser.add_argument('--json', action='store_true', help='print the report as JSON')
+    return parser.parse_args()
+
+if __name__ == '__main__':
+    args = parse_args()
+    report = run(args)
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print_report(report)
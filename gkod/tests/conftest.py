@@ -0,0 +1,14 @@
+# conftest.py
+# app.py and client.py configure themselves at import time: the database, log files and
+# client_config.db all go to a scratch directory instead of /var or the checkout
+import os
+import sys
+import tempfile
+
+SCRATCH_DIR = tempfile.mkdtemp(prefix='gkod-tests-')
+os.environ.setdefault('DB_PATH', os.path.join(SCRATCH_DIR, 'database.db'))
+os.environ.setdefault('LOG_FILE', os.path.join(SCRATCH_DIR, 'server.log'))
+# client.py writes client.log and client_config.db to the working directory
+os.chdir(SCRATCH_DIR)
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,122 @@
+# test_presence.py
+# SqlitePresenceStore and SharedConnectionRegistry with two "workers" on one database file
+import pytest
+
+import app
+
+
+@pytest.fixture
+def workers(tmp_path):
+    # Each worker gets its own Database (and connection pool), as separate processes would
+    path = str(tmp_path / 'presence.db')
+    databases = [app.Database(path), app.Database(path)]
+    registries = [
+        app.SharedConnectionRegistry(app.SqlitePresenceStore(database.pool, worker_id=worker_id))
+        for database, worker_id in zip(databases, ('worker-a', 'worker-b'))
+    ]
+    yield registries
+    for database in databases:
+        database.close()
+
+
+def test_registration_is_visible_to_other_workers(workers):
+    a, b = workers
+    a.add('client-1', 'sid-1', 1, status='active', system_info={'os': 'linux'},
+          connected_at='2024-01-01T00:00:00')
+
+    record = b.get('client-1')
+    assert record['user_id'] == 1
+    assert record['worker_id'] == 'worker-a'
+    assert record['sid'] == 'sid-1'
+    assert record['system_info'] == {'os': 'linux'}
+    assert b.client_ids_for_user(1) == ['client-1']
+    # Worker b holds no socket for the client
+    assert 'client-1' not in b
+    assert b.client_for_sid('sid-1') is None
+
+
+def test_updates_and_disconnects_reach_other_workers(workers):
+    a, b = workers
+    a.add('client-1', 'sid-1', 1, status='active')
+    version = b.user_version(1)
+
+    a.update('client-1', status='busy')
+    _, changed, removed = b.changes_since(1, version)
+    assert [client_id for client_id, _ in changed] == ['client-1']
+    assert changed[0][1]['status'] == 'busy'
+    assert removed == []
+
+    version = b.user_version(1)
+    a.remove_sid('sid-1')
+    assert b.get('client-1') is None
+    assert b.changes_since(1, version)[1:] == ([], ['client-1'])
+
+
+def test_clients_of_expired_workers_are_reaped(workers):
+    a, b = workers
+    a.add('client-1', 'sid-1', 1, status='active')
+    b.add('client-2', 'sid-2', 1, status='active')
+    version = b.user_version(1)
+
+    # Worker a stops renewing its lease
+    with b.store.pool.connection() as conn:
+        conn.execute("UPDATE presence_workers SET lease_until = 0 WHERE worker_id = 'worker-a'")
+        conn.commit()
+    b.store.renew()
+
+    assert b.get('client-1') is None
+    assert b.client_ids_for_user(1) == ['client-2']
+    assert b.changes_since(1, version)[2] == ['client-1']
+
+
+def test_expired_tombstones_move_the_horizon(workers):
+    a, b = workers
+    a.add('client-1', 'sid-1', 1, status='active')
+    version = b.user_version(1)
+    a.remove_sid('sid-1')
+    assert b.changes_since(1, version) is not None
+
+    b.store.tombstone_ttl = -1
+    b.store.renew()
+    # The removal can no longer be reported as a delta, so callers must fetch a full listing
+    assert b.changes_since(1, version) is None
+
+
+def test_partition_checks_ownership_across_workers(workers):
+    a, b = workers
+    a.add('client-1', 'sid-1', 1, status='active')
+    a.add('client-2', 'sid-2', 2, status='active')
+    b.add('client-3', 'sid-3', 1, status='active')
+
+    owned, not_found, forbidden = b.partition(1, ['client-1', 'client-2', 'client-3', 'client-4'])
+    assert sorted(owned) == ['client-1', 'client-3']
+    assert not_found == ['client-4']
+    assert forbidden == ['client-2']
+
+
+def test_only_the_publishing_socket_withdraws(workers):
+    a, b = workers
+    a.add('client-1', 'sid-1', 1, status='active')
+
+    # A stale socket on another worker, or an old sid, must not remove the live entry
+    b.store.withdraw('client-1', 'sid-1')
+    a.store.withdraw('client-1', 'sid-old')
+    assert b.get('client-1')['sid'] == 'sid-1'
+
+    # Reconnecting through worker b moves the entry; a's late disconnect leaves it alone
+    b.add('client-1', 'sid-9', 1, status='active')
+    a.remove_sid('sid-1')
+    record = a.get('client-1')
+    assert record['worker_id'] == 'worker-b'
+    assert record['sid'] == 'sid-9'
+
+
+def test_client_moving_to_another_user_is_removed_for_the_old_one(workers):
+    a, b = workers
+    a.add('client-1', 'sid-1', 1, status='active')
+    version = b.user_version(1)
+
+    b.add('client-1', 'sid-2', 2, status='active')
+    assert b.client_ids_for_user(1) == []
+    assert b.changes_since(1, version)[2] == ['client-1']
+    assert b.partition(1, ['client-1'])[2] == ['client-1']
@@ -0,0 +1,188 @@
+# test_screen_watch.py
+# ScreenWatcher and changed_regions driven by SyntheticFrameSource
+import threading
+import time
+
+import pytest
+
+np = pytest.importorskip('numpy')
+pytest.importorskip('PIL')
+
+import client
+
+
+class FakeSocket:
+    # Records screen_frame packets; acks them right away unless auto_ack is off
+    def __init__(self, auto_ack=True, on_frame=None):
+        self.connected = True
+        self.auto_ack = auto_ack
+        self.on_frame = on_frame
+        self.frames = []
+        self.callbacks = []
+        self.ended = threading.Event()
+
+    def emit(self, event, data=None, callback=None):
+        if event == 'screen_watch_end':
+            self.ended.set()
+            return
+        self.frames.append(data)
+        if self.auto_ack:
+            callback({'ok': True})
+        else:
+            self.callbacks.append(callback)
+        if self.on_frame is not None and data['last']:
+            self.on_frame(self)
+
+
+def make_watcher(sio, source, **kwargs):
+    kwargs.setdefault('fps', 30)
+    kwargs.setdefault('tile', 32)
+    # Keyframes only on start and on request
+    kwargs.setdefault('keyframe_interval', 3600)
+    return client.ScreenWatcher(sio, source, 'watch-1', **kwargs)
+
+
+def stop_after(count, watcher):
+    def on_frame(sio):
+        if sum(1 for frame in sio.frames if frame['last']) >= count:
+            watcher.stop()
+    return on_frame
+
+
+def dirty_tiles(previous, frame, tile):
+    # Brute-force reference for changed_regions
+    height, width = frame.shape[:2]
+    tiles = set()
+    for y in range(0, height, tile):
+        for x in range(0, width, tile):
+            if (previous[y:y + tile, x:x + tile] != frame[y:y + tile, x:x + tile]).any():
+                tiles.add((x, y))
+    return tiles
+
+
+def region_tiles(regions, tile):
+    tiles = set()
+    for x, y, w, h in regions:
+        assert x % tile == 0 and y % tile == 0 and h <= tile
+        tiles.update((tx, y) for tx in range(x, x + w, tile))
+    return tiles
+
+
+def test_changed_regions_cover_exactly_the_dirty_tiles():
+    source = client.SyntheticFrameSource(width=200, height=120, box=20, speed=7)
+    previous = source.grab()
+    for _ in range(5):
+        frame = source.grab()
+        regions = client.changed_regions(previous, frame, 32)
+        assert region_tiles(regions, 32) == dirty_tiles(previous, frame, 32)
+        previous = frame
+
+
+def test_changed_regions_empty_for_identical_frames():
+    source = client.SyntheticFrameSource(width=200, height=120)
+    frame = source.grab()
+    assert client.changed_regions(frame, frame.copy(), 32) == []
+
+
+def test_changed_regions_clip_partial_tiles():
+    previous = np.zeros((50, 70, 3), dtype=np.uint8)
+    frame = previous.copy()
+    frame[49, 69] = 255
+    assert client.changed_regions(previous, frame, 32) == [(64, 32, 6, 18)]
+
+
+def test_keyframe_on_start_then_only_changed_tiles():
+    source = client.SyntheticFrameSource(width=320, height=160, box=24, speed=8)
+    reference = client.SyntheticFrameSource(width=320, height=160, box=24, speed=8)
+    sio = FakeSocket()
+    watcher = make_watcher(sio, source)
+    sio.on_frame = stop_after(4, watcher)
+    watcher._run()
+
+    frames = [frame for frame in sio.frames if frame['last']]
+    assert [frame['keyframe'] for frame in frames] == [True, False, False, False]
+    # The keyframe is full-width strips covering the whole frame
+    keyframe = frames[0]
+    assert sum(tile['h'] for tile in keyframe['tiles']) == 160
+    assert all(tile['x'] == 0 and tile['w'] == 320 for tile in keyframe['tiles'])
+
+    previous = reference.grab()
+    for frame in frames[1:]:
+        current = reference.grab()
+        regions = [(tile['x'], tile['y'], tile['w'], tile['h']) for tile in frame['tiles']]
+        assert region_tiles(regions, 32) == dirty_tiles(previous, current, 32)
+        assert sum(tile['w'] * tile['h'] for tile in frame['tiles']) < 320 * 160 / 4
+        previous = current
+
+    assert [frame['seq'] for frame in frames] == [1, 2, 3, 4]
+    assert watcher.stats['keyframes'] == 1
+    assert sio.ended.is_set()
+
+
+def test_keyframe_on_request():
+    source = client.SyntheticFrameSource(width=320, height=160)
+    sio = FakeSocket()
+    watcher = make_watcher(sio, source)
+
+    def on_frame(sio):
+        if len(sio.frames) == 2:
+            watcher.request_keyframe()
+        elif len(sio.frames) == 4:
+            watcher.stop()
+    sio.on_frame = on_frame
+    watcher._run()
+
+    assert [frame['keyframe'] for frame in sio.frames] == [True, False, True, False]
+    assert watcher.stats['keyframes'] == 2
+
+
+def test_unchanged_screen_sends_nothing_and_slows_down():
+    class StillSource(client.FrameSource):
+        def grab(self):
+            return np.full((64, 64, 3), 80, dtype=np.uint8)
+
+    sio = FakeSocket()
+    watcher = make_watcher(sio, StillSource(), duration=0.5)
+    watcher._run()
+
+    assert len(sio.frames) == 1 and sio.frames[0]['keyframe']
+    assert watcher.interval > watcher.min_interval
+
+
+def test_pauses_while_acks_are_outstanding():
+    source = client.SyntheticFrameSource(width=320, height=160)
+    sio = FakeSocket(auto_ack=False)
+    watcher = make_watcher(sio, source)
+    thread = threading.Thread(target=watcher._run, daemon=True)
+    thread.start()
+    try:
+        deadline = time.monotonic() + 5
+        while watcher.stats['skipped'] < 2 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        assert watcher.stats['skipped'] >= 2
+        # Nothing goes out beyond the unacked limit, and the capture rate backs off
+        assert len(sio.frames) == client.WATCH_MAX_UNACKED
+        assert watcher.interval > watcher.min_interval
+
+        callbacks, sio.callbacks = sio.callbacks, []
+        for callback in callbacks:
+            callback({'ok': True})
+        deadline = time.monotonic() + 5
+        while len(sio.frames) == client.WATCH_MAX_UNACKED and time.monotonic() < deadline:
+            time.sleep(0.01)
+        assert len(sio.frames) > client.WATCH_MAX_UNACKED
+    finally:
+        watcher.stop()
+        thread.join(5)
+    assert not thread.is_alive()
+
+
+def test_stop_requested_by_server_ack():
+    source = client.SyntheticFrameSource(width=320, height=160)
+    sio = FakeSocket(auto_ack=False)
+    watcher = make_watcher(sio, source)
+    sio.on_frame = lambda sio: sio.callbacks.pop()({'ok': False, 'stop': True})
+    watcher._run()
+
+    assert len(sio.frames) == 1
+    assert sio.ended.is_set()